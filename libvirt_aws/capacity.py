@@ -0,0 +1,151 @@
+from __future__ import annotations
+from typing import (
+    Dict,
+    NamedTuple,
+    Optional,
+)
+
+import libvirt
+
+
+class CapacityError(Exception):
+    pass
+
+
+class CapacityLimits(NamedTuple):
+    # Maximum ratio of bytes provisioned to volumes to the pool
+    # capacity, 0 for no limit.  Thin volumes only use storage as they
+    # are written to, so pools can safely promise more than they have,
+    # up to a point.
+    overcommit_ratio: float = 1.0
+    # Fraction of the pool capacity past which no more storage is
+    # promised, to leave headroom for existing thin volumes to grow.
+    max_fill: float = 0.95
+
+
+class PoolUsage(NamedTuple):
+    capacity: int
+    # Bytes of storage in use.
+    allocation: int
+    # Bytes promised to volumes.
+    provisioned: int
+
+    @property
+    def available(self) -> int:
+        return max(self.capacity - self.allocation, 0)
+
+
+def check_admission(
+    usage: PoolUsage,
+    limits: CapacityLimits,
+    size: int,
+    *,
+    preallocated: bool,
+) -> None:
+    """Raise CapacityError if *size* more bytes cannot be provisioned.
+
+    *preallocated* storage is taken from the pool right away, thin
+    storage is only promised.
+    """
+    fill_limit = usage.capacity * limits.max_fill
+    allocation = usage.allocation + (size if preallocated else 0)
+    if allocation > fill_limit:
+        raise CapacityError(
+            f"the storage pool has {_gib(usage.available)} GiB available, "
+            f"{_gib(usage.capacity - fill_limit)} GiB of which are reserved"
+        )
+
+    if limits.overcommit_ratio:
+        provision_limit = usage.capacity * limits.overcommit_ratio
+        if usage.provisioned + size > provision_limit:
+            raise CapacityError(
+                f"the storage pool has "
+                f"{_gib(max(provision_limit - usage.provisioned, 0))} GiB "
+                f"left to provision"
+            )
+
+
+def usage_metrics(usage: PoolUsage) -> Dict[str, float]:
+    return {
+        "PoolCapacityBytes": usage.capacity,
+        "PoolAllocatedBytes": usage.allocation,
+        "PoolAvailableBytes": usage.available,
+        "PoolProvisionedBytes": usage.provisioned,
+        "PoolOvercommitRatio": (
+            usage.provisioned / usage.capacity if usage.capacity else 0.0
+        ),
+    }
+
+
+def _gib(nbytes: float) -> str:
+    return f"{nbytes / 2**30:.1f}"
+
+
+class CapacityAccountant:
+    """Tracks the storage usage of a pool.
+
+    The pool and its volumes are sampled by refresh(), which makes a
+    libvirt call per volume and should run off the event loop.
+    """
+
+    def __init__(
+        self,
+        pool: libvirt.virStoragePool,
+        limits: CapacityLimits,
+    ) -> None:
+        self.pool = pool
+        self.limits = limits
+        self.capacity: Optional[int] = None
+        self._pool_allocation = 0
+        # Volume name -> allocation
+        self._volumes: Dict[str, int] = {}
+        # Storage preallocated since the last refresh.
+        self._pending = 0
+
+    def refresh(self) -> None:
+        _, capacity, allocation, _ = self.pool.info()
+        volumes = {}
+        for vol in self.pool.listAllVolumes(0):
+            try:
+                _, _, vol_allocation = vol.info()
+            except libvirt.libvirtError:
+                # Deleted in the meantime.
+                continue
+            volumes[vol.name()] = vol_allocation
+        self.capacity = capacity
+        self._pool_allocation = allocation
+        self._volumes = volumes
+        self._pending = 0
+
+    @property
+    def allocation(self) -> int:
+        # libvirt only updates the pool allocation on refresh, while
+        # volume allocation is current as of the last sample.  Other
+        # files may use the pool storage too, so take the larger.
+        volumes = sum(self._volumes.values())
+        return max(self._pool_allocation, volumes) + self._pending
+
+    def usage(self, provisioned: int) -> PoolUsage:
+        if self.capacity is None:
+            raise AssertionError("pool usage has not been sampled yet")
+        return PoolUsage(self.capacity, self.allocation, provisioned)
+
+    def admit(
+        self,
+        provisioned: int,
+        size: int,
+        *,
+        preallocated: bool,
+    ) -> None:
+        """Check that *size* more bytes can be provisioned and count them.
+
+        *provisioned* is the number of bytes already promised.
+        """
+        check_admission(
+            self.usage(provisioned),
+            self.limits,
+            size,
+            preallocated=preallocated,
+        )
+        if preallocated:
+            self._pending += size
@@ -0,0 +1,85 @@
+from __future__ import annotations
+from typing import (
+    Any,
+    Callable,
+    List,
+)
+
+import asyncio
+import threading
+
+import libvirt
+
+
+# Device event name, domain name, device alias.
+DeviceEventCallback = Callable[[str, str, str], None]
+
+DEVICE_EVENTS = {
+    "added": libvirt.VIR_DOMAIN_EVENT_ID_DEVICE_ADDED,
+    "removed": libvirt.VIR_DOMAIN_EVENT_ID_DEVICE_REMOVED,
+    "removal-failed": libvirt.VIR_DOMAIN_EVENT_ID_DEVICE_REMOVAL_FAILED,
+}
+
+_lock = threading.Lock()
+_started = False
+
+
+def start_event_loop() -> None:
+    """Run the libvirt event loop in a background thread.
+
+    Must be called before opening the connections that events are
+    wanted from.  Safe to call more than once.
+    """
+    global _started
+    with _lock:
+        if _started:
+            return
+        libvirt.virEventRegisterDefaultImpl()
+        thread = threading.Thread(
+            target=_run_event_loop,
+            name="libvirt-events",
+            daemon=True,
+        )
+        thread.start()
+        _started = True
+
+
+def _run_event_loop() -> None:
+    while True:
+        libvirt.virEventRunDefaultImpl()
+
+
+def register_device_events(
+    conn: libvirt.virConnect,
+    callback: DeviceEventCallback,
+) -> List[int]:
+    """Call *callback* in the running asyncio loop on device events.
+
+    Returns callback ids to pass to deregister_events().
+    """
+    loop = asyncio.get_running_loop()
+    ids = []
+
+    for name, event_id in DEVICE_EVENTS.items():
+
+        def _cb(
+            conn: libvirt.virConnect,
+            dom: libvirt.virDomain,
+            alias: str,
+            opaque: Any,
+            name: str = name,
+        ) -> None:
+            # Called in the libvirt event thread.
+            loop.call_soon_threadsafe(callback, name, dom.name(), alias)
+
+        ids.append(conn.domainEventRegisterAny(None, event_id, _cb, None))
+
+    return ids
+
+
+def deregister_events(conn: libvirt.virConnect, ids: List[int]) -> None:
+    for callback_id in ids:
+        try:
+            conn.domainEventDeregisterAny(callback_id)
+        except libvirt.libvirtError:
+            pass
@@ -2,8 +2,15 @@
 
 from ._routing import routes as routes
 
+from . import attachments
 from . import az
+from . import batch
+from . import cloudwatch
 from . import dns
+from . import ebs
 from . import instances
 from . import ips
+from . import snapshots
+from . import tags
 from . import volumes
+from . import warm_pool
@@ -0,0 +1,221 @@
+from __future__ import annotations
+from typing import (
+    Any,
+    Callable,
+    Iterable,
+    List,
+    Mapping,
+    NamedTuple,
+    Optional,
+    Sequence,
+)
+
+import fnmatch
+
+from . import _routing
+
+
+Getter = Callable[[Mapping[str, Any]], Iterable[Any]]
+
+
+class Field(NamedTuple):
+    """How a Describe* filter maps onto the data.
+
+    Filters with a *column* are pushed down into SQL as a qualifier on
+    that column (or SQL expression).  Filters with a *getter* are
+    evaluated against the described object after the SQL narrowing,
+    the getter returns all values of the object the filter may match.
+    """
+
+    column: Optional[str] = None
+    getter: Optional[Getter] = None
+    type: Callable[[str], Any] = str
+
+
+class CompiledFilters(NamedTuple):
+    quals: List[str]
+    params: List[Any]
+    residual: List[Callable[[Mapping[str, Any]], bool]]
+
+    @property
+    def has_sql(self) -> bool:
+        return bool(self.quals)
+
+    @property
+    def where(self) -> str:
+        return " AND ".join(self.quals) if self.quals else "1"
+
+    def match(self, obj: Mapping[str, Any]) -> bool:
+        return all(pred(obj) for pred in self.residual)
+
+
+def compile_filters(
+    filters: Optional[Sequence[Mapping[str, Any]]],
+    fields: Mapping[str, Field],
+    *,
+    resource_type: str,
+    id_column: str,
+) -> CompiledFilters:
+    """Compile EC2 Filter.N parameters into SQL and residual predicates.
+
+    Values of a single filter are OR-ed, distinct filters are AND-ed.
+    ``tag:<key>`` and ``tag-key`` filters are turned into lookups in
+    the tags table on *resource_type* joined on *id_column*.  Values
+    may contain the ``*`` and ``?`` wildcards, backslash escapes them.
+    """
+    compiled = CompiledFilters([], [], [])
+
+    for flt in filters or ():
+        if not flt:
+            continue
+        name = flt.get("Name")
+        if not name:
+            raise _routing.InvalidParameterError(
+                "missing required Filter.N.Name"
+            )
+        values = [v for v in flt.get("Value") or () if v is not None]
+        if not values:
+            raise _routing.InvalidParameterError(
+                f"missing required Filter.N.Value for filter {name}"
+            )
+
+        if name.startswith("tag:"):
+            tagname = name[len("tag:") :]
+            match, params = _match_values("tagvalue", values)
+            compiled.quals.append(
+                f"""{id_column} IN (
+                    SELECT resource_name FROM tags
+                    WHERE
+                        resource_type = ?
+                        AND tagname = ?
+                        AND {match}
+                )"""
+            )
+            compiled.params.extend([resource_type, tagname, *params])
+        elif name == "tag-key":
+            match, params = _match_values("tagname", values)
+            compiled.quals.append(
+                f"""{id_column} IN (
+                    SELECT resource_name FROM tags
+                    WHERE
+                        resource_type = ?
+                        AND {match}
+                )"""
+            )
+            compiled.params.extend([resource_type, *params])
+        else:
+            field = fields.get(name)
+            if field is None:
+                raise _routing.InvalidParameterError(
+                    f"unsupported filter type: {name}"
+                )
+            if field.column is not None:
+                match, params = _match_values(
+                    field.column, values, field.type
+                )
+                compiled.quals.append(match)
+                compiled.params.extend(params)
+            else:
+                assert field.getter is not None
+                compiled.residual.append(
+                    _make_predicate(field.getter, values)
+                )
+
+    return compiled
+
+
+def in_list(column: str, values: Sequence[Any]) -> str:
+    return f"{column} IN ({', '.join(['?'] * len(values))})"
+
+
+def _match_values(
+    column: str,
+    values: Sequence[str],
+    type: Callable[[str], Any] = str,
+) -> tuple[str, List[Any]]:
+    exact = []
+    patterns = []
+    for value in values:
+        if type is str and _has_wildcards(value):
+            patterns.append(_to_glob(value))
+        else:
+            try:
+                exact.append(type(_unescape(value)))
+            except ValueError:
+                raise _routing.InvalidParameterError(
+                    f"invalid filter value: {value!r}"
+                ) from None
+
+    quals = []
+    if exact:
+        quals.append(in_list(column, exact))
+    quals.extend(f"{column} GLOB ?" for _ in patterns)
+
+    if len(quals) == 1:
+        return quals[0], exact + patterns
+    else:
+        return f"({' OR '.join(quals)})", exact + patterns
+
+
+def _make_predicate(
+    getter: Getter,
+    values: Sequence[str],
+) -> Callable[[Mapping[str, Any]], bool]:
+    patterns = [_to_glob(v) for v in values]
+
+    def _pred(obj: Mapping[str, Any]) -> bool:
+        for val in getter(obj):
+            if isinstance(val, bool):
+                val = "true" if val else "false"
+            sval = str(val)
+            if any(fnmatch.fnmatchcase(sval, p) for p in patterns):
+                return True
+        return False
+
+    return _pred
+
+
+def _has_wildcards(value: str) -> bool:
+    escaped = False
+    for c in value:
+        if escaped:
+            escaped = False
+        elif c == "\\":
+            escaped = True
+        elif c in "*?":
+            return True
+    return False
+
+
+def _unescape(value: str) -> str:
+    if "\\" not in value:
+        return value
+    result = []
+    escaped = False
+    for c in value:
+        if escaped:
+            result.append(c)
+            escaped = False
+        elif c == "\\":
+            escaped = True
+        else:
+            result.append(c)
+    return "".join(result)
+
+
+def _to_glob(value: str) -> str:
+    # Translate an EC2 filter value into a pattern understood by both
+    # SQLite GLOB and fnmatch.
+    result = []
+    escaped = False
+    for c in value:
+        if escaped:
+            result.append(f"[{c}]" if c in "*?[" else c)
+            escaped = False
+        elif c == "\\":
+            escaped = True
+        elif c == "[":
+            result.append("[[]")
+        else:
+            result.append(c)
+    return "".join(result)
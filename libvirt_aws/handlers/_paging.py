@@ -0,0 +1,64 @@
+from __future__ import annotations
+from typing import (
+    Any,
+    List,
+    Sequence,
+)
+
+import base64
+import binascii
+import json
+
+from . import _routing
+
+
+class InvalidNextTokenError(_routing.ClientError):
+    code = "InvalidNextToken"
+
+
+def get_max_results(
+    args: _routing.HandlerArgs,
+    maximum: int,
+    minimum: int = 5,
+) -> int:
+    """Validate the MaxResults request parameter, *maximum* if unset."""
+    max_results_arg = args.get("MaxResults")
+    if not max_results_arg:
+        return maximum
+
+    try:
+        max_results = int(max_results_arg)
+    except ValueError:
+        raise _routing.InvalidParameterError(
+            "MaxResults must be an integer"
+        ) from None
+    if not minimum <= max_results <= maximum:
+        raise _routing.InvalidParameterError(
+            f"MaxResults must be between {minimum} and {maximum}"
+        )
+    return max_results
+
+
+def encode_next_token(key: Sequence[Any]) -> str:
+    """Encode the sort key of the last returned row as a NextToken."""
+    return base64.urlsafe_b64encode(json.dumps(list(key)).encode()).decode()
+
+
+def decode_next_token(token: str, length: int) -> List[str]:
+    """Decode a NextToken produced by encode_next_token().
+
+    The result is a sort key of *length* strings to continue after.
+    """
+    try:
+        key = json.loads(base64.urlsafe_b64decode(token.encode()))
+    except (ValueError, binascii.Error):
+        raise InvalidNextTokenError(
+            "The specified NextToken is not valid"
+        ) from None
+    if (
+        not isinstance(key, list)
+        or len(key) != length
+        or not all(isinstance(k, str) for k in key)
+    ):
+        raise InvalidNextTokenError("The specified NextToken is not valid")
+    return key
@@ -40,21 +40,30 @@ def _format_expanded_list(parent: str) -> str:
     return "item"
 
 
+def _format_member_list(parent: str) -> str:
+    return "member"
+
+
+_LIST_FORMATTERS = {
+    "condensed": _format_condensed_list,
+    "expanded": _format_expanded_list,
+    "member": _format_member_list,
+}
+
+ListFormat = Literal["condensed", "expanded", "member"]
+
+
 def format_xml_response(
     data: Mapping[str, Any],
     root: Optional[str] = None,
     xmlns: Optional[str] = None,
-    list_format: Literal["condensed", "expanded"] = "expanded",
+    list_format: ListFormat = "expanded",
 ) -> str:
     bbody = dicttoxml.dicttoxml(
         data,
         root=False,
         attr_type=False,
-        item_func=(
-            _format_condensed_list
-            if list_format == "condensed"
-            else _format_expanded_list
-        ),
+        item_func=_LIST_FORMATTERS[list_format],
     )
     body = bbody.decode("utf-8")
     if root is not None:
@@ -144,17 +153,24 @@ class SparseList(Generic[T], List[Optional[T]]):
 
 HandlerArgs = Dict[str, Any]
 
+# Handlers return a dict to be rendered as XML, or a ready response
+# for APIs that don't speak XML.
 _HandlerType = Callable[
     [HandlerArgs, libvirt.virStoragePool],
-    Awaitable[Dict[str, Any]],
+    Awaitable[Union[Dict[str, Any], web.StreamResponse]],
 ]
 
 
+# Raw handlers get the request itself, e.g. to stream its body.
+_RawHandlerType = Callable[[web.Request], Awaitable[web.StreamResponse]]
+
+
 class _HandlerData(NamedTuple):
     handler: _HandlerType
     xmlns: Optional[str]
-    list_format: Literal["condensed", "expanded"]
+    list_format: ListFormat
     error_formatter: Callable[[ServiceError], str]
+    error_content_type: str
     include_request_id: bool
 
 
@@ -168,8 +184,9 @@ def handler(
     methods: str | Tuple[str, ...] = ("GET", "POST"),
     path: str = "/",
     xmlns: Optional[str] = None,
-    list_format: Literal["condensed", "expanded"] = "expanded",
+    list_format: ListFormat = "expanded",
     error_formatter: Callable[[ServiceError], str] = format_ec2_error_xml,
+    error_content_type: str = "text/xml",
 ) -> Callable[[_HandlerType], _HandlerType]:
     if isinstance(methods, str):
         methods = (methods,)
@@ -184,6 +201,7 @@ def handler(
                     xmlns=xmlns,
                     list_format=list_format,
                     error_formatter=error_formatter,
+                    error_content_type=error_content_type,
                     include_request_id=True,
                 )
                 if (method, path) not in _path_handlers:
@@ -203,8 +221,9 @@ def direct_handler(
     methods: str | Tuple[str, ...] = ("GET", "POST"),
     path: str = "/",
     xmlns: Optional[str] = None,
-    list_format: Literal["condensed", "expanded"] = "expanded",
+    list_format: ListFormat = "expanded",
     error_formatter: Callable[[ServiceError], str] = format_ec2_error_xml,
+    error_content_type: str = "text/xml",
 ) -> Callable[[_HandlerType], _HandlerType]:
     if isinstance(methods, str):
         methods = (methods,)
@@ -219,6 +238,7 @@ def direct_handler(
                     xmlns=xmlns,
                     list_format=list_format,
                     error_formatter=error_formatter,
+                    error_content_type=error_content_type,
                     include_request_id=False,
                 )
                 paths = [path]
@@ -247,7 +267,40 @@ def direct_handler(
     return inner
 
 
+def raw_handler(
+    path: str,
+    *,
+    methods: str | Tuple[str, ...] = "GET",
+    error_formatter: Callable[[ServiceError], str] = format_ec2_error_xml,
+    error_content_type: str = "text/xml",
+) -> Callable[[_RawHandlerType], _RawHandlerType]:
+    if isinstance(methods, str):
+        methods = (methods,)
+
+    def inner(handler: _RawHandlerType) -> _RawHandlerType:
+        async def _handle(request: web.Request) -> web.StreamResponse:
+            try:
+                return await handler(request)
+            except ServiceError as e:
+                _format_error(e, error_formatter, error_content_type)
+                raise e
+            except Exception:
+                exc = InternalServerError("\n" + traceback.format_exc())
+                _format_error(exc, error_formatter, error_content_type)
+                raise exc from None
+
+        for method in methods:
+            if (method, path) in _path_handlers:
+                raise AssertionError(f"{method} {path} is already handled")
+            routes.route(method, path)(_handle)
+            _path_handlers.add((method, path))
+        return handler
+
+    return inner
+
+
 Args = Union[
+    multidict.MultiMapping[str],
     multidict.MultiDictProxy[str],
     multidict.MultiDictProxy[Union[str, bytes, web.FileField]],
 ]
@@ -339,6 +392,8 @@ async def handle_request(
 
     try:
         result = await handler_data.handler(args, request.app)
+        if isinstance(result, web.StreamResponse):
+            return result
 
         if handler_data.include_request_id:
             result["RequestID"] = str(uuid.uuid4())
@@ -355,17 +410,26 @@ async def handle_request(
         )
         return web.Response(text=text, content_type="text/xml")
     except ServiceError as e:
-        e.text = handler_data.error_formatter(e)
-        dom = minidom.parseString(e.text)
-        aiohttp.log.access_logger.debug(
-            f"Error Response:\n\n{dom.toprettyxml()}"
+        _format_error(
+            e, handler_data.error_formatter, handler_data.error_content_type
         )
         raise e
     except Exception:
         exc = InternalServerError("\n" + traceback.format_exc())
-        exc.text = handler_data.error_formatter(exc)
-        dom = minidom.parseString(exc.text)
-        aiohttp.log.access_logger.debug(
-            f"Error Response:\n\n{dom.toprettyxml()}"
+        _format_error(
+            exc, handler_data.error_formatter, handler_data.error_content_type
         )
         raise exc from None
+
+
+def _format_error(
+    err: ServiceError,
+    error_formatter: Callable[[ServiceError], str],
+    error_content_type: str,
+) -> None:
+    text = error_formatter(err)
+    err.text = text
+    err.content_type = error_content_type
+    if error_content_type == "text/xml":
+        text = minidom.parseString(text).toprettyxml()
+    aiohttp.log.access_logger.debug(f"Error Response:\n\n{text}")
@@ -0,0 +1,464 @@
+from __future__ import annotations
+from typing import (
+    Any,
+    AsyncIterator,
+    Collection,
+    Dict,
+    Iterator,
+    List,
+    NamedTuple,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+)
+
+import asyncio
+import contextlib
+import json
+import sqlite3
+
+import libvirt
+
+from .. import events
+from .. import objects
+from .. import qemu
+
+from . import _filters
+from . import _routing
+
+
+# Volume attachments are tracked in the attachments table and move
+#
+#   attaching -> attached -> detaching -> (row deleted)
+#
+# An attachment becomes "attached" once the guest reports a disk with
+# the serial we gave the device, or, for guests without an agent, as
+# soon as the device is plugged.  It is gone once libvirt reports the
+# device removed.  Disks of pool volumes without a row, e.g. attached
+# by other means, are considered attached.
+
+# How long to wait for the guest to see a new disk.
+CONFIRM_TIMEOUT = 30.0
+CONFIRM_POLL_INTERVAL = 0.5
+
+# Safety net for missed events.
+RECONCILE_INTERVAL = 60.0
+
+# Volumes get virtio disk targets vdb through vdzz, vda being left for
+# the boot disk.
+TARGET_PREFIX = "vd"
+MAX_TARGETS = 26 * 27
+
+
+class AttachmentRecord(NamedTuple):
+    volume_id: str
+    instance_id: str
+    device: str
+    driver: Optional[str]
+    state: str
+    alias: Optional[str]
+
+    @property
+    def driver_options(self) -> Dict[str, str]:
+        return json.loads(self.driver) if self.driver else {}
+
+
+_confirming: Set[Tuple[str, str]] = set()
+_tasks: Set[asyncio.Task[None]] = set()
+# Instance id -> lock held while choosing a target and recording an
+# attachment, so that concurrent attaches do not pick the same target.
+_domain_locks: Dict[str, asyncio.Lock] = {}
+# Attachments with an attachDevice() or detachDevice() call running.
+_in_flight: Set[Tuple[str, str]] = set()
+
+
+def get_attachments(
+    db: sqlite3.Connection,
+    *,
+    volume_ids: Optional[Sequence[str]] = None,
+    instance_id: Optional[str] = None,
+) -> List[AttachmentRecord]:
+    quals = []
+    params: List[Any] = []
+    if volume_ids is not None:
+        quals.append(_filters.in_list("volume_id", volume_ids))
+        params.extend(volume_ids)
+    if instance_id is not None:
+        quals.append("instance_id = ?")
+        params.append(instance_id)
+
+    with db:
+        cur = db.execute(
+            f"""
+                SELECT {", ".join(AttachmentRecord._fields)}
+                FROM attachments
+                WHERE {" AND ".join(quals) or "1"}
+            """,
+            params,
+        )
+        return [AttachmentRecord(*row) for row in cur.fetchall()]
+
+
+def get_attachment(
+    db: sqlite3.Connection,
+    volume_id: str,
+    instance_id: str,
+) -> Optional[AttachmentRecord]:
+    records = [
+        r
+        for r in get_attachments(db, volume_ids=[volume_id])
+        if r.instance_id == instance_id
+    ]
+    return records[0] if records else None
+
+
+def domain_lock(instance_id: str) -> asyncio.Lock:
+    """Return the lock serializing the attachment of disks to a domain."""
+    lock = _domain_locks.get(instance_id)
+    if lock is None:
+        lock = _domain_locks[instance_id] = asyncio.Lock()
+    return lock
+
+
+@contextlib.contextmanager
+def in_flight(volume_id: str, instance_id: str) -> Iterator[None]:
+    """Mark the libvirt call making or removing an attachment as running.
+
+    reconcile() leaves such attachments alone, as their device may not
+    have shown up in the domain yet.
+    """
+    key = (volume_id, instance_id)
+    _in_flight.add(key)
+    try:
+        yield
+    finally:
+        _in_flight.discard(key)
+
+
+def get_used_targets(
+    db: sqlite3.Connection,
+    domain: objects.Domain,
+) -> Set[str]:
+    """Return the disk targets of *domain* that are taken.
+
+    Besides the disks of the domain these are the targets of
+    attachments being made.
+    """
+    used = set(domain.disk_targets)
+    used.update(r.device for r in get_attachments(db, instance_id=domain.name))
+    return used
+
+
+def target_name(index: int) -> str:
+    """Return the name of the *index*th virtio disk target, from vda."""
+    suffix = ""
+    index += 1
+    while index:
+        index, rem = divmod(index - 1, 26)
+        suffix = chr(ord("a") + rem) + suffix
+    return f"{TARGET_PREFIX}{suffix}"
+
+
+def allocate_target(used: Collection[str]) -> Optional[str]:
+    """Return the first free disk target, None if all are taken."""
+    for index in range(1, MAX_TARGETS):
+        name = target_name(index)
+        if name not in used:
+            return name
+    return None
+
+
+def begin_attach(
+    db: sqlite3.Connection,
+    volume_id: str,
+    instance_id: str,
+    device: str,
+    driver: Dict[str, str],
+) -> None:
+    """Record an attachment about to be made.  Must be in a transaction."""
+    db.execute(
+        """
+            INSERT INTO attachments
+                (volume_id, instance_id, device, driver, state, alias)
+            VALUES (?, ?, ?, ?, 'attaching', NULL)
+            ON CONFLICT (volume_id, instance_id)
+            DO UPDATE SET
+                device = excluded.device,
+                driver = excluded.driver,
+                state = excluded.state,
+                alias = NULL
+        """,
+        [volume_id, instance_id, device, json.dumps(driver)],
+    )
+
+
+def begin_detach(
+    db: sqlite3.Connection,
+    volume_id: str,
+    instance_id: str,
+    device: str,
+    alias: Optional[str],
+) -> None:
+    """Record a detachment about to be requested.
+
+    Must be called inside a transaction.
+    """
+    db.execute(
+        """
+            INSERT INTO attachments
+                (volume_id, instance_id, device, state, alias)
+            VALUES (?, ?, ?, 'detaching', ?)
+            ON CONFLICT (volume_id, instance_id)
+            DO UPDATE SET
+                state = excluded.state,
+                alias = coalesce(excluded.alias, alias)
+        """,
+        [volume_id, instance_id, device, alias],
+    )
+
+
+def set_state(
+    db: sqlite3.Connection,
+    volume_id: str,
+    instance_id: str,
+    state: str,
+    *,
+    expected: Optional[str] = None,
+) -> None:
+    """Move an attachment to *state*, if it is in *expected* state."""
+    with db:
+        db.execute(
+            """
+                UPDATE attachments SET state = ?
+                WHERE
+                    volume_id = ? AND instance_id = ?
+                    AND (? IS NULL OR state = ?)
+            """,
+            [state, volume_id, instance_id, expected, expected],
+        )
+
+
+def forget(db: sqlite3.Connection, volume_id: str, instance_id: str) -> None:
+    with db:
+        db.execute(
+            "DELETE FROM attachments WHERE volume_id = ? AND instance_id = ?",
+            [volume_id, instance_id],
+        )
+
+
+def get_states(
+    db: sqlite3.Connection,
+    instance_id: Optional[str] = None,
+) -> Dict[Tuple[str, str], Tuple[str, str]]:
+    """Map (volume_id, instance_id) to (device, state)."""
+    return {
+        (r.volume_id, r.instance_id): (r.device, r.state)
+        for r in get_attachments(db, instance_id=instance_id)
+    }
+
+
+def track_attach(
+    app: _routing.App,
+    virdom: libvirt.virDomain,
+    volume_id: str,
+    instance_id: str,
+    device: str,
+) -> None:
+    """Follow up on an attachDevice() call that succeeded."""
+    domain = objects.domain_from_xml(virdom.XMLDesc(0))
+    alias = domain.disk_aliases.get(device)
+    if alias is not None:
+        with app["db"]:
+            app["db"].execute(
+                """
+                    UPDATE attachments SET alias = ?
+                    WHERE volume_id = ? AND instance_id = ?
+                """,
+                [alias, volume_id, instance_id],
+            )
+    if device in domain.disk_targets:
+        # The device is plugged already, don't wait for the event.
+        _start_confirmation(app, virdom, volume_id, instance_id, device)
+
+
+def track_detach(
+    app: _routing.App,
+    virdom: libvirt.virDomain,
+    volume_id: str,
+    instance_id: str,
+    device: str,
+) -> str:
+    """Follow up on a detachDevice() call, return the attachment state."""
+    domain = objects.domain_from_xml(virdom.XMLDesc(0))
+    if device in domain.disk_targets:
+        # The guest has not released the device yet, wait for the
+        # DEVICE_REMOVED event.
+        return "detaching"
+    forget(app["db"], volume_id, instance_id)
+    return "detached"
+
+
+def handle_device_event(
+    app: _routing.App,
+    event: str,
+    instance_id: str,
+    alias: str,
+) -> None:
+    db: sqlite3.Connection = app["db"]
+    records = get_attachments(db, instance_id=instance_id)
+    record = next((r for r in records if r.alias == alias), None)
+
+    if event == "added":
+        virdom = app["libvirt"].lookupByName(instance_id)
+        if record is None:
+            # Our own attachDevice() call has not returned yet, or
+            # the alias is not recorded for some other reason.
+            domain = objects.domain_from_xml(virdom.XMLDesc(0))
+            targets = {v: k for k, v in domain.disk_aliases.items()}
+            device = targets.get(alias)
+            record = next((r for r in records if r.device == device), None)
+        if record is not None and record.state == "attaching":
+            _start_confirmation(
+                app, virdom, record.volume_id, instance_id, record.device
+            )
+    elif record is None:
+        return
+    elif event == "removed":
+        forget(db, record.volume_id, instance_id)
+    elif event == "removal-failed":
+        app["logger"].warning(
+            f"guest refused to release volume {record.volume_id} "
+            f"from instance {instance_id}"
+        )
+        set_state(
+            db,
+            record.volume_id,
+            instance_id,
+            "attached",
+            expected="detaching",
+        )
+
+
+def _start_confirmation(
+    app: _routing.App,
+    virdom: libvirt.virDomain,
+    volume_id: str,
+    instance_id: str,
+    device: str,
+) -> None:
+    key = (volume_id, instance_id)
+    if key in _confirming:
+        return
+    _confirming.add(key)
+    task = asyncio.create_task(
+        _confirm_attachment(app, virdom, volume_id, instance_id, device)
+    )
+    _tasks.add(task)
+    task.add_done_callback(_tasks.discard)
+
+
+async def _confirm_attachment(
+    app: _routing.App,
+    virdom: libvirt.virDomain,
+    volume_id: str,
+    instance_id: str,
+    device: str,
+) -> None:
+    try:
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + CONFIRM_TIMEOUT
+        serial = f"lvirtebs-{device}"
+        while True:
+            try:
+                # guest-get-disks returns a list, not an object.
+                disks: Any = await qemu.agent_command(
+                    virdom, {"execute": "guest-get-disks"}
+                )
+            except libvirt.libvirtError:
+                # No (capable) agent, the device being plugged is all
+                # the confirmation there is going to be.
+                break
+            if any(get_disk_serial(d) == serial for d in disks):
+                break
+            if loop.time() >= deadline:
+                app["logger"].warning(
+                    f"instance {instance_id} did not report volume "
+                    f"{volume_id} as {device} in {CONFIRM_TIMEOUT}s"
+                )
+                break
+            await asyncio.sleep(CONFIRM_POLL_INTERVAL)
+
+        set_state(
+            app["db"],
+            volume_id,
+            instance_id,
+            "attached",
+            expected="attaching",
+        )
+    finally:
+        _confirming.discard((volume_id, instance_id))
+
+
+def get_disk_serial(disk: Dict[str, Any]) -> Optional[str]:
+    """Return the serial of a disk reported by the guest agent."""
+    serial = disk.get("serial") or (disk.get("address") or {}).get("serial")
+    return str(serial) if serial else None
+
+
+async def reconcile(app: _routing.App) -> None:
+    """Bring attachment states in line with the devices of the domains.
+
+    Catches up on events missed while the service was not running.
+    Attachments whose libvirt call is still running are skipped, and
+    the rest checked without yielding to the event loop.
+    """
+    lvirt_conn: libvirt.virConnect = app["libvirt"]
+    db: sqlite3.Connection = app["db"]
+
+    records = get_attachments(db)
+    domains: Dict[str, Optional[Tuple[libvirt.virDomain, objects.Domain]]]
+    domains = {}
+    for record in records:
+        if (record.volume_id, record.instance_id) in _in_flight:
+            continue
+        if record.instance_id not in domains:
+            try:
+                virdom = lvirt_conn.lookupByName(record.instance_id)
+                domain = objects.domain_from_xml(virdom.XMLDesc(0))
+            except libvirt.libvirtError:
+                domains[record.instance_id] = None
+            else:
+                domains[record.instance_id] = (virdom, domain)
+
+        entry = domains[record.instance_id]
+        if entry is None or record.device not in entry[1].disk_targets:
+            forget(db, record.volume_id, record.instance_id)
+        elif record.state == "attaching":
+            _start_confirmation(
+                app,
+                entry[0],
+                record.volume_id,
+                record.instance_id,
+                record.device,
+            )
+
+
+async def watch_device_events(app: _routing.App) -> AsyncIterator[None]:
+    """Cleanup context advancing attachment states on device events."""
+    conn: libvirt.virConnect = app["libvirt"]
+
+    def _on_event(event: str, instance_id: str, alias: str) -> None:
+        try:
+            handle_device_event(app, event, instance_id, alias)
+        except Exception:
+            app["logger"].exception(
+                f"could not handle device {event} event of {instance_id}"
+            )
+
+    ids = events.register_device_events(conn, _on_event)
+    await reconcile(app)
+    yield
+    events.deregister_events(conn, ids)
+    for task in list(_tasks):
+        task.cancel()
@@ -0,0 +1,263 @@
+from __future__ import annotations
+from typing import (
+    Any,
+    Awaitable,
+    Callable,
+    Dict,
+    List,
+    NamedTuple,
+    Optional,
+    Tuple,
+)
+
+import asyncio
+import json
+
+from aiohttp import web
+import libvirt
+
+from . import _routing
+from . import errors
+from . import volumes
+
+
+# Largest number of steps in one batch request.
+MAX_BATCH_SIZE = 500
+# How many steps of a batch run at once, unless MaxConcurrency says
+# otherwise, and the most MaxConcurrency may ask for.
+DEFAULT_CONCURRENCY = 8
+MAX_CONCURRENCY = 32
+
+
+def format_batch_error_json(err: _routing.ServiceError) -> str:
+    return json.dumps({"Error": _format_error(err)})
+
+
+class BatchStep(NamedTuple):
+    action: str
+    args: _routing.HandlerArgs
+
+
+class _BatchContext:
+    """State shared by the steps of a batch.
+
+    Domain lookups and volume attachments are only fetched once per
+    batch rather than once per step.
+    """
+
+    def __init__(self, app: _routing.App) -> None:
+        self.app = app
+        self._domains: Dict[str, Optional[libvirt.virDomain]] = {}
+        self._attachments: Optional[volumes.Attachments] = None
+
+    def get_domain(self, instance_id: str) -> Optional[libvirt.virDomain]:
+        if instance_id not in self._domains:
+            lvirt_conn: libvirt.virConnect = self.app["libvirt"]
+            try:
+                virdom = lvirt_conn.lookupByName(instance_id)
+            except libvirt.libvirtError:
+                virdom = None
+            self._domains[instance_id] = virdom
+        return self._domains[instance_id]
+
+    @property
+    def attachments(self) -> volumes.Attachments:
+        if self._attachments is None:
+            self._attachments = volumes.get_attachments(self.app)
+        return self._attachments
+
+
+def _get_domain(
+    ctx: _BatchContext,
+    args: _routing.HandlerArgs,
+    not_found: type[_routing.ServiceError],
+) -> libvirt.virDomain:
+    instance_id = args.get("InstanceId")
+    if not instance_id:
+        raise _routing.InvalidParameterError("missing required InstanceId")
+    if not isinstance(instance_id, str):
+        raise _routing.InvalidParameterError("invalid InstanceId value")
+    virdom = ctx.get_domain(instance_id)
+    if virdom is None:
+        raise not_found(f"invalid InstanceId: {instance_id}")
+    return virdom
+
+
+async def _create_volume(
+    ctx: _BatchContext,
+    args: _routing.HandlerArgs,
+) -> Dict[str, Any]:
+    return await volumes.create(ctx.app, args)
+
+
+async def _attach_volume(
+    ctx: _BatchContext,
+    args: _routing.HandlerArgs,
+) -> Dict[str, Any]:
+    virdom = _get_domain(ctx, args, _routing.InvalidParameterError)
+    return await volumes.attach(
+        ctx.app, args, virdom, attachments=ctx.attachments
+    )
+
+
+async def _detach_volume(
+    ctx: _BatchContext,
+    args: _routing.HandlerArgs,
+) -> Dict[str, Any]:
+    virdom = _get_domain(ctx, args, errors.InvalidInstanceID_NotFound)
+    return await volumes.detach(
+        ctx.app, args, virdom, attachments=ctx.attachments
+    )
+
+
+async def _delete_volume(
+    ctx: _BatchContext,
+    args: _routing.HandlerArgs,
+) -> Dict[str, Any]:
+    volume_id = args.get("VolumeId")
+    if not volume_id:
+        raise _routing.InvalidParameterError("missing required VolumeId")
+    return await volumes.delete(
+        ctx.app, volume_id, attachments=ctx.attachments
+    )
+
+
+BATCH_ACTIONS: Dict[
+    str,
+    Callable[[_BatchContext, _routing.HandlerArgs], Awaitable[Dict[str, Any]]],
+] = {
+    "CreateVolume": _create_volume,
+    "AttachVolume": _attach_volume,
+    "DetachVolume": _detach_volume,
+    "DeleteVolume": _delete_volume,
+}
+
+
+def _to_args(value: Any, path: str) -> Any:
+    # Bring JSON values to the shape parse_args() gives query
+    # parameters, which is what the handlers expect.
+    if isinstance(value, dict):
+        return {k: _to_args(v, f"{path}.{k}") for k, v in value.items()}
+    elif isinstance(value, list):
+        return [_to_args(v, f"{path}.{i}") for i, v in enumerate(value, 1)]
+    elif isinstance(value, bool):
+        return "true" if value else "false"
+    elif isinstance(value, (str, int, float)):
+        return str(value)
+    else:
+        raise _routing.InvalidParameterError(
+            f"Value {value!r} for parameter {path} is invalid"
+        )
+
+
+def parse_batch(body: Any) -> Tuple[List[BatchStep], int]:
+    """Parse a batch request body into its steps and concurrency."""
+    if not isinstance(body, dict):
+        raise _routing.InvalidParameterError("expected a JSON object")
+
+    requests = body.get("Requests")
+    if not isinstance(requests, list) or not requests:
+        raise _routing.InvalidParameterError("missing required Requests")
+    if len(requests) > MAX_BATCH_SIZE:
+        raise _routing.InvalidParameterError(
+            f"a batch may have at most {MAX_BATCH_SIZE} Requests"
+        )
+
+    concurrency = body.get("MaxConcurrency", DEFAULT_CONCURRENCY)
+    if (
+        not isinstance(concurrency, int)
+        or isinstance(concurrency, bool)
+        or not 1 <= concurrency <= MAX_CONCURRENCY
+    ):
+        raise _routing.InvalidParameterError(
+            f"MaxConcurrency must be between 1 and {MAX_CONCURRENCY}"
+        )
+
+    steps = []
+    volume_ids = set()
+    for i, request in enumerate(requests, 1):
+        if not isinstance(request, dict):
+            raise _routing.InvalidParameterError(
+                f"Requests.{i} must be an object"
+            )
+        args = _to_args(request, f"Requests.{i}")
+        action = args.pop("Action", None)
+        if action not in BATCH_ACTIONS:
+            raise _routing.InvalidParameterError(
+                f"Requests.{i}: unsupported Action: {action}"
+            )
+        # Steps run concurrently and do not see each other's effects,
+        # so a volume may only be acted on once per batch.
+        volume_id = args.get("VolumeId")
+        if volume_id:
+            if volume_id in volume_ids:
+                raise _routing.InvalidParameterError(
+                    f"Requests.{i}: volume {volume_id} appears more than "
+                    f"once in the batch"
+                )
+            volume_ids.add(volume_id)
+        steps.append(BatchStep(action, args))
+
+    return steps, concurrency
+
+
+def _format_error(err: _routing.ServiceError) -> Dict[str, str]:
+    return {"Code": err.code, "Message": err.msg}
+
+
+async def run_batch(
+    app: _routing.App,
+    steps: List[BatchStep],
+    concurrency: int,
+) -> List[Dict[str, Any]]:
+    """Run *steps* at most *concurrency* at a time.
+
+    Returns the result of every step, in order.  A failed step does not
+    stop the others.
+    """
+    ctx = _BatchContext(app)
+    sem = asyncio.Semaphore(concurrency)
+
+    async def _run(step: BatchStep) -> Dict[str, Any]:
+        async with sem:
+            try:
+                result = await BATCH_ACTIONS[step.action](ctx, step.args)
+            except _routing.ServiceError as e:
+                return {"Error": _format_error(e)}
+            except Exception as e:
+                app["logger"].exception(f"batch {step.action} failed")
+                return {
+                    "Error": {
+                        "Code": _routing.InternalServerError.code,
+                        "Message": str(e),
+                    }
+                }
+            return {"Result": result}
+
+    return list(await asyncio.gather(*(_run(step) for step in steps)))
+
+
+@_routing.raw_handler(
+    "/volumes/batch",
+    methods="POST",
+    error_formatter=format_batch_error_json,
+    error_content_type="application/json",
+)
+async def batch_volumes(request: web.Request) -> web.StreamResponse:
+    """Create, attach, detach or delete many volumes in one request.
+
+    The body is a JSON object with a list of Requests, each having an
+    Action and the parameters of that action, and optionally the
+    MaxConcurrency to run them with.
+    """
+    app: _routing.App = request.app
+    try:
+        body = await request.json()
+    except ValueError:
+        raise _routing.InvalidParameterError(
+            "request body is not valid JSON"
+        ) from None
+
+    steps, concurrency = parse_batch(body)
+    results = await run_batch(app, steps, concurrency)
+    return web.json_response({"Results": results})
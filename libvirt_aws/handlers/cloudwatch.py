@@ -0,0 +1,506 @@
+from __future__ import annotations
+from typing import (
+    Any,
+    Dict,
+    List,
+    Mapping,
+    NamedTuple,
+    Optional,
+    Tuple,
+)
+
+import datetime
+import functools
+import time
+import uuid
+
+import libvirt
+
+from .. import metrics
+from .. import objects
+from .. import tasks
+
+from . import _paging
+from . import _routing
+from . import volumes
+
+
+# A read-only subset of the CloudWatch query API serving the AWS/EBS
+# metrics of attached volumes, sampled from libvirt block statistics.
+# Every sample of a counter metric is the increment over the sampling
+# interval, so Sum over a period is the total for the period and
+# SampleCount is the number of samples rather than of I/O operations.
+# Storage pool usage is served from a namespace of its own.
+
+XMLNS = "http://monitoring.amazonaws.com/doc/2010-08-01/"
+NAMESPACE = "AWS/EBS"
+POOL_NAMESPACE = "LibvirtAWS/StoragePool"
+
+# Metric name -> unit.
+METRICS = {
+    "VolumeReadOps": "Count",
+    "VolumeWriteOps": "Count",
+    "VolumeReadBytes": "Bytes",
+    "VolumeWriteBytes": "Bytes",
+    "VolumeTotalReadTime": "Seconds",
+    "VolumeTotalWriteTime": "Seconds",
+    "VolumeIdleTime": "Seconds",
+    "VolumeQueueLength": "Count",
+    # Non-standard: space returned to the pool by sparsification.
+    "VolumeReclaimedBytes": "Bytes",
+}
+
+POOL_METRICS = {
+    "PoolCapacityBytes": "Bytes",
+    "PoolAllocatedBytes": "Bytes",
+    "PoolAvailableBytes": "Bytes",
+    "PoolProvisionedBytes": "Bytes",
+    "PoolOvercommitRatio": "None",
+    # Bytes read from and written to attached volumes in the pool.
+    "PoolReadBytes": "Bytes",
+    "PoolWriteBytes": "Bytes",
+}
+
+
+class _Namespace(NamedTuple):
+    # App key of the MetricStore holding the series.
+    store: str
+    # The one dimension, identifying the resource.
+    dimension: str
+    # Metric name -> unit.
+    metrics: Dict[str, str]
+
+
+NAMESPACES = {
+    NAMESPACE: _Namespace("metrics", "VolumeId", METRICS),
+    POOL_NAMESPACE: _Namespace("pool_metrics", "PoolName", POOL_METRICS),
+}
+
+STATISTICS = {"SampleCount", "Average", "Sum", "Minimum", "Maximum"}
+
+MAX_DATAPOINTS = 1440
+MAX_METRIC_DATA_QUERIES = 500
+LIST_METRICS_MAX_RESULTS = 500
+
+_COUNTERS = (
+    "rd.reqs",
+    "rd.bytes",
+    "rd.times",
+    "wr.reqs",
+    "wr.bytes",
+    "wr.times",
+    "fl.reqs",
+    "fl.times",
+)
+
+
+def format_cloudwatch_error_xml(err: _routing.ServiceError) -> str:
+    return _routing.format_xml_response(
+        {
+            "ErrorResponse": {
+                "Error": {
+                    "Type": "Sender",
+                    "Code": err.code,
+                    "Message": err.msg,
+                },
+                "RequestId": str(uuid.uuid4()),
+            },
+        },
+        xmlns=XMLNS,
+    )
+
+
+class InvalidParameterCombinationError(_routing.ClientError):
+    code = "InvalidParameterCombination"
+
+
+class MissingParameterError(_routing.ClientError):
+    code = "MissingParameter"
+
+
+cloudwatch_handler = functools.partial(
+    _routing.handler,
+    xmlns=XMLNS,
+    list_format="member",
+    error_formatter=format_cloudwatch_error_xml,
+)
+
+
+@cloudwatch_handler("GetMetricStatistics")
+async def get_metric_statistics(
+    args: _routing.HandlerArgs,
+    app: _routing.App,
+) -> Dict[str, Any]:
+    namespace, metric_name = _get_metric_name(
+        args.get("Namespace"), args.get("MetricName")
+    )
+    resource_id = _get_resource_id(namespace, args.get("Dimensions"))
+    start, end = _get_time_range(args)
+    period = _get_period(args.get("Period"), start, end)
+
+    statistics = list(_get_members(args.get("Statistics")))
+    if not statistics:
+        raise MissingParameterError("missing required Statistics")
+    unknown = set(statistics) - STATISTICS
+    if unknown:
+        raise _routing.InvalidParameterError(
+            f"unsupported Statistics: {', '.join(sorted(unknown))}"
+        )
+
+    unit = namespace.metrics[metric_name]
+    datapoints = []
+    series = app[namespace.store].get((resource_id, metric_name))
+    if series is not None:
+        for dp in series.query(start, end, period):
+            datapoint: Dict[str, Any] = {
+                "Timestamp": _format_time(dp.timestamp),
+            }
+            for stat in statistics:
+                datapoint[stat] = _get_statistic(dp, stat)
+            datapoint["Unit"] = unit
+            datapoints.append(datapoint)
+
+    return {
+        "GetMetricStatisticsResult": {
+            "Label": metric_name,
+            "Datapoints": datapoints,
+        },
+        "ResponseMetadata": {
+            "RequestId": str(uuid.uuid4()),
+        },
+    }
+
+
+@cloudwatch_handler("GetMetricData")
+async def get_metric_data(
+    args: _routing.HandlerArgs,
+    app: _routing.App,
+) -> Dict[str, Any]:
+    start, end = _get_time_range(args)
+    queries = list(_get_members(args.get("MetricDataQueries")))
+    if not queries:
+        raise MissingParameterError("missing required MetricDataQueries")
+    if len(queries) > MAX_METRIC_DATA_QUERIES:
+        raise _routing.InvalidParameterError(
+            f"at most {MAX_METRIC_DATA_QUERIES} MetricDataQueries "
+            f"are allowed"
+        )
+    descending = args.get("ScanBy", "TimestampDescending") != (
+        "TimestampAscending"
+    )
+
+    results = []
+    for query in queries:
+        if not query or not query.get("Id"):
+            raise MissingParameterError(
+                "missing required MetricDataQueries.member.N.Id"
+            )
+        if query.get("Expression"):
+            raise _routing.InvalidParameterError(
+                "metric math expressions are not supported"
+            )
+        stat_spec = query.get("MetricStat")
+        if not stat_spec:
+            raise MissingParameterError(
+                "missing required MetricDataQueries.member.N.MetricStat"
+            )
+        metric = stat_spec.get("Metric") or {}
+        namespace, metric_name = _get_metric_name(
+            metric.get("Namespace"), metric.get("MetricName")
+        )
+        resource_id = _get_resource_id(namespace, metric.get("Dimensions"))
+        period = _get_period(stat_spec.get("Period"), start, end)
+        stat = stat_spec.get("Stat")
+        if stat not in STATISTICS:
+            raise _routing.InvalidParameterError(
+                f"unsupported Stat: {stat}"
+            )
+        if query.get("ReturnData", "true") == "false":
+            continue
+
+        series = app[namespace.store].get((resource_id, metric_name))
+        points = series.query(start, end, period) if series else []
+        if descending:
+            points.reverse()
+        results.append(
+            {
+                "Id": query["Id"],
+                "Label": query.get("Label") or metric_name,
+                "Timestamps": [_format_time(dp.timestamp) for dp in points],
+                "Values": [_get_statistic(dp, stat) for dp in points],
+                "StatusCode": "Complete",
+            }
+        )
+
+    return {
+        "GetMetricDataResult": {
+            "MetricDataResults": results,
+            "Messages": [],
+        },
+        "ResponseMetadata": {
+            "RequestId": str(uuid.uuid4()),
+        },
+    }
+
+
+@cloudwatch_handler("ListMetrics")
+async def list_metrics(
+    args: _routing.HandlerArgs,
+    app: _routing.App,
+) -> Dict[str, Any]:
+    namespace_arg = args.get("Namespace")
+    keys = sorted(
+        (name, resource_id, metric_name)
+        for name, namespace in NAMESPACES.items()
+        if not namespace_arg or namespace_arg == name
+        for resource_id, metric_name in app[namespace.store].keys()
+    )
+
+    metric_name_arg = args.get("MetricName")
+    if metric_name_arg:
+        keys = [k for k in keys if k[2] == metric_name_arg]
+    for dim in _get_members(args.get("Dimensions")):
+        if not dim:
+            keys = []
+            continue
+        keys = [
+            k
+            for k in keys
+            if NAMESPACES[k[0]].dimension == dim.get("Name")
+            and (not dim.get("Value") or k[1] == dim["Value"])
+        ]
+
+    next_token = args.get("NextToken")
+    if next_token:
+        after = tuple(_paging.decode_next_token(next_token, 3))
+        keys = [k for k in keys if k > after]
+
+    result: Dict[str, Any] = {
+        "Metrics": [
+            {
+                "Namespace": name,
+                "MetricName": metric_name,
+                "Dimensions": [
+                    {
+                        "Name": NAMESPACES[name].dimension,
+                        "Value": resource_id,
+                    }
+                ],
+            }
+            for name, resource_id, metric_name in keys[
+                :LIST_METRICS_MAX_RESULTS
+            ]
+        ],
+    }
+    if len(keys) > LIST_METRICS_MAX_RESULTS:
+        result["NextToken"] = _paging.encode_next_token(
+            keys[LIST_METRICS_MAX_RESULTS - 1]
+        )
+
+    return {
+        "ListMetricsResult": result,
+        "ResponseMetadata": {
+            "RequestId": str(uuid.uuid4()),
+        },
+    }
+
+
+async def sample_volume_metrics(app: _routing.App) -> None:
+    """Record a sample of I/O metrics of all attached volumes.
+
+    The I/O of the volumes is also totalled per storage pool.
+    """
+    store: metrics.MetricStore = app["metrics"]
+    volume_ids = volumes.get_volume_ids(app)
+    volume_pools = volumes.get_volume_pools(app)
+    samples = await tasks.run_blocking(_collect_block_stats, app, volume_ids)
+    now = time.time()
+
+    pool_io = {
+        pool.name(): {"PoolReadBytes": 0, "PoolWriteBytes": 0}
+        for pool in volumes.get_libvirt_pools(app)
+    }
+    for volume_id, instance_id, counters in samples:
+        delta = store.delta(f"{volume_id}/{instance_id}", now, counters)
+        if delta is None:
+            continue
+        elapsed, increments = delta
+        for name, value in _compute_metrics(elapsed, increments).items():
+            store.put((volume_id, name), now, value)
+        io = pool_io.get(volume_pools.get(volume_id, ""))
+        if io is not None:
+            io["PoolReadBytes"] += increments["rd.bytes"]
+            io["PoolWriteBytes"] += increments["wr.bytes"]
+
+    store.retain(volume_ids.values())
+    for pool_name, io in pool_io.items():
+        for name, value in io.items():
+            app["pool_metrics"].put((pool_name, name), now, value)
+
+
+def _collect_block_stats(
+    app: _routing.App,
+    volume_ids: Mapping[str, str],
+) -> List[Tuple[str, str, Dict[str, int]]]:
+    # Block statistics of all domains in a single call, rather than
+    # a blockStats() round trip per attached disk.
+    lvirt_conn: libvirt.virConnect = app["libvirt"]
+    pools = volumes.get_libvirt_pools(app)
+
+    devices = {}
+    for volname, atts in objects.get_pools_attachments(pools).items():
+        volume_id = volume_ids.get(volname)
+        if volume_id is not None:
+            for att in atts:
+                devices[att.domain, att.device] = volume_id
+
+    samples = []
+    all_stats = lvirt_conn.getAllDomainStats(
+        int(libvirt.VIR_DOMAIN_STATS_BLOCK),
+        int(libvirt.VIR_CONNECT_GET_ALL_DOMAINS_STATS_ACTIVE),
+    )
+    for virdom, stats in all_stats:
+        domain = virdom.name()
+        for i in range(stats.get("block.count", 0)):
+            prefix = f"block.{i}."
+            volume_id = devices.get((domain, stats.get(f"{prefix}name")))
+            if volume_id is None:
+                continue
+            counters = {c: stats.get(f"{prefix}{c}", 0) for c in _COUNTERS}
+            samples.append((volume_id, domain, counters))
+
+    return samples
+
+
+def _compute_metrics(
+    elapsed: float,
+    increments: Mapping[str, int],
+) -> Dict[str, float]:
+    read_time = increments["rd.times"] / 1e9
+    write_time = increments["wr.times"] / 1e9
+    busy_time = read_time + write_time + increments["fl.times"] / 1e9
+    ops = increments["rd.reqs"] + increments["wr.reqs"]
+    return {
+        "VolumeReadOps": increments["rd.reqs"],
+        "VolumeWriteOps": increments["wr.reqs"],
+        "VolumeReadBytes": increments["rd.bytes"],
+        "VolumeWriteBytes": increments["wr.bytes"],
+        "VolumeTotalReadTime": read_time,
+        "VolumeTotalWriteTime": write_time,
+        # Concurrent requests make the busy time exceed the wall time,
+        # so this is a lower bound.
+        "VolumeIdleTime": max(elapsed - busy_time, 0.0) if ops else elapsed,
+        # Average number of requests in flight (Little's law).
+        "VolumeQueueLength": busy_time / elapsed,
+    }
+
+
+def _get_statistic(dp: metrics.Datapoint, stat: str) -> float:
+    if stat == "SampleCount":
+        return float(dp.sample_count)
+    elif stat == "Average":
+        return dp.average
+    elif stat == "Sum":
+        return dp.sum
+    elif stat == "Minimum":
+        return dp.minimum
+    else:
+        return dp.maximum
+
+
+def _get_members(value: Any) -> List[Any]:
+    if not value:
+        return []
+    if not isinstance(value, dict) or "member" not in value:
+        raise _routing.InvalidParameterError(f"invalid list value: {value!r}")
+    return [v for v in value["member"] if v is not None]
+
+
+def _get_metric_name(
+    namespace: Optional[str],
+    metric_name: Optional[str],
+) -> Tuple[_Namespace, str]:
+    if not namespace:
+        raise MissingParameterError("missing required Namespace")
+    if not metric_name:
+        raise MissingParameterError("missing required MetricName")
+    ns = NAMESPACES.get(namespace)
+    if ns is None:
+        raise _routing.InvalidParameterError(
+            f"unsupported Namespace: {namespace}"
+        )
+    if metric_name not in ns.metrics:
+        raise _routing.InvalidParameterError(
+            f"unsupported MetricName: {metric_name}"
+        )
+    return ns, metric_name
+
+
+def _get_resource_id(namespace: _Namespace, dimensions: Any) -> str:
+    dims = _get_members(dimensions)
+    if (
+        len(dims) != 1
+        or dims[0].get("Name") != namespace.dimension
+        or not dims[0].get("Value")
+    ):
+        raise InvalidParameterCombinationError(
+            f"exactly one {namespace.dimension} dimension is required"
+        )
+    return str(dims[0]["Value"])
+
+
+def _get_time_range(args: _routing.HandlerArgs) -> Tuple[float, float]:
+    start = _parse_time(args.get("StartTime"), "StartTime")
+    end = _parse_time(args.get("EndTime"), "EndTime")
+    if start >= end:
+        raise _routing.InvalidParameterError(
+            "StartTime must be before EndTime"
+        )
+    return start, end
+
+
+def _get_period(value: Any, start: float, end: float) -> int:
+    if not value:
+        raise MissingParameterError("missing required Period")
+    try:
+        period = int(value)
+    except ValueError:
+        raise _routing.InvalidParameterError(
+            "Period must be an integer"
+        ) from None
+    if period <= 0 or period % 60:
+        raise _routing.InvalidParameterError(
+            "Period must be a positive multiple of 60"
+        )
+    if (end - start) / period > MAX_DATAPOINTS:
+        raise InvalidParameterCombinationError(
+            f"You have requested up to {int((end - start) // period)} "
+            f"datapoints, which exceeds the limit of {MAX_DATAPOINTS}."
+        )
+    return period
+
+
+def _parse_time(value: Any, name: str) -> float:
+    if not value:
+        raise MissingParameterError(f"missing required {name}")
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    text = str(value)
+    if text.endswith("Z"):
+        text = text[:-1] + "+00:00"
+    try:
+        ts = datetime.datetime.fromisoformat(text)
+    except ValueError:
+        raise _routing.InvalidParameterError(
+            f"invalid {name} value: {value!r}"
+        ) from None
+    if ts.tzinfo is None:
+        ts = ts.replace(tzinfo=datetime.timezone.utc)
+    return ts.timestamp()
+
+
+def _format_time(timestamp: float) -> str:
+    ts = datetime.datetime.fromtimestamp(timestamp, datetime.timezone.utc)
+    return ts.strftime("%Y-%m-%dT%H:%M:%SZ")
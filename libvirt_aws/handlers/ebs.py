@@ -0,0 +1,313 @@
+from __future__ import annotations
+from typing import (
+    Any,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Set,
+    Tuple,
+)
+
+import base64
+import functools
+import hashlib
+import json
+import time
+
+from aiohttp import web
+import libvirt
+
+from .. import objects
+from .. import qemu_img
+from .. import tasks
+
+from . import _paging
+from . import _routing
+from . import snapshots
+from . import volumes
+
+
+# EBS direct API, read-only.  Snapshots are immutable images in a
+# qcow2 backing chain, so the chain itself records which blocks changed
+# between two snapshots of the same volume: those allocated in the
+# images above the older snapshot.  Block data is read straight out of
+# the image files at the offsets reported by qemu-img map.
+
+BLOCK_SIZE = 512 * 1024
+MAX_RESULTS = 10000
+MIN_RESULTS = 100
+# Block tokens never actually expire, as snapshot images are immutable.
+TOKEN_LIFETIME = 7 * 24 * 3600
+
+
+def format_ebs_error_json(err: _routing.ServiceError) -> str:
+    return json.dumps({"__type": err.code, "Message": err.msg})
+
+
+class ValidationError(_routing.ClientError):
+    code = "ValidationException"
+
+
+class ResourceNotFoundError(_routing.NotFoundError):
+    code = "ResourceNotFoundException"
+
+
+ebs_handler = functools.partial(
+    _routing.direct_handler,
+    methods="GET",
+    error_formatter=format_ebs_error_json,
+    error_content_type="application/json",
+)
+
+
+@ebs_handler("ListSnapshotBlocks", path="/snapshots/{snapshotId}/blocks")
+async def list_snapshot_blocks(
+    args: _routing.HandlerArgs,
+    app: _routing.App,
+) -> web.StreamResponse:
+    snapshot = _get_snapshot(app, args["snapshotId"])
+    max_results, start_index = _get_paging(args)
+
+    chain = _get_chain(app, snapshot)
+    extents = await _map_extents(chain, start=start_index * BLOCK_SIZE)
+    indexes = _take(
+        _block_indexes(e for e in extents if e.present), max_results + 1
+    )
+
+    result = _list_result(snapshot, indexes, max_results)
+    result["Blocks"] = [
+        {
+            "BlockIndex": i,
+            "BlockToken": _block_token(snapshot.id, i),
+        }
+        for i in indexes[:max_results]
+    ]
+    return web.json_response(result)
+
+
+@ebs_handler(
+    "ListChangedBlocks",
+    path="/snapshots/{secondSnapshotId}/changedblocks",
+)
+async def list_changed_blocks(
+    args: _routing.HandlerArgs,
+    app: _routing.App,
+) -> web.StreamResponse:
+    second = _get_snapshot(app, args["secondSnapshotId"])
+    first_id = args.get("firstSnapshotId")
+    first = _get_snapshot(app, first_id) if first_id else None
+    max_results, start_index = _get_paging(args)
+
+    chain = _get_chain(app, second)
+    extents = await _map_extents(chain, start=start_index * BLOCK_SIZE)
+
+    first_blocks: Set[int] = set()
+    if first is None:
+        changed = [e for e in extents if e.present]
+    else:
+        first_chain = _get_chain(app, first)
+        paths = [v.target_path for v in chain]
+        try:
+            depth = paths.index(first_chain[0].target_path)
+        except ValueError:
+            # Not an ancestor, e.g. the volume was flattened in between.
+            # All blocks of the second snapshot might have changed.
+            changed = [e for e in extents if e.present]
+        else:
+            changed = [e for e in extents if e.present and e.depth < depth]
+
+    indexes = _take(_block_indexes(changed), max_results + 1)
+
+    if first is not None and indexes:
+        first_extents = await _map_extents(
+            first_chain,
+            start=indexes[0] * BLOCK_SIZE,
+            length=(indexes[-1] - indexes[0] + 1) * BLOCK_SIZE,
+        )
+        first_blocks = set(
+            _block_indexes(e for e in first_extents if e.present)
+        )
+
+    result = _list_result(second, indexes, max_results)
+    blocks = []
+    for i in indexes[:max_results]:
+        block: Dict[str, Any] = {"BlockIndex": i}
+        if first is not None and i in first_blocks:
+            block["FirstBlockToken"] = _block_token(first.id, i)
+        block["SecondBlockToken"] = _block_token(second.id, i)
+        blocks.append(block)
+    result["ChangedBlocks"] = blocks
+    return web.json_response(result)
+
+
+@ebs_handler(
+    "GetSnapshotBlock",
+    path="/snapshots/{snapshotId}/blocks/{blockIndex}",
+)
+async def get_snapshot_block(
+    args: _routing.HandlerArgs,
+    app: _routing.App,
+) -> web.StreamResponse:
+    snapshot = _get_snapshot(app, args["snapshotId"])
+    try:
+        index = int(args["blockIndex"])
+    except ValueError:
+        raise ValidationError("invalid blockIndex") from None
+    if args.get("blockToken") != _block_token(snapshot.id, index):
+        raise ValidationError("invalid blockToken")
+
+    size = snapshot.volume_size * 2**30
+    start = index * BLOCK_SIZE
+    if not 0 <= start < size:
+        raise ValidationError("blockIndex is out of range")
+    length = min(BLOCK_SIZE, size - start)
+
+    chain = _get_chain(app, snapshot)
+    extents = await _map_extents(chain, start=start, length=length)
+    data = await tasks.run_blocking(
+        _read_block, [v.target_path for v in chain], extents, start, length
+    )
+
+    return web.Response(
+        body=data,
+        content_type="application/octet-stream",
+        headers={
+            "x-amz-Data-Length": str(len(data)),
+            "x-amz-Checksum": base64.b64encode(
+                hashlib.sha256(data).digest()
+            ).decode(),
+            "x-amz-Checksum-Algorithm": "SHA256",
+        },
+    )
+
+
+def _get_snapshot(
+    app: _routing.App,
+    snapshot_id: str,
+) -> snapshots.SnapshotRecord:
+    try:
+        snapshot = snapshots.get_snapshot_record(app, snapshot_id)
+    except snapshots.InvalidSnapshotNotFound as e:
+        raise ResourceNotFoundError(e.msg) from None
+    if snapshot.status != "completed":
+        raise ValidationError(f"The snapshot '{snapshot_id}' is not ready.")
+    return snapshot
+
+
+def _get_chain(
+    app: _routing.App,
+    snapshot: snapshots.SnapshotRecord,
+) -> List[objects.Volume]:
+    pool = volumes.get_storage_pool(app, snapshot.pool).pool
+    try:
+        return [
+            objects.volume_from_xml(
+                pool.storageVolLookupByName(name).XMLDesc(0)
+            )
+            for name in objects.get_backing_chain(pool, snapshot.image)
+        ]
+    except libvirt.libvirtError as e:
+        raise _routing.InternalServerError(str(e)) from e
+
+
+async def _map_extents(
+    chain: List[objects.Volume],
+    *,
+    start: int = 0,
+    length: Optional[int] = None,
+) -> List[qemu_img.Extent]:
+    return await qemu_img.map_extents(
+        chain[0].target_path, start=start, length=length, fmt=chain[0].format
+    )
+
+
+def _get_paging(args: _routing.HandlerArgs) -> Tuple[int, int]:
+    max_results = MAX_RESULTS
+    if args.get("maxResults"):
+        max_results = _paging.get_max_results(
+            {"MaxResults": args["maxResults"]}, MAX_RESULTS, MIN_RESULTS
+        )
+
+    start_index = 0
+    if args.get("startingBlockIndex"):
+        try:
+            start_index = int(args["startingBlockIndex"])
+        except ValueError:
+            raise ValidationError("invalid startingBlockIndex") from None
+
+    page_token = args.get("pageToken")
+    if page_token:
+        try:
+            (index,) = _paging.decode_next_token(page_token, 1)
+            start_index = max(start_index, int(index))
+        except (_paging.InvalidNextTokenError, ValueError):
+            raise ValidationError("invalid pageToken") from None
+
+    return max_results, start_index
+
+
+def _list_result(
+    snapshot: snapshots.SnapshotRecord,
+    indexes: List[int],
+    max_results: int,
+) -> Dict[str, Any]:
+    result: Dict[str, Any] = {
+        "BlockSize": BLOCK_SIZE,
+        "VolumeSize": snapshot.volume_size,
+        "ExpiryTime": time.time() + TOKEN_LIFETIME,
+    }
+    if len(indexes) > max_results:
+        result["NextToken"] = _paging.encode_next_token(
+            [str(indexes[max_results])]
+        )
+    return result
+
+
+def _block_indexes(extents: Iterable[qemu_img.Extent]) -> Iterator[int]:
+    # Indexes of blocks touched by *extents*, in order and without
+    # duplicates.  Extents must be sorted.
+    last = -1
+    for extent in extents:
+        first = max(extent.start // BLOCK_SIZE, last + 1)
+        end = (extent.start + extent.length - 1) // BLOCK_SIZE
+        for i in range(first, end + 1):
+            yield i
+        last = max(last, end)
+
+
+def _take(it: Iterator[int], count: int) -> List[int]:
+    result = []
+    for i in it:
+        result.append(i)
+        if len(result) == count:
+            break
+    return result
+
+
+def _block_token(snapshot_id: str, index: int) -> str:
+    return base64.urlsafe_b64encode(f"{snapshot_id}:{index}".encode()).decode()
+
+
+def _read_block(
+    chain: List[str],
+    extents: List[qemu_img.Extent],
+    start: int,
+    length: int,
+) -> bytes:
+    data = bytearray(length)
+    for extent in extents:
+        if not extent.data:
+            # Unallocated or zero, already zeroed.
+            continue
+        if extent.offset is None or extent.depth >= len(chain):
+            raise _routing.InternalServerError(
+                f"cannot read data at {extent.start} directly"
+            )
+        lo = max(extent.start, start)
+        hi = min(extent.start + extent.length, start + length)
+        with open(chain[extent.depth], "rb") as f:
+            f.seek(extent.offset + (lo - extent.start))
+            data[lo - start : hi - start] = f.read(hi - lo)
+    return bytes(data)
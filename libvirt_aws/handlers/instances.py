@@ -6,39 +6,121 @@ import libvirt
 
 from .. import objects
 
+from . import _filters
 from . import _routing
+from . import attachments
 from . import ips
 from . import volumes
 
 
+_INSTANCE_STATES = {
+    libvirt.VIR_DOMAIN_NOSTATE: "pending",
+    libvirt.VIR_DOMAIN_RUNNING: "running",
+    libvirt.VIR_DOMAIN_BLOCKED: "running",
+    libvirt.VIR_DOMAIN_PAUSED: "stopped",
+    libvirt.VIR_DOMAIN_SHUTDOWN: "stopping",
+    libvirt.VIR_DOMAIN_SHUTOFF: "stopped",
+    libvirt.VIR_DOMAIN_CRASHED: "stopped",
+    libvirt.VIR_DOMAIN_PMSUSPENDED: "stopped",
+}
+
+_INSTANCE_STATE_CODES = {
+    "pending": 0,
+    "running": 16,
+    "shutting-down": 32,
+    "terminated": 48,
+    "stopping": 64,
+    "stopped": 80,
+}
+
+INSTANCE_FILTERS = {
+    "instance-id": _filters.Field(getter=lambda i: [i["instanceId"]]),
+    "instance-state-name": _filters.Field(
+        getter=lambda i: [i["instanceState"]["name"]],
+    ),
+    "instance-state-code": _filters.Field(
+        getter=lambda i: [i["instanceState"]["code"]],
+    ),
+}
+
+
 @_routing.handler("DescribeInstances")
 async def describe_instances(
     args: _routing.HandlerArgs,
     app: _routing.App,
 ) -> dict[str, Any]:
-    pool: libvirt.virStoragePool = app["libvirt_pool"]
     net: libvirt.virNetwork = app["libvirt_net"]
     lvirt_conn: libvirt.virConnect = app["libvirt"]
 
-    instance_ids = set(args.get("InstanceId", ()))
-    result = []
+    compiled = _filters.compile_filters(
+        args.get("Filter"),
+        INSTANCE_FILTERS,
+        resource_type="instance",
+        id_column="resource_name",
+    )
 
-    for domain in objects.get_all_domains(lvirt_conn):
-        domname = domain.name
-        if not instance_ids or domname in instance_ids:
-            block_devices = await _describe_block_devices(pool, domain)
-            network_ifaces = await ips.describe_network_ifaces(
-                lvirt_conn, net, domain
-            )
+    instance_ids = [i for i in args.get("InstanceId") or () if i]
+    if instance_ids:
+        virdoms = []
+        for instance_id in instance_ids:
+            try:
+                virdoms.append(lvirt_conn.lookupByName(instance_id))
+            except libvirt.libvirtError:
+                continue
+    else:
+        virdoms = lvirt_conn.listAllDomains()
 
-            result.append(
-                {
-                    "instanceId": domname,
-                    "instanceType": "t2.micro",
-                    "blockDeviceMapping": block_devices,
-                    "networkInterfaceSet": network_ifaces,
-                }
+    if compiled.has_sql:
+        with app["db"]:
+            cur = app["db"].execute(
+                f"""
+                    SELECT DISTINCT resource_name
+                    FROM tags
+                    WHERE resource_type = 'instance' AND {compiled.where}
+                """,
+                compiled.params,
             )
+            tagged = {row[0] for row in cur.fetchall()}
+        virdoms = [d for d in virdoms if d.name() in tagged]
+
+    result = []
+    pool_locations = [
+        (pool.name(), objects.get_pool_path(pool))
+        for pool in volumes.get_libvirt_pools(app)
+    ]
+    volume_ids = volumes.get_volume_ids(app)
+
+    for virdom in virdoms:
+        state = _INSTANCE_STATES.get(virdom.state()[0], "pending")
+        instance = {
+            "instanceId": virdom.name(),
+            "instanceState": {
+                "code": _INSTANCE_STATE_CODES[state],
+                "name": state,
+            },
+        }
+        if not compiled.match(instance):
+            continue
+
+        domain = objects.domain_from_xml(virdom.XMLDesc(0))
+        block_devices = await _describe_block_devices(
+            pool_locations,
+            volume_ids,
+            domain,
+            attachments.get_states(app["db"], virdom.name()),
+        )
+        network_ifaces = await ips.describe_network_ifaces(
+            lvirt_conn, net, domain
+        )
+
+        instance.update(
+            {
+                "instanceType": "t2.micro",
+                "blockDeviceMapping": block_devices,
+                "networkInterfaceSet": network_ifaces,
+            }
+        )
+        result.append(instance)
 
     return {
         "reservationSet": [
@@ -52,30 +134,36 @@ async def describe_instances(
 
 
 async def _describe_block_devices(
-    lvirt_pool: libvirt.virStoragePool,
-    domain: libvirt.virDomain,
+    pool_locations: list[tuple[str, str]],
+    volume_ids: dict[str, str],
+    domain: objects.Domain,
+    states: dict[tuple[str, str], tuple[str, str]],
 ) -> list[dict[str, Any]]:
     block_devices = []
     existing = set()
     for disk in domain.disks:
-        if disk.pool != lvirt_pool.name():
+        if not any(
+            disk.in_pool(name, path) for name, path in pool_locations
+        ):
             continue
 
         att = disk.attachment
+        volume_id = volume_ids.get(att.volume, att.volume)
         block_devices.append(
             {
                 "deviceName": f"/dev/{att.device}",
                 "ebs": {
-                    "volumeId": att.volume,
-                    "status": volumes.get_attachment_status(att),
+                    "volumeId": volume_id,
+                    "status": states.get(
+                        (volume_id, att.domain), (att.device, "attached")
+                    )[1],
                 },
             }
         )
-        existing.add((att.volume, att.domain))
+        existing.add((volume_id, att.domain))
 
-    recent_atts = volumes.get_known_attachments()
-    for (vol, dom), (device, status) in recent_atts.items():
-        if (vol, dom) not in existing and status != "detached":
+    for (vol, dom), (device, status) in states.items():
+        if (vol, dom) not in existing:
             block_devices.append(
                 {
                     "deviceName": f"/dev/{device}",
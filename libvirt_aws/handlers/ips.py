@@ -1,30 +1,47 @@
 from __future__ import annotations
 from typing import (
     Any,
+    Callable,
     Dict,
-    FrozenSet,
     List,
 )
 
 import collections
-import itertools
 import ipaddress
 import json
 import os.path
 import pathlib
 import sqlite3
 import textwrap
+import time
 import uuid
 
 import libvirt
 
+from . import _filters
 from . import _routing
 from . import errors
+from . import tags as _tags
+from .. import ipalloc
 from .. import objects
 from .. import qemu
 
 
 PUBLIC_IP_BLOCK_SIZE = 16
+PUBLIC_IP_POOL = "public"
+PRIVATE_IP_POOL = "private"
+# Seconds after which an uncommitted private IP reservation is released.
+PRIVATE_IP_RESERVATION_TTL = 60
+
+
+ADDRESS_FILTERS = {
+    "public-ip": _filters.Field(column="ip_address"),
+    "instance-id": _filters.Field(column="instance_id"),
+    "allocation-id": _filters.Field(column="allocation_id"),
+    "association-id": _filters.Field(column="association_id"),
+    "private-ip-address": _filters.Field(column="private_ip_address"),
+    "domain": _filters.Field(getter=lambda addr: [addr["domain"]]),
+}
 
 
 class AddressLimitExceededError(_routing.ClientError):
@@ -52,81 +69,26 @@ async def describe_addresses(
     args: _routing.HandlerArgs,
     app: _routing.App,
 ) -> Dict[str, Any]:
-    filters = args.get("Filter")
-    requested_ips = args.get("PublicIp")
-    tags = []
-    ips = []
-    instances = []
-    alloc_ids = args.get("AllocationId", [])
-    assoc_ids = []
-    if filters:
-        assert isinstance(filters, list)
-        for flt in filters:
-            if flt["Name"].startswith("tag:"):
-                tagname = flt["Name"][len("tag:") :]
-                tagvalue = flt["Value"]
-                tags.append((tagname, tagvalue))
-            elif flt["Name"] == "public-ip":
-                ips.append(flt["Value"])
-            elif flt["Name"] == "instance-id":
-                instances.append(flt["Value"])
-            elif flt["Name"] == "allocation-id":
-                alloc_ids.append(flt["Value"])
-            elif flt["Name"] == "association-id":
-                assoc_ids.append(flt["Value"])
-            else:
-                raise _routing.InvalidParameterError(
-                    f"unsupported filter type: {flt['Name']}"
-                )
-
-    requested_ip_set: FrozenSet[str]
+    compiled = _filters.compile_filters(
+        args.get("Filter"),
+        ADDRESS_FILTERS,
+        resource_type="ip_address",
+        id_column="ip_address",
+    )
+    quals = [compiled.where]
+    qargs = list(compiled.params)
 
+    requested_ips = [ip for ip in args.get("PublicIp") or () if ip]
     if requested_ips:
-        requested_ip_set = frozenset(requested_ips) - frozenset(ips)
-    elif ips:
-        requested_ip_set = frozenset(ips)
+        quals.append(_filters.in_list("ip_address", requested_ips))
+        qargs.extend(requested_ips)
 
-    quals = []
-    qargs: List[Any] = []
-    if requested_ips:
-        quals.append(
-            f"ip_address IN ({','.join(('?',) * len(requested_ip_set))})"
-        )
-        qargs.extend(requested_ip_set)
-    if instances:
-        quals.append(f"instance_id IN ({','.join(('?',) * len(instances))})")
-        qargs.extend(instances)
+    alloc_ids = [a for a in args.get("AllocationId") or () if a]
     if alloc_ids:
-        quals.append(f"allocation_id IN ({','.join(('?',) * len(alloc_ids))})")
+        quals.append(_filters.in_list("allocation_id", alloc_ids))
         qargs.extend(alloc_ids)
-    if assoc_ids:
-        quals.append(
-            f"association_id IN ({','.join(('?',) * len(assoc_ids))})"
-        )
-        qargs.extend(assoc_ids)
 
-    if tags:
-        tag_filters = " OR ".join(
-            f"(tagname = ? AND tagvalue IN ({','.join(('?',) * len(tvals))}))"
-            for (_tn, tvals) in tags
-        )
-
-        quals.append(
-            f"""ip_address IN (
-                    SELECT resource_name FROM tags
-                    WHERE
-                      resource_type = 'ip_address'
-                      AND ({tag_filters})
-                )
-            """
-        )
-        qargs.extend(
-            itertools.chain.from_iterable(
-                [tagname] + tagvalues for (tagname, tagvalues) in tags
-            )
-        )
-
-    query = """
+    query = f"""
         SELECT
             ip_address,
             instance_id,
@@ -134,9 +96,9 @@ async def describe_addresses(
             association_id
         FROM
             ip_addresses
+        WHERE
+            {" AND ".join(quals)}
     """
-    if quals:
-        query += f" WHERE {' AND '.join(quals)}"
 
     with app["db"]:
         cur = app["db"].execute(query, qargs)
@@ -160,21 +122,22 @@ async def describe_addresses(
         for tag in cur.fetchall():
             addr_tags[tag[0]][tag[1]] = tag[2]
 
+    result = [
+        {
+            "publicIp": addr[0],
+            "instanceId": addr[1],
+            "allocationId": addr[2],
+            "associationId": addr[3],
+            "domain": "vpc",
+            "tagSet": [
+                {"key": k, "value": v} for k, v in addr_tags[addr[0]].items()
+            ],
+        }
+        for addr in addresses
+    ]
+
     return {
-        "addressesSet": [
-            {
-                "publicIp": addr[0],
-                "instanceId": addr[1],
-                "allocationId": addr[2],
-                "associationId": addr[3],
-                "domain": "vpc",
-                "tagSet": [
-                    {"key": k, "value": v}
-                    for k, v in addr_tags[addr[0]].items()
-                ],
-            }
-            for addr in addresses
-        ],
+        "addressesSet": [addr for addr in result if compiled.match(addr)],
     }
 
 
@@ -206,62 +169,32 @@ async def allocate_address(
             "standard domain is not supported"
         )
 
-    cur = app["db"].cursor()
-    cur.execute(
-        f"""
-        SELECT ip_address FROM ip_addresses
-    """
-    )
-    existing = {ipaddress.IPv4Address(row[0]) for row in cur.fetchall()}
-    cur.close()
+    db_conn: sqlite3.Connection = app["db"]
+    _ensure_ip_pools(app)
 
-    net = objects.network_from_xml(app["libvirt_net"].XMLDesc())
-    ip_range_start = int(net.static_ip_range[0])
-    ip_range_end = max(
-        ip_range_start + PUBLIC_IP_BLOCK_SIZE,
-        int(net.static_ip_range[1]),
-    )
-    for int_addr in range(ip_range_start, ip_range_end):
-        address = ipaddress.IPv4Address(int_addr)
-        if address not in existing:
-            break
-    else:
-        raise AddressLimitExceededError(
-            "libvirt network is out of static addresses"
-        )
+    tags = _tags.get_tag_specification(args)
 
-    tags = {}
-    tag_spec = args.get("TagSpecification")
-    if tag_spec:
-        for spec_entry in tag_spec:
-            tag_entries = spec_entry["Tag"]
-            for tag in tag_entries:
-                tags[tag["Key"]] = tag["Value"]
+    allocation_id = f"eipalloc-{uuid.uuid4()}"
 
-    cur = app["db"].cursor()
+    with db_conn:
+        try:
+            (address,) = ipalloc.allocate(db_conn, PUBLIC_IP_POOL)
+        except ipalloc.AddressPoolExhaustedError:
+            raise AddressLimitExceededError(
+                "libvirt network is out of static addresses"
+            ) from None
 
-    if tags:
-        cur.executemany(
+        _tags.put_tags(db_conn, [(str(address), "ip_address")], tags)
+
+        db_conn.execute(
             """
-                INSERT INTO tags
-                    (resource_name, resource_type, tagname, tagvalue)
-                VALUES (?, ?, ?, ?)
+                INSERT INTO ip_addresses
+                    (allocation_id, ip_address)
+                VALUES (?, ?)
             """,
-            [[str(address), "ip_address", n, v] for n, v in tags.items()],
+            [allocation_id, str(address)],
         )
 
-    allocation_id = f"eipalloc-{uuid.uuid4()}"
-    cur.execute(
-        """
-            INSERT INTO ip_addresses
-                (allocation_id, ip_address)
-            VALUES (?, ?)
-        """,
-        [allocation_id, str(address)],
-    )
-
-    app["db"].commit()
-
     return {
         "publicIp": str(address),
         "domain": "vpc",
@@ -535,7 +468,7 @@ async def release_address(
     with db_conn:
         cur = db_conn.execute(
             """
-                SELECT instance_id
+                SELECT instance_id, ip_address
                 FROM ip_addresses
                 WHERE allocation_id = ?
             """,
@@ -548,7 +481,7 @@ async def release_address(
                 "could not find address for specified AllocationId"
             )
 
-        cur_instance_id = row[0]
+        cur_instance_id, ip_address = row
         if cur_instance_id is not None:
             raise InvalidAddress_InUse(
                 f"specified address is in use by instance {cur_instance_id}, "
@@ -583,6 +516,8 @@ async def release_address(
             [alloc_id],
         )
 
+        ipalloc.release(db_conn, PUBLIC_IP_POOL, [ip_address])
+
     return {
         "return": "true",
     }
@@ -637,77 +572,93 @@ async def assign_private_ip_addresses(
             f"invalid InstanceId: {e}"
         ) from e
 
-    net = objects.network_from_xml(app["libvirt_net"].XMLDesc())
-
     db_conn: sqlite3.Connection = app["db"]
+    _ensure_ip_pools(app)
 
-    new_addrs = []
-
+    # Phase 1: reserve the addresses.  The reservation is committed
+    # right away so that the database is not held while the guest agent
+    # is busy.  Reservations left behind by a crash are released by
+    # sweep_private_ip_reservations().
     with db_conn:
-        cur = db_conn.execute(
+        try:
+            new_addrs = ipalloc.allocate(db_conn, PRIVATE_IP_POOL, addr_count)
+        except ipalloc.AddressPoolExhaustedError:
+            raise AddressLimitExceededError(
+                "libvirt network is out of static addresses"
+            ) from None
+
+        db_conn.executemany(
             """
-                SELECT ip_address
-                FROM private_ip_addresses
-                WHERE instance_id IS NOT NULL
+                INSERT INTO private_ip_addresses(
+                    ip_address,
+                    instance_id,
+                    interface,
+                    state,
+                    reserved_at
+                )
+                VALUES
+                    (?, ?, ?, 'pending', ?)
             """,
+            [
+                (str(addr), instance_id, ifname, time.time())
+                for addr in new_addrs
+            ],
         )
-        taken_addrs = {ipaddress.ip_address(row[0]) for row in cur.fetchall()}
-
-        ip_range_start = int(net.static_ip_range[0]) + PUBLIC_IP_BLOCK_SIZE
-        ip_range_end = int(net.static_ip_range[1])
 
-        for int_addr in range(ip_range_start, ip_range_end):
-            address = ipaddress.IPv4Address(int_addr)
-            if address in taken_addrs:
-                continue
+    assigned_addrs = [str(addr) for addr in new_addrs]
 
-            new_addrs.append(address)
+    # Phase 2: apply all addresses in the guest with a single exec.
+    try:
+        result = await _ip_batch(
+            vir_domain,
+            [f"addr add {addr} dev {ifname}" for addr in assigned_addrs],
+        )
+    except Exception as e:
+        _release_private_ip_addresses(db_conn, assigned_addrs)
+        raise _routing.InternalServerError(
+            f"could not assign address in VM: {e}"
+        ) from e
 
-            db_conn.execute(
-                """
-                    INSERT INTO private_ip_addresses(
-                        ip_address,
-                        instance_id,
-                        interface
-                    )
-                    VALUES
-                        (?, ?, ?)
-                """,
-                [str(address), instance_id, ifname],
+    if result.returncode != 0:
+        error = _routing.InternalServerError(
+            f"could not assign address in VM: {result.returncode}\n"
+            f"{result.stderr.read().decode('utf-8', errors='replace')}"
+        )
+        # `ip -batch` stops at the first failing command, undo whatever
+        # was applied before it.
+        try:
+            await _ip_batch(
+                vir_domain,
+                [f"addr del {addr} dev {ifname}" for addr in assigned_addrs],
+                force=True,
             )
-            if len(new_addrs) == addr_count:
-                break
-
-        if len(new_addrs) < addr_count:
-            raise AddressLimitExceededError(
-                "libvirt network is out of static addresses"
+        except Exception:
+            app["logger"].exception(
+                f"could not undo address assignment on {interface_id}"
             )
+        _release_private_ip_addresses(db_conn, assigned_addrs)
+        raise error
 
-        assigned_addrs = []
-
-        for new_addr in new_addrs:
-            result = await qemu.agent_exec(
-                vir_domain,
-                ["ip", "addr", "add", str(new_addr), "dev", ifname],
+    # Phase 3: commit the reservation.
+    placeholders = ", ".join(["?"] * len(assigned_addrs))
+    with db_conn:
+        cur = db_conn.execute(
+            f"""
+                UPDATE private_ip_addresses
+                SET state = 'assigned', reserved_at = NULL
+                WHERE
+                    state = 'pending'
+                    AND ip_address IN ({placeholders})
+            """,
+            assigned_addrs,
+        )
+        if cur.rowcount != len(assigned_addrs):
+            # Should not happen unless the guest agent took longer than
+            # the reservation TTL and the sweeper got to it first.
+            raise _routing.InternalServerError(
+                "address reservation expired before it could be committed"
             )
 
-            if result.returncode != 0:
-                placeholders = ", ".join(["?"] * len(assigned_addrs))
-                db_conn.execute(
-                    f"""
-                        DELETE FROM private_ip_addresses
-                        WHERE ip_address IN ({placeholders})
-                    """,
-                    assigned_addrs,
-                )
-
-                raise _routing.InternalServerError(
-                    f"could not assign address in VM: {result.returncode}\n"
-                    f"{result.stderr.read().decode('utf-8', errors='replace')}"
-                )
-            else:
-                assigned_addrs.append(str(new_addr))
-
     return {
         "networkInterfaceId": interface_id,
         "return": True,
@@ -766,6 +717,7 @@ async def unassign_private_ip_addresses(
                     instance_id = ?
                     AND interface = ?
                     AND ip_address IN ({placeholders})
+                    AND state = 'assigned'
             """,
             [instance_id, ifname] + addrs,
         )
@@ -776,31 +728,77 @@ async def unassign_private_ip_addresses(
                 f"interface {interface_id}"
             )
 
-        for addr in addrs:
-            result = await qemu.agent_exec(
-                vir_domain,
-                ["ip", "addr", "del", addr, "dev", ifname],
-            )
+    result = await _ip_batch(
+        vir_domain,
+        [f"addr del {addr} dev {ifname}" for addr in addrs],
+    )
 
-            if result.returncode != 0:
-                raise _routing.InternalServerError(
-                    f"could not unassign address in VM: {result.returncode}\n"
-                    f"{result.stderr.read().decode('utf-8', errors='replace')}"
-                )
-            else:
-                db_conn.execute(
-                    f"""
-                        DELETE FROM private_ip_addresses
-                        WHERE ip_address = ?
-                    """,
-                    [addr],
-                )
+    if result.returncode != 0:
+        raise _routing.InternalServerError(
+            f"could not unassign address in VM: {result.returncode}\n"
+            f"{result.stderr.read().decode('utf-8', errors='replace')}"
+        )
+
+    _release_private_ip_addresses(db_conn, addrs)
 
     return {
         "return": True,
     }
 
 
+async def sweep_private_ip_reservations(app: _routing.App) -> None:
+    """Release private IP reservations that were never committed."""
+    db_conn: sqlite3.Connection = app["db"]
+    deadline = time.time() - PRIVATE_IP_RESERVATION_TTL
+
+    with db_conn:
+        cur = db_conn.execute(
+            """
+                SELECT ip_address
+                FROM private_ip_addresses
+                WHERE state = 'pending' AND reserved_at < ?
+            """,
+            [deadline],
+        )
+        stale = [row[0] for row in cur.fetchall()]
+
+    if stale:
+        app["logger"].warning(
+            f"releasing stale private IP reservations: {', '.join(stale)}"
+        )
+        _release_private_ip_addresses(db_conn, stale)
+
+
+def _release_private_ip_addresses(
+    db_conn: sqlite3.Connection,
+    addrs: List[str],
+) -> None:
+    placeholders = ", ".join(["?"] * len(addrs))
+    with db_conn:
+        db_conn.execute(
+            f"""
+                DELETE FROM private_ip_addresses
+                WHERE ip_address IN ({placeholders})
+            """,
+            addrs,
+        )
+        ipalloc.release(db_conn, PRIVATE_IP_POOL, addrs)
+
+
+async def _ip_batch(
+    virdom: libvirt.virDomain,
+    commands: List[str],
+    *,
+    force: bool = False,
+) -> qemu.RemoteProcess:
+    args = ["ip"]
+    if force:
+        args.append("-force")
+    args.extend(["-batch", "-"])
+    script = "".join(f"{cmd}\n" for cmd in commands)
+    return await qemu.agent_exec(virdom, args, input=script.encode())
+
+
 async def describe_network_ifaces(
     lvirt_conn: libvirt.virConnect,
     lvirt_net: libvirt.virNetwork,
@@ -894,6 +892,41 @@ async def describe_network_ifaces(
     return ifaces
 
 
+def _ensure_ip_pools(app: _routing.App) -> None:
+    """Sync the allocator pools with the static range of the network.
+
+    The first PUBLIC_IP_BLOCK_SIZE addresses of the static range are
+    handed out as elastic IPs, the remainder up to the start of the
+    DHCP range as secondary private IPs.
+    """
+    db_conn: sqlite3.Connection = app["db"]
+    net = objects.network_from_xml(app["libvirt_net"].XMLDesc())
+    range_start, range_end = net.static_ip_range
+    public_end = range_start + PUBLIC_IP_BLOCK_SIZE
+
+    def _get_used(table: str) -> Callable[[], List[str]]:
+        def _inner() -> List[str]:
+            cur = db_conn.execute(f"SELECT ip_address FROM {table}")
+            return [row[0] for row in cur.fetchall()]
+
+        return _inner
+
+    ipalloc.ensure_pool(
+        db_conn,
+        PUBLIC_IP_POOL,
+        range_start,
+        public_end,
+        _get_used("ip_addresses"),
+    )
+    ipalloc.ensure_pool(
+        db_conn,
+        PRIVATE_IP_POOL,
+        public_end,
+        range_end,
+        _get_used("private_ip_addresses"),
+    )
+
+
 async def _find_interface(
     domain: libvirt.virDomain,
     network: ipaddress.IPv4Network,
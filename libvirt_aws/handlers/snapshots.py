@@ -0,0 +1,527 @@
+from __future__ import annotations
+from typing import (
+    Any,
+    Dict,
+    List,
+    NamedTuple,
+    Optional,
+    Set,
+)
+
+import datetime
+import sqlite3
+import uuid
+
+import libvirt
+
+from .. import objects
+from .. import placement
+from .. import profiles
+from .. import tasks
+
+from . import _filters
+from . import _paging
+from . import _routing
+from . import tags as _tags
+from . import volumes
+
+
+DESCRIBE_SNAPSHOTS_MAX_RESULTS = 1000
+
+
+class InvalidSnapshotNotFound(_routing.ClientError):
+    code = "InvalidSnapshot.NotFound"
+
+
+# Snapshots of block volumes are copies of the volume, made in the
+# background from an LVM snapshot of it taken when the snapshot is
+# created.  They are "pending" until the copy is done.  Volumes being
+# copied from are kept here: LVM does not resize them meanwhile, and
+# deleting them would take the LVM snapshot along.
+_copying: Set[str] = set()
+
+
+class SnapshotRecord(NamedTuple):
+    id: str
+    volume_id: str
+    volume_size: int
+    # Name of the libvirt volume holding the frozen image.
+    image: str
+    description: str
+    start_time: str
+    status: str
+    # Name of the storage pool holding the image, that of the volume.
+    pool: Optional[str]
+
+
+SNAPSHOT_FILTERS = {
+    "snapshot-id": _filters.Field(column="id"),
+    "volume-id": _filters.Field(column="volume_id"),
+    "volume-size": _filters.Field(column="volume_size", type=int),
+    "description": _filters.Field(column="description"),
+    "start-time": _filters.Field(column="start_time"),
+    "status": _filters.Field(column="status"),
+}
+
+
+@_routing.handler("CreateSnapshot")
+async def create_snapshot(
+    args: _routing.HandlerArgs,
+    app: _routing.App,
+) -> Dict[str, Any]:
+    volume_id = args.get("VolumeId")
+    if not volume_id:
+        raise _routing.InvalidParameterError("missing required VolumeId")
+    if not isinstance(volume_id, str):
+        raise _routing.InvalidParameterError("invalid VolumeId value")
+
+    record = volumes.get_volume_record(app, volume_id)
+    if record.status != "available":
+        raise _routing.IncorrectStateError(
+            f"Volume {volume_id} is {record.status} and cannot be "
+            f"snapshotted."
+        )
+    volumes.check_not_busy(volume_id)
+    # Snapshot images stay where they are, in the pool of the volume.
+    storage_pool = volumes.get_storage_pool(app, record.pool)
+    pool = storage_pool.pool
+
+    description = args.get("Description") or ""
+    tags = _tags.get_tag_specification(args)
+    snapshot_id = f"snap-{uuid.uuid4().hex[:17]}"
+    start_time = datetime.datetime.now(datetime.timezone.utc)
+    start_time_str = start_time.strftime("%Y-%m-%dT%H:%M:%S.%f000Z")
+
+    if storage_pool.is_block:
+        check_not_copying(volume_id)
+        image_name = f"{uuid.uuid4()}.raw"
+        await _freeze_block_volume(app, storage_pool, record, image_name)
+        snapshot = SnapshotRecord(
+            id=snapshot_id,
+            volume_id=volume_id,
+            volume_size=record.size,
+            image=image_name,
+            description=description,
+            start_time=start_time_str,
+            status="pending",
+            pool=storage_pool.name,
+        )
+        with app["db"]:
+            _insert_snapshot(app["db"], snapshot)
+            _tags.put_tags(app["db"], [(snapshot_id, "snapshot")], tags)
+        _submit_copy(app, snapshot)
+        return _describe_snapshot(snapshot, tags)
+
+    # The current image of the volume becomes the snapshot and is
+    # never written to again, the volume continues in a new thin
+    # overlay on top of it.  No data is copied.
+    overlay_name = f"{uuid.uuid4()}.qcow2"
+    try:
+        image = objects.volume_from_xml(
+            pool.storageVolLookupByName(record.volume_name).XMLDesc(0)
+        )
+        profile = app["volume_profiles"].get(
+            record.volume_type, profiles.VolumeProfile()
+        )
+        overlay = pool.createXML(
+            profiles.volume_xml(
+                overlay_name,
+                record.size,
+                profile,
+                backing_path=image.target_path,
+                backing_format=image.format,
+            ),
+            0,
+        )
+    except libvirt.libvirtError as e:
+        raise _routing.InternalServerError(str(e)) from e
+
+    attachments = objects.get_pool_attachments(pool)
+    try:
+        for att in attachments.get(record.volume_name, []):
+            _snapshot_attached_disk(app, att, overlay.path(), snapshot_id)
+    except libvirt.libvirtError as e:
+        overlay.delete(0)
+        raise _routing.InternalServerError(str(e)) from e
+
+    snapshot = SnapshotRecord(
+        id=snapshot_id,
+        volume_id=volume_id,
+        volume_size=record.size,
+        image=record.volume_name,
+        description=description,
+        start_time=start_time_str,
+        status="completed",
+        pool=storage_pool.name,
+    )
+    db: sqlite3.Connection = app["db"]
+    with db:
+        _insert_snapshot(db, snapshot)
+        db.execute(
+            "UPDATE volumes SET volume_name = ? WHERE id = ?",
+            [overlay_name, volume_id],
+        )
+        _tags.put_tags(db, [(snapshot_id, "snapshot")], tags)
+
+    return _describe_snapshot(snapshot, tags)
+
+
+def _insert_snapshot(db: sqlite3.Connection, snapshot: SnapshotRecord) -> None:
+    """Record a new snapshot.  Must be called inside a transaction."""
+    db.execute(
+        f"""
+            INSERT INTO snapshots ({", ".join(SnapshotRecord._fields)})
+            VALUES ({", ".join("?" * len(SnapshotRecord._fields))})
+        """,
+        snapshot,
+    )
+
+
+def check_not_copying(volume_id: str) -> None:
+    """Raise IncorrectStateError if a snapshot of the volume is copied."""
+    if volume_id in _copying:
+        raise _routing.IncorrectStateError(
+            f"Volume {volume_id} has a snapshot in progress, try again "
+            f"later."
+        )
+
+
+def _frozen_name(image: str) -> str:
+    # The LVM snapshot a block snapshot image is copied from.
+    return f"{image}.tmp"
+
+
+async def _freeze_block_volume(
+    app: _routing.App,
+    storage_pool: placement.StoragePool,
+    record: volumes.VolumeRecord,
+    image: str,
+) -> None:
+    """Take the LVM snapshot of *record* to copy snapshot *image* from.
+
+    Crash-consistent, also for attached volumes, as LVM suspends I/O
+    to the volume while it snapshots it.
+    """
+    # Room for the LVM snapshot and the copy.
+    await volumes.check_capacity(
+        app, storage_pool, 2 * record.size, preallocated=True
+    )
+    pool = storage_pool.pool
+    try:
+        origin = objects.volume_from_xml(
+            pool.storageVolLookupByName(record.volume_name).XMLDesc(0)
+        )
+        await tasks.run_blocking(
+            pool.createXML,
+            profiles.block_volume_xml(
+                _frozen_name(image),
+                record.size,
+                origin_path=origin.target_path,
+            ),
+            0,
+        )
+    except libvirt.libvirtError as e:
+        raise _routing.InternalServerError(str(e)) from e
+
+
+def _submit_copy(app: _routing.App, snapshot: SnapshotRecord) -> None:
+    _copying.add(snapshot.volume_id)
+
+    async def _job() -> None:
+        try:
+            await _copy_block_snapshot(app, snapshot)
+        finally:
+            _copying.discard(snapshot.volume_id)
+
+    app["volume_queue"].submit(_job)
+
+
+async def _copy_block_snapshot(
+    app: _routing.App,
+    snapshot: SnapshotRecord,
+) -> None:
+    pool = volumes.get_storage_pool(app, snapshot.pool).pool
+    try:
+        frozen = pool.storageVolLookupByName(_frozen_name(snapshot.image))
+        try:
+            vol = pool.storageVolLookupByName(snapshot.image)
+        except libvirt.libvirtError:
+            pass
+        else:
+            # Left over from a copy interrupted by a restart.
+            await tasks.run_blocking(vol.delete, 0)
+        await tasks.run_blocking(
+            pool.createXMLFrom,
+            profiles.block_volume_xml(snapshot.image, snapshot.volume_size),
+            frozen,
+            0,
+        )
+    except libvirt.libvirtError:
+        app["logger"].exception(f"could not copy snapshot {snapshot.id}")
+        status = "error"
+    else:
+        status = "completed"
+
+    try:
+        frozen = pool.storageVolLookupByName(_frozen_name(snapshot.image))
+        await tasks.run_blocking(frozen.delete, 0)
+    except libvirt.libvirtError:
+        pass
+
+    with app["db"]:
+        app["db"].execute(
+            """
+                UPDATE snapshots SET status = ?
+                WHERE id = ? AND status = 'pending'
+            """,
+            [status, snapshot.id],
+        )
+
+
+async def resume_snapshot_jobs(app: _routing.App) -> None:
+    """Resubmit snapshot copies interrupted by a restart.
+
+    The LVM snapshots they copy from survive restarts.
+    """
+    with app["db"]:
+        cur = app["db"].execute(
+            f"""
+                SELECT {", ".join(SnapshotRecord._fields)}
+                FROM snapshots
+                WHERE status = 'pending'
+            """
+        )
+        pending = [SnapshotRecord(*row) for row in cur.fetchall()]
+
+    for snapshot in pending:
+        _submit_copy(app, snapshot)
+
+
+@_routing.handler("DeleteSnapshot")
+async def delete_snapshot(
+    args: _routing.HandlerArgs,
+    app: _routing.App,
+) -> Dict[str, Any]:
+    snapshot_id = args.get("SnapshotId")
+    if not snapshot_id:
+        raise _routing.InvalidParameterError("missing required SnapshotId")
+
+    snapshot = get_snapshot_record(app, snapshot_id)
+    if snapshot.status == "pending":
+        raise _routing.IncorrectStateError(
+            f"Snapshot {snapshot_id} is still being created."
+        )
+
+    # The image may still back volumes or other snapshots, so only
+    # hide the snapshot here and let garbage collection remove the
+    # image once nothing refers to it.
+    db: sqlite3.Connection = app["db"]
+    with db:
+        db.execute(
+            "UPDATE snapshots SET status = 'deleted' WHERE id = ?",
+            [snapshot_id],
+        )
+        _tags.delete_resource_tags(db, [(snapshot_id, "snapshot")])
+
+    await collect_garbage(app)
+
+    return {
+        "return": "true",
+    }
+
+
+@_routing.handler("DescribeSnapshots")
+async def describe_snapshots(
+    args: _routing.HandlerArgs,
+    app: _routing.App,
+) -> Dict[str, Any]:
+    max_results = _paging.get_max_results(
+        args, DESCRIBE_SNAPSHOTS_MAX_RESULTS
+    )
+    compiled = _filters.compile_filters(
+        args.get("Filter"),
+        SNAPSHOT_FILTERS,
+        resource_type="snapshot",
+        id_column="id",
+    )
+    quals = ["status != 'deleted'", compiled.where]
+    params = list(compiled.params)
+
+    snapshot_ids = [s for s in args.get("SnapshotId") or () if s]
+    if snapshot_ids:
+        quals.append(_filters.in_list("id", snapshot_ids))
+        params.extend(snapshot_ids)
+
+    next_token = args.get("NextToken")
+    if next_token:
+        quals.append("id > ?")
+        params.extend(_paging.decode_next_token(next_token, 1))
+
+    records = _query_snapshots(app, " AND ".join(quals), params, max_results)
+    tags = _tags.get_resource_tags(
+        app["db"], "snapshot", [r.id for r in records[:max_results]]
+    )
+
+    result: Dict[str, Any] = {
+        "snapshotSet": [
+            _describe_snapshot(r, tags[r.id]) for r in records[:max_results]
+        ],
+    }
+    if len(records) > max_results:
+        last = records[max_results - 1]
+        result["nextToken"] = _paging.encode_next_token([last.id])
+
+    return result
+
+
+def get_snapshot_record(app: _routing.App, snapshot_id: str) -> SnapshotRecord:
+    """Return the record of existing snapshot *snapshot_id*."""
+    records = _query_snapshots(
+        app, "id = ? AND status != 'deleted'", [snapshot_id], 1
+    )
+    if not records:
+        raise InvalidSnapshotNotFound(
+            f"The snapshot '{snapshot_id}' does not exist."
+        )
+    return records[0]
+
+
+async def collect_garbage(app: _routing.App) -> None:
+    """Remove images of deleted snapshots that nothing refers to anymore."""
+    db: sqlite3.Connection = app["db"]
+
+    with db:
+        cur = db.execute(
+            "SELECT id, image, pool FROM snapshots WHERE status = 'deleted'"
+        )
+        deleted = cur.fetchall()
+        if not deleted:
+            return
+        # Volumes being created from a snapshot have no image yet,
+        # but will be backed by the snapshot image.
+        cur = db.execute(
+            """
+                SELECT volume_name, pool FROM volumes
+                UNION ALL
+                SELECT image, pool FROM snapshots WHERE status != 'deleted'
+                UNION ALL
+                SELECT s.image, s.pool
+                FROM
+                    volumes AS v
+                    JOIN snapshots AS s ON s.id = v.snapshot_id
+                WHERE v.status = 'creating'
+            """
+        )
+        # Backing chains do not cross pools.
+        roots: Dict[Optional[str], List[str]] = {}
+        for name, pool_name in cur.fetchall():
+            roots.setdefault(pool_name, []).append(name)
+
+    referenced: Dict[Optional[str], Set[str]] = {}
+    for snapshot_id, image, pool_name in deleted:
+        pool = volumes.get_storage_pool(app, pool_name).pool
+        if pool_name not in referenced:
+            referenced[pool_name] = await tasks.run_blocking(
+                _get_chain_images, pool, roots.get(pool_name, [])
+            )
+        if image in referenced[pool_name]:
+            continue
+        try:
+            vol = pool.storageVolLookupByName(image)
+        except libvirt.libvirtError:
+            pass
+        else:
+            await tasks.run_blocking(vol.delete, 0)
+        with db:
+            db.execute("DELETE FROM snapshots WHERE id = ?", [snapshot_id])
+
+
+def _get_chain_images(
+    pool: libvirt.virStoragePool,
+    roots: List[str],
+) -> Set[str]:
+    # Names of all volumes in the backing chains of *roots*.
+    images: Set[str] = set()
+    for name in roots:
+        if name in images:
+            continue
+        try:
+            images.update(objects.get_backing_chain(pool, name))
+        except libvirt.libvirtError:
+            continue
+    return images
+
+
+def _snapshot_attached_disk(
+    app: _routing.App,
+    att: objects.VolumeAttachment,
+    overlay_path: str,
+    snapshot_id: str,
+) -> None:
+    lvirt_conn: libvirt.virConnect = app["libvirt"]
+    virdom = lvirt_conn.lookupByName(att.domain)
+    domain = objects.domain_from_xml(virdom.XMLDesc(0))
+
+    # Disks not mentioned would be snapshotted too.
+    other_disks = "".join(
+        f"<disk name='{target}' snapshot='no'/>"
+        for target in domain.disk_targets
+        if target != att.device
+    )
+    xml = f"""
+        <domainsnapshot>
+            <name>{snapshot_id}</name>
+            <disks>
+                <disk name='{att.device}' snapshot='external' type='file'>
+                    <driver type='qcow2'/>
+                    <source file='{overlay_path}'/>
+                </disk>
+                {other_disks}
+            </disks>
+        </domainsnapshot>
+    """
+    virdom.snapshotCreateXML(
+        xml,
+        libvirt.VIR_DOMAIN_SNAPSHOT_CREATE_DISK_ONLY
+        | libvirt.VIR_DOMAIN_SNAPSHOT_CREATE_REUSE_EXT
+        | libvirt.VIR_DOMAIN_SNAPSHOT_CREATE_NO_METADATA
+        | libvirt.VIR_DOMAIN_SNAPSHOT_CREATE_ATOMIC,
+    )
+
+
+def _query_snapshots(
+    app: _routing.App,
+    where: str,
+    params: List[Any],
+    limit: int,
+) -> List[SnapshotRecord]:
+    with app["db"]:
+        cur = app["db"].execute(
+            f"""
+                SELECT {", ".join(SnapshotRecord._fields)}
+                FROM snapshots
+                WHERE {where}
+                ORDER BY id
+                LIMIT ?
+            """,
+            [*params, limit + 1],
+        )
+        return [SnapshotRecord(*row) for row in cur.fetchall()]
+
+
+def _describe_snapshot(
+    record: SnapshotRecord,
+    tags: Dict[str, str],
+) -> Dict[str, Any]:
+    return {
+        "snapshotId": record.id,
+        "volumeId": record.volume_id,
+        "volumeSize": record.volume_size,
+        "description": record.description,
+        "startTime": record.start_time,
+        "status": record.status,
+        "progress": "0%" if record.status == "pending" else "100%",
+        "encrypted": "false",
+        "storageTier": "standard",
+        "tagSet": [{"key": k, "value": v} for k, v in tags.items()],
+    }
@@ -0,0 +1,375 @@
+from __future__ import annotations
+from typing import (
+    Any,
+    Dict,
+    Iterable,
+    List,
+    Optional,
+    Tuple,
+)
+
+import collections
+import sqlite3
+
+import libvirt
+
+from . import _filters
+from . import _paging
+from . import _routing
+
+
+# EC2 resource type -> resource_type in the tags table.
+RESOURCE_TYPES = {
+    "volume": "volume",
+    "elastic-ip": "ip_address",
+    "instance": "instance",
+    "snapshot": "snapshot",
+}
+
+_EC2_RESOURCE_TYPES = {v: k for k, v in RESOURCE_TYPES.items()}
+
+DESCRIBE_TAGS_MAX_RESULTS = 1000
+
+
+class InvalidIDError(_routing.ClientError):
+    code = "InvalidID"
+
+
+Resource = Tuple[str, str]
+
+
+def get_tag_specification(args: _routing.HandlerArgs) -> Dict[str, str]:
+    """Extract tags from the TagSpecification.N request parameter."""
+    tags = {}
+    tag_spec = args.get("TagSpecification")
+    if tag_spec:
+        for spec_entry in tag_spec:
+            tag_entries = spec_entry["Tag"]
+            for tag in tag_entries:
+                tags[tag["Key"]] = tag["Value"]
+
+    return tags
+
+
+def put_tags(
+    db: sqlite3.Connection,
+    resources: Iterable[Resource],
+    tags: Dict[str, str],
+) -> None:
+    """Create or overwrite *tags* on all *resources*.
+
+    Must be called inside a transaction.
+    """
+    db.executemany(
+        """
+            INSERT INTO tags
+                (resource_name, resource_type, tagname, tagvalue)
+            VALUES
+                (?, ?, ?, ?)
+            ON CONFLICT
+                (resource_name, resource_type, tagname)
+            DO UPDATE
+                SET tagvalue = excluded.tagvalue
+        """,
+        [
+            (res_name, res_type, k, v)
+            for res_name, res_type in resources
+            for k, v in tags.items()
+        ],
+    )
+
+
+def delete_resource_tags(
+    db: sqlite3.Connection,
+    resources: Iterable[Resource],
+) -> None:
+    """Drop all tags of *resources*.  Must be called inside a transaction."""
+    db.executemany(
+        """
+            DELETE FROM tags
+            WHERE resource_name = ? AND resource_type = ?
+        """,
+        list(resources),
+    )
+
+
+def get_resource_tags(
+    db: sqlite3.Connection,
+    resource_type: str,
+    names: List[str],
+) -> Dict[str, Dict[str, str]]:
+    """Return tags of resources *names* of type *resource_type*."""
+    tags: Dict[str, Dict[str, str]] = collections.defaultdict(dict)
+    if not names:
+        return tags
+
+    placeholders = ", ".join(["?"] * len(names))
+    with db:
+        cur = db.execute(
+            f"""
+                SELECT resource_name, tagname, tagvalue
+                FROM tags
+                WHERE
+                    resource_type = ?
+                    AND resource_name IN ({placeholders})
+            """,
+            [resource_type, *names],
+        )
+        for name, key, value in cur.fetchall():
+            tags[name][key] = value
+    return tags
+
+
+@_routing.handler("CreateTags")
+async def create_tags(
+    args: _routing.HandlerArgs,
+    app: _routing.App,
+) -> Dict[str, Any]:
+    resource_ids = _get_resource_ids(args)
+    tags = {}
+    for tag in args.get("Tag") or ():
+        if not tag or not tag.get("Key"):
+            raise _routing.InvalidParameterError("missing required Tag.N.Key")
+        tags[tag["Key"]] = tag.get("Value", "")
+
+    if not tags:
+        raise _routing.InvalidParameterError("missing required Tag")
+
+    db: sqlite3.Connection = app["db"]
+    resources = _resolve_resources(app, resource_ids)
+
+    with db:
+        put_tags(db, resources, tags)
+
+    return {
+        "return": "true",
+    }
+
+
+@_routing.handler("DeleteTags")
+async def delete_tags(
+    args: _routing.HandlerArgs,
+    app: _routing.App,
+) -> Dict[str, Any]:
+    resource_ids = _get_resource_ids(args)
+    # Key -> expected value, None means "any value".
+    tags: Dict[str, Optional[str]] = {}
+    for tag in args.get("Tag") or ():
+        if not tag or not tag.get("Key"):
+            raise _routing.InvalidParameterError("missing required Tag.N.Key")
+        tags[tag["Key"]] = tag.get("Value")
+
+    db: sqlite3.Connection = app["db"]
+    resources = _resolve_resources(app, resource_ids)
+
+    with db:
+        if tags:
+            db.executemany(
+                """
+                    DELETE FROM tags
+                    WHERE
+                        resource_name = ?1
+                        AND resource_type = ?2
+                        AND tagname = ?3
+                        AND (?4 IS NULL OR tagvalue = ?4)
+                """,
+                [
+                    (res_name, res_type, k, v)
+                    for res_name, res_type in resources
+                    for k, v in tags.items()
+                ],
+            )
+        else:
+            delete_resource_tags(db, resources)
+
+    return {
+        "return": "true",
+    }
+
+
+@_routing.handler("DescribeTags")
+async def describe_tags(
+    args: _routing.HandlerArgs,
+    app: _routing.App,
+) -> Dict[str, Any]:
+    max_results = _paging.get_max_results(args, DESCRIBE_TAGS_MAX_RESULTS)
+
+    type_placeholders = ", ".join(["?"] * len(_EC2_RESOURCE_TYPES))
+    quals = [f"t.resource_type IN ({type_placeholders})"]
+    qargs: List[Any] = list(_EC2_RESOURCE_TYPES)
+
+    for flt in args.get("Filter") or ():
+        name = flt["Name"]
+        values = list(flt.get("Value") or ())
+        placeholders = ", ".join(["?"] * len(values))
+        if name == "resource-type":
+            try:
+                values = [RESOURCE_TYPES[v] for v in values]
+            except KeyError as e:
+                raise _routing.InvalidParameterError(
+                    f"unsupported resource-type: {e.args[0]}"
+                ) from None
+            quals.append(f"t.resource_type IN ({placeholders})")
+            qargs.extend(values)
+        elif name == "resource-id":
+            quals.append(
+                f"""(
+                    t.resource_name IN ({placeholders})
+                    OR a.allocation_id IN ({placeholders})
+                )"""
+            )
+            qargs.extend(values)
+            qargs.extend(values)
+        elif name == "key":
+            quals.append(f"t.tagname IN ({placeholders})")
+            qargs.extend(values)
+        elif name == "value":
+            quals.append(f"t.tagvalue IN ({placeholders})")
+            qargs.extend(values)
+        else:
+            raise _routing.InvalidParameterError(
+                f"unsupported filter type: {name}"
+            )
+
+    next_token = args.get("NextToken")
+    if next_token:
+        quals.append(
+            "(t.resource_type, t.resource_name, t.tagname) > (?, ?, ?)"
+        )
+        qargs.extend(_paging.decode_next_token(next_token, 3))
+
+    db: sqlite3.Connection = app["db"]
+    with db:
+        cur = db.execute(
+            f"""
+                SELECT
+                    t.resource_type,
+                    t.resource_name,
+                    t.tagname,
+                    t.tagvalue,
+                    a.allocation_id
+                FROM
+                    tags AS t
+                    LEFT JOIN ip_addresses AS a
+                        ON (
+                            t.resource_type = 'ip_address'
+                            AND a.ip_address = t.resource_name
+                        )
+                WHERE
+                    {' AND '.join(quals)}
+                ORDER BY
+                    t.resource_type, t.resource_name, t.tagname
+                LIMIT ?
+            """,
+            qargs + [max_results + 1],
+        )
+        rows = cur.fetchall()
+
+    result: Dict[str, Any] = {
+        "tagSet": [
+            {
+                "resourceId": alloc_id if alloc_id else res_name,
+                "resourceType": _EC2_RESOURCE_TYPES[res_type],
+                "key": key,
+                "value": value,
+            }
+            for res_type, res_name, key, value, alloc_id in rows[:max_results]
+        ],
+    }
+
+    if len(rows) > max_results:
+        last = rows[max_results - 1]
+        result["nextToken"] = _paging.encode_next_token(last[:3])
+
+    return result
+
+
+def _get_resource_ids(args: _routing.HandlerArgs) -> List[str]:
+    resource_ids = [r for r in args.get("ResourceId") or () if r]
+    if not resource_ids:
+        raise _routing.InvalidParameterError("missing required ResourceId")
+    return resource_ids
+
+
+def _resolve_resources(
+    app: _routing.App,
+    resource_ids: List[str],
+) -> List[Resource]:
+    """Map EC2 resource ids to (resource_name, resource_type) tag keys."""
+    db: sqlite3.Connection = app["db"]
+    lvirt_conn: libvirt.virConnect = app["libvirt"]
+
+    alloc_ids = [r for r in resource_ids if r.startswith("eipalloc-")]
+    snapshot_ids = [r for r in resource_ids if r.startswith("snap-")]
+    # Anything else is a volume or an instance.
+    other_ids = [
+        r
+        for r in resource_ids
+        if not r.startswith("eipalloc-") and not r.startswith("snap-")
+    ]
+    ips = {}
+    if alloc_ids:
+        placeholders = ", ".join(["?"] * len(alloc_ids))
+        with db:
+            cur = db.execute(
+                f"""
+                    SELECT allocation_id, ip_address
+                    FROM ip_addresses
+                    WHERE allocation_id IN ({placeholders})
+                """,
+                alloc_ids,
+            )
+            ips = dict(cur.fetchall())
+
+    snapshots = set()
+    if snapshot_ids:
+        placeholders = ", ".join(["?"] * len(snapshot_ids))
+        with db:
+            cur = db.execute(
+                f"""
+                    SELECT id
+                    FROM snapshots
+                    WHERE id IN ({placeholders}) AND status != 'deleted'
+                """,
+                snapshot_ids,
+            )
+            snapshots = {row[0] for row in cur.fetchall()}
+
+    volumes = set()
+    if other_ids:
+        with db:
+            cur = db.execute(
+                f"""
+                    SELECT id
+                    FROM volumes
+                    WHERE {_filters.in_list("id", other_ids)}
+                """,
+                other_ids,
+            )
+            volumes = {row[0] for row in cur.fetchall()}
+
+    resources = []
+    for res_id in resource_ids:
+        if res_id.startswith("eipalloc-"):
+            ip = ips.get(res_id)
+            if ip is None:
+                raise InvalidIDError(f"The ID '{res_id}' is not valid")
+            resources.append((ip, "ip_address"))
+            continue
+        elif res_id.startswith("snap-"):
+            if res_id not in snapshots:
+                raise InvalidIDError(f"The ID '{res_id}' is not valid")
+            resources.append((res_id, "snapshot"))
+            continue
+        elif res_id in volumes:
+            resources.append((res_id, "volume"))
+            continue
+
+        try:
+            lvirt_conn.lookupByName(res_id)
+        except libvirt.libvirtError:
+            raise InvalidIDError(f"The ID '{res_id}' is not valid") from None
+        else:
+            resources.append((res_id, "instance"))
+
+    return resources
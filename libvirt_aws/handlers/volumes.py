@@ -3,18 +3,46 @@ from __future__ import annotations
 import asyncio
 import datetime
 import json
-import os.path
+import re
 import sqlite3
 import textwrap
-from typing import Any, Dict, Tuple
+import time
+from typing import (
+    Any,
+    Dict,
+    List,
+    Mapping,
+    NamedTuple,
+    Optional,
+    Set,
+    Tuple,
+)
+import math
 import uuid
 
+from aiohttp import web
+import aiohttp
 import libvirt
 
+from . import _filters
+from . import _paging
 from . import _routing
+from . import attachments as _attachments
 from . import errors
+from . import snapshots
+from . import tags as _tags
+from . import warm_pool
 
+from .. import capacity
+from .. import iotune
+from .. import metrics
 from .. import objects
+from .. import placement
+from .. import profiles
+from .. import qemu
+from .. import qemu_img
+from .. import sparsify
+from .. import tasks
 
 
 class InvalidAttachmentNotFound(_routing.ClientError):
@@ -25,7 +53,146 @@ class InvalidVolumeNotFound(_routing.ClientError):
     code = "InvalidVolume.NotFound"
 
 
-_known_attachments: Dict[Tuple[str, str], Tuple[str, str]] = {}
+class VolumeInUseError(_routing.ClientError):
+    code = "VolumeInUse"
+
+
+class AttachmentLimitExceededError(_routing.ClientError):
+    code = "AttachmentLimitExceeded"
+
+
+class IncorrectModificationStateError(_routing.ClientError):
+    code = "IncorrectModificationState"
+
+
+class InsufficientVolumeCapacityError(_routing.ServerError):
+    code = "InsufficientVolumeCapacity"
+
+
+WIPE_ALGORITHMS = {
+    "zero": libvirt.VIR_STORAGE_VOL_WIPE_ALG_ZERO,
+    "trim": libvirt.VIR_STORAGE_VOL_WIPE_ALG_TRIM,
+}
+
+WIPE_CHUNK_SIZE = 16 * 2**20
+
+
+# Volume name -> domains it is attached to.
+Attachments = Mapping[str, List[objects.VolumeAttachment]]
+
+
+class VolumeRecord(NamedTuple):
+    id: str
+    availability_zone: str
+    volume_type: str
+    size: int
+    create_time: Optional[str]
+    status: str
+    # Name of the libvirt volume holding the active image, changes
+    # when the volume is snapshotted.
+    volume_name: str
+    snapshot_id: Optional[str]
+    # Provisioned IOPS and throughput (MiB/s), None for the volume
+    # type default.
+    iops: Optional[int]
+    throughput: Optional[int]
+    # Name of the storage pool holding the images of the volume.
+    pool: Optional[str]
+
+
+def _attachment_values(key: str) -> _filters.Getter:
+    def _getter(vol: Mapping[str, Any]) -> List[Any]:
+        return [att[key] for att in vol["attachmentSet"]]
+
+    return _getter
+
+
+VOLUME_FILTERS = {
+    "volume-id": _filters.Field(column="id"),
+    "availability-zone": _filters.Field(column="availability_zone"),
+    "volume-type": _filters.Field(column="volume_type"),
+    "size": _filters.Field(column="size", type=int),
+    "create-time": _filters.Field(column="create_time"),
+    "status": _filters.Field(getter=lambda vol: [vol["status"]]),
+    "attachment.instance-id": _filters.Field(
+        getter=_attachment_values("instanceId"),
+    ),
+    "attachment.device": _filters.Field(getter=_attachment_values("device")),
+    "attachment.status": _filters.Field(getter=_attachment_values("status")),
+}
+
+
+# Volumes whose image is being rewritten in the background, e.g.
+# flattened, and must not be attached, snapshotted or resized.
+_busy_volumes: Set[str] = set()
+# Warm volumes with a provisioning job queued or running.
+_warming: Set[str] = set()
+
+
+def _modification_value(key: str) -> _filters.Getter:
+    def _getter(modification: Mapping[str, Any]) -> List[Any]:
+        value = modification.get(key)
+        return [] if value is None else [value]
+
+    return _getter
+
+
+MODIFICATION_FILTERS = {
+    "volume-id": _filters.Field(column="volume_id"),
+    "modification-state": _filters.Field(column="state"),
+    "start-time": _filters.Field(column="start_time"),
+    "original-size": _filters.Field(
+        getter=_modification_value("originalSize"),
+    ),
+    "target-size": _filters.Field(
+        getter=_modification_value("targetSize"),
+    ),
+    "original-iops": _filters.Field(
+        getter=_modification_value("originalIops"),
+    ),
+    "target-iops": _filters.Field(
+        getter=_modification_value("targetIops"),
+    ),
+    "target-throughput": _filters.Field(
+        getter=_modification_value("targetThroughput"),
+    ),
+    "original-volume-type": _filters.Field(
+        getter=_modification_value("originalVolumeType"),
+    ),
+    "target-volume-type": _filters.Field(
+        getter=_modification_value("targetVolumeType"),
+    ),
+}
+
+DESCRIBE_MODIFICATIONS_MAX_RESULTS = 500
+
+# Filesystem type -> guest command growing it to the size of its device.
+GROW_FS_COMMANDS: Dict[str, Tuple[str, ...]] = {
+    "ext2": ("resize2fs", "{device}"),
+    "ext3": ("resize2fs", "{device}"),
+    "ext4": ("resize2fs", "{device}"),
+    "xfs": ("xfs_growfs", "{mountpoint}"),
+    "btrfs": ("btrfs", "filesystem", "resize", "max", "{mountpoint}"),
+}
+
+GUEST_COMMAND_TIMEOUT = 120.0
+
+# Sparsify a detached volume once its image grew by this much since it
+# was last sparsified.
+RECLAIM_MIN_GROWTH = 256 * 2**20
+
+# Names of libvirt volumes created for EBS volumes.
+VOLUME_NAME_RE = re.compile(
+    r"^[0-9a-f]{8}(-[0-9a-f]{4}){3}-[0-9a-f]{12}\.\w+$"
+)
+
+# Pool metrics making up the I/O load considered by volume placement.
+POOL_LOAD_METRICS = ("PoolReadBytes", "PoolWriteBytes")
+
+IMPORT_FORMATS = frozenset({"raw", "qcow2"})
+# Image data is moved between HTTP bodies and libvirt streams in chunks
+# of this size.  Chunks that are all zeros are sent as holes.
+TRANSFER_CHUNK_SIZE = 2**20
 
 
 @_routing.handler("CreateVolume")
@@ -33,10 +200,37 @@ async def create_volume(
     args: _routing.HandlerArgs,
     app: _routing.App,
 ) -> Dict[str, Any]:
-    pool: libvirt.virStoragePool = app["libvirt_pool"]
+    return await create(app, args)
+
+
+async def create(
+    app: _routing.App,
+    args: _routing.HandlerArgs,
+) -> Dict[str, Any]:
+    """Create a volume as described by CreateVolume *args*."""
+    snapshot_id = args.get("SnapshotId") or None
+    snapshot = None
+    if snapshot_id is not None:
+        snapshot = snapshots.get_snapshot_record(app, snapshot_id)
+        if snapshot.status != "completed":
+            raise _routing.IncorrectStateError(
+                f"Snapshot {snapshot_id} is {snapshot.status}."
+            )
+
     size = args.get("Size")
     if not size:
-        raise _routing.InvalidParameterError("missing required Size")
+        if snapshot is None:
+            raise _routing.InvalidParameterError("missing required Size")
+        size = snapshot.volume_size
+    try:
+        size = int(size)
+    except ValueError:
+        raise _routing.InvalidParameterError("invalid Size value") from None
+    if snapshot is not None and size < snapshot.volume_size:
+        raise _routing.InvalidParameterError(
+            f"Size must be at least the snapshot size "
+            f"({snapshot.volume_size} GiB)"
+        )
 
     az = args.get("AvailabilityZone")
     if not az:
@@ -47,64 +241,104 @@ async def create_volume(
     voltype = args.get("VolumeType")
     if not voltype:
         voltype = "gp2"
+    profile = app["volume_profiles"].get(voltype)
+    if profile is None:
+        raise _routing.InvalidParameterError(
+            f"unsupported VolumeType: {voltype}"
+        )
 
-    volname = f"{uuid.uuid4()}.qcow2"
-
-    xml = textwrap.dedent(
-        f"""\
-    <volume type='file'>
-        <name>{volname}</name>
-        <capacity unit="G">{size}</capacity>
-        <target>
-            <path>{volname}</path>
-            <permissions>
-                <mode>0644</mode>
-            </permissions>
-            <format type='qcow2'/>
-            <compat>1.1</compat>
-            <features>
-                <lazy_refcounts/>
-            </features>
-        </target>
-    </volume>"""
-    )
+    iops = _get_int_arg(args, "Iops")
+    throughput = _get_int_arg(args, "Throughput")
+    tune = _get_iotune(voltype, size, iops, throughput)
+
+    warm = None
+    if snapshot is None:
+        warm = warm_pool.find_ready(
+            app["db"],
+            voltype,
+            size,
+            [p.name for p in get_storage_pools(app) if p.accepts(az, voltype)],
+        )
 
-    pool.createXML(xml, flags=libvirt.VIR_STORAGE_VOL_CREATE_PREALLOC_METADATA)
+    if warm is not None:
+        # Already provisioned and accounted for.
+        volname = warm.volume_name
+        pool_name = get_storage_pool(app, warm.pool).name
+        status = "available"
+    elif snapshot is not None:
+        # A thin overlay, which must be in the pool of its backing
+        # image.
+        storage_pool = get_storage_pool(app, snapshot.pool)
+        await check_capacity(app, storage_pool, size, preallocated=False)
+        volname = f"{uuid.uuid4()}.qcow2"
+        pool_name = storage_pool.name
+        status = "creating"
+    else:
+        storage_pool = await _place_volume(
+            app,
+            az,
+            voltype,
+            size,
+            preallocated=profile.preallocation in {"falloc", "full"},
+        )
+        volname = f"{uuid.uuid4()}.{profile.format}"
+        pool_name = storage_pool.name
+        status = "creating"
 
     create_time = datetime.datetime.now(datetime.timezone.utc)
+    create_time_str = create_time.strftime("%Y-%m-%dT%H:%M:%S.%f000Z")
 
-    tags = {}
-    tag_spec = args.get("TagSpecification")
-    if tag_spec:
-        for spec_entry in tag_spec:
-            tag_entries = spec_entry["Tag"]
-            for tag in tag_entries:
-                tags[tag["Key"]] = tag["Value"]
-
-    if tags:
-        cur = app["db"].cursor()
-        cur.executemany(
+    tags = _tags.get_tag_specification(args)
+    with app["db"]:
+        if warm is not None:
+            warm_pool.remove(app["db"], warm.volume_name)
+        app["db"].execute(
             """
-                INSERT INTO tags
-                    (resource_name, resource_type, tagname, tagvalue)
-                VALUES (?, ?, ?, ?)
+                INSERT INTO volumes
+                    (id, availability_zone, volume_type, size, create_time,
+                     status, volume_name, snapshot_id, iops, throughput,
+                     pool)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
             """,
-            [[volname, "volume", n, v] for n, v in tags.items()],
+            [
+                volname,
+                az,
+                voltype,
+                size,
+                create_time_str,
+                status,
+                volname,
+                snapshot_id,
+                iops,
+                throughput,
+                pool_name,
+            ],
         )
-        app["db"].commit()
+        _tags.put_tags(app["db"], [(volname, "volume")], tags)
 
-    return {
+    if warm is not None:
+        _submit_warm_pool_fill(app)
+    else:
+        _submit_provisioning(
+            app, volname, size, snapshot.image if snapshot else None
+        )
+
+    result: Dict[str, Any] = {
         "volumeId": volname,
         "size": size,
-        "iops": 10000,
         "availabilityZone": az,
-        "snapshotId": None,
-        "status": "creating",
-        "createTime": create_time.strftime("%Y-%m-%dT%H:%M:%S.%f000Z"),
+        "snapshotId": snapshot_id,
+        "status": status,
+        "createTime": create_time_str,
         "volumeType": voltype,
         "tagSet": [{"key": k, "value": v} for k, v in tags.items()],
         "multiAttachEnabled": "false",
     }
+    if tune is not None:
+        result["iops"] = tune.iops
+        result["throughput"] = tune.throughput
+
+    return result
 
 
 @_routing.handler("DeleteVolume")
@@ -112,17 +346,51 @@ async def delete_volume(
     args: _routing.HandlerArgs,
     app: _routing.App,
 ) -> Dict[str, Any]:
-    pool: libvirt.virStoragePool = app["libvirt_pool"]
     volname = args.get("VolumeId")
     if not volname:
         raise _routing.InvalidParameterError("missing required VolumeId")
 
-    try:
-        vol = pool.storageVolLookupByName(volname)
-    except libvirt.libvirtError as e:
-        raise InvalidVolumeNotFound(e.args[0]) from None
+    return await delete(app, volname)
+
+
+async def delete(
+    app: _routing.App,
+    volname: str,
+    *,
+    attachments: Optional[Attachments] = None,
+) -> Dict[str, Any]:
+    """Start deleting volume *volname*.
+
+    *attachments* are those of all pool volumes, if already known.
+    """
+    record = get_volume_record(app, volname)
+    if record.status in {"creating", "importing"}:
+        raise _routing.IncorrectStateError(
+            f"The volume '{volname}' is still being created."
+        )
+    elif record.status == "deleting":
+        return {
+            "return": "true",
+        }
+
+    check_not_busy(volname)
+    snapshots.check_not_copying(volname)
+    # The modification job would not find the volume anymore.
+    if _get_active_modification(app, volname) is not None:
+        raise _routing.IncorrectStateError(
+            f"Volume {volname} is being modified, try again later."
+        )
+    (vol_info,) = _describe_volumes(app, [record], attachments=attachments)
+    if vol_info["status"] == "in-use":
+        raise VolumeInUseError(f"Volume {volname} is currently attached.")
+
+    with app["db"]:
+        app["db"].execute(
+            "UPDATE volumes SET status = 'deleting' WHERE id = ?",
+            [volname],
+        )
 
-    vol.delete()
+    _submit_deletion(app, volname)
 
     return {
         "return": "true",
@@ -134,124 +402,343 @@ async def describe_volumes(
     args: _routing.HandlerArgs,
     app: _routing.App,
 ) -> Dict[str, Any]:
-    pool: libvirt.virStoragePool = app["libvirt_pool"]
-    volume_ids = set(args.get("VolumeId", ()))
-    result = []
-    filters = args.get("Filter")
-    if filters:
-        filtered_volume_ids = set()
-        for flt in filters:
-            if flt["Name"].startswith("tag:"):
-                tagname = flt["Name"][len("tag:")]
-                tagvalue = flt["Value"]
-
-                cur = app["db"].cursor()
-                cur.execute(
-                    f"""
-                    SELECT resource_name FROM tags
-                    WHERE tagname = ? AND resource_type = 'volume'
-                    AND tagvalue IN ({",".join(["?"] * len(tagvalue))})
-                """,
-                    [tagname] + list(tagvalue),
-                )
-                filtered_volume_ids.update(cur.fetchall())
-                cur.close()
-            else:
-                raise _routing.InvalidParameterError(
-                    f"unsupported filter type: {flt['Name']}"
-                )
+    _sync_inventory(app)
 
-        if volume_ids:
-            volume_ids -= filtered_volume_ids
-        else:
-            volume_ids = filtered_volume_ids
+    compiled = _filters.compile_filters(
+        args.get("Filter"),
+        VOLUME_FILTERS,
+        resource_type="volume",
+        id_column="id",
+    )
+    quals = [compiled.where]
+    params = list(compiled.params)
 
-    for volume in objects.get_all_volumes(pool):
-        volname = volume.name
-        if (not volume_ids and not filters) or volname in volume_ids:
-            result.append(_describe_volume(pool, volume))
+    volume_ids = [v for v in args.get("VolumeId") or () if v]
+    if volume_ids:
+        quals.append(_filters.in_list("id", volume_ids))
+        params.extend(volume_ids)
+
+    records = _query_volumes(app, " AND ".join(quals), params)
+    result = [
+        desc
+        for desc in _describe_volumes(app, records)
+        if compiled.match(desc)
+    ]
 
     return {
         "volumeSet": result,
     }
 
 
+@_routing.raw_handler("/volumes/import", methods=("POST", "PUT"))
+async def import_volume(request: web.Request) -> web.StreamResponse:
+    """Create a volume from the disk image in the request body.
+
+    The image is streamed into a new volume as it is received.  The
+    volume is as large as Size GiB, or as the image if Size is omitted.
+    """
+    app: _routing.App = request.app
+    args = _routing.parse_args(request.query)
+
+    az = args.get("AvailabilityZone")
+    if not az:
+        raise _routing.InvalidParameterError(
+            "missing required AvailabilityZone"
+        )
+
+    voltype = args.get("VolumeType") or "gp2"
+    if voltype not in app["volume_profiles"]:
+        raise _routing.InvalidParameterError(
+            f"unsupported VolumeType: {voltype}"
+        )
+
+    fmt = args.get("Format") or "raw"
+    if fmt not in IMPORT_FORMATS:
+        raise _routing.InvalidParameterError(f"unsupported Format: {fmt}")
+
+    size = _get_int_arg(args, "Size")
+    iops = _get_int_arg(args, "Iops")
+    throughput = _get_int_arg(args, "Throughput")
+    if size is not None:
+        _get_iotune(voltype, size, iops, throughput)
+    # Without a Size, the image size is not known up front.  Block
+    # volumes must be created at their final size and cannot hold
+    # qcow2 images, so such imports go to file pools.
+    storage_pool = await _place_volume(
+        app,
+        az,
+        voltype,
+        size or 0,
+        preallocated=False,
+        allow_block=size is not None and fmt == "raw",
+    )
+
+    volname = f"{uuid.uuid4()}.{fmt}"
+    create_time = datetime.datetime.now(datetime.timezone.utc)
+    create_time_str = create_time.strftime("%Y-%m-%dT%H:%M:%S.%f000Z")
+
+    tags = _tags.get_tag_specification(args)
+    with app["db"]:
+        app["db"].execute(
+            """
+                INSERT INTO volumes
+                    (id, availability_zone, volume_type, size, create_time,
+                     status, volume_name, iops, throughput, pool)
+                VALUES (?, ?, ?, ?, ?, 'importing', ?, ?, ?, ?)
+            """,
+            [
+                volname,
+                az,
+                voltype,
+                size or 0,
+                create_time_str,
+                volname,
+                iops,
+                throughput,
+                storage_pool.name,
+            ],
+        )
+        _tags.put_tags(app["db"], [(volname, "volume")], tags)
+
+    try:
+        if storage_pool.is_block:
+            assert size is not None
+            await _import_block_image(
+                storage_pool.pool, volname, request.content, size
+            )
+        else:
+            size = await _import_image(
+                storage_pool.pool, volname, request.content, fmt, size
+            )
+        _get_iotune(voltype, size, iops, throughput)
+    except BaseException:
+        app["logger"].info(f"import of volume {volname} failed")
+        with app["db"]:
+            app["db"].execute(
+                "UPDATE volumes SET status = 'deleting' WHERE id = ?",
+                [volname],
+            )
+        _submit_deletion(app, volname)
+        raise
+
+    with app["db"]:
+        app["db"].execute(
+            "UPDATE volumes SET status = 'available', size = ? WHERE id = ?",
+            [size, volname],
+        )
+
+    record = get_volume_record(app, volname)
+    (result,) = _describe_volumes(app, [record])
+    result["RequestID"] = str(uuid.uuid4())
+    version = args.get("Version")
+    text = _routing.format_xml_response(
+        result,
+        root="ImportVolumeResponse",
+        xmlns=(
+            f"http://ec2.amazonaws.com/doc/{version}/" if version else None
+        ),
+    )
+    return web.Response(text=text, content_type="text/xml")
+
+
+@_routing.raw_handler("/volumes/{VolumeId}/export")
+async def export_volume(request: web.Request) -> web.StreamResponse:
+    """Stream the image of a detached volume in the response body."""
+    app: _routing.App = request.app
+    volume_id = request.match_info["VolumeId"]
+
+    record = get_volume_record(app, volume_id)
+    if record.status != "available":
+        raise _routing.IncorrectStateError(
+            f"Volume {volume_id} is {record.status} and cannot be exported."
+        )
+    check_not_busy(volume_id)
+    (vol_info,) = _describe_volumes(app, [record])
+    if vol_info["status"] == "in-use":
+        raise VolumeInUseError(f"Volume {volume_id} is currently attached.")
+
+    storage_pool = get_storage_pool(app, record.pool)
+    vol = storage_pool.pool.storageVolLookupByName(record.volume_name)
+    volume = objects.volume_from_xml(vol.XMLDesc(0))
+    if volume.backing_store is not None:
+        # The image alone is not the volume's data, and a chain
+        # cannot be streamed as one image.
+        raise _routing.IncorrectStateError(
+            f"Volume {volume_id} is backed by a snapshot image and "
+            f"cannot be exported."
+        )
+
+    # Keep the image from being rewritten or attached while it is read.
+    _busy_volumes.add(volume_id)
+    try:
+        length = vol.infoFlags(libvirt.VIR_STORAGE_VOL_GET_PHYSICAL)[2]
+        stream = vol.connect().newStream(0)
+        await tasks.run_blocking(
+            vol.download,
+            stream,
+            0,
+            length,
+            # Block devices have no holes to skip.
+            (
+                0
+                if storage_pool.is_block
+                else libvirt.VIR_STORAGE_VOL_DOWNLOAD_SPARSE_STREAM
+            ),
+        )
+        response = web.StreamResponse(
+            headers={
+                "Content-Disposition": (
+                    f'attachment; filename="{volume_id}"'
+                ),
+                "X-Volume-Format": volume.format,
+            },
+        )
+        response.content_type = "application/octet-stream"
+        response.content_length = length
+        try:
+            await response.prepare(request)
+            await _send_image(stream, response)
+        except BaseException:
+            stream.abort()
+            raise
+        await tasks.run_blocking(stream.finish)
+        await response.write_eof()
+        return response
+    finally:
+        _busy_volumes.discard(volume_id)
+
+
 @_routing.handler("AttachVolume")
 async def attach_volume(
     args: _routing.HandlerArgs,
     app: _routing.App,
 ) -> Dict[str, Any]:
-    pool: libvirt.virStoragePool = app["libvirt_pool"]
+    lvirt_conn: libvirt.virConnect = app["libvirt"]
     instance_id = args.get("InstanceId")
     if not instance_id:
         raise _routing.InvalidParameterError("missing required InstanceId")
     if not isinstance(instance_id, str):
         raise _routing.InvalidParameterError("invalid InstanceId value")
+
+    try:
+        virdom = lvirt_conn.lookupByName(instance_id)
+    except libvirt.libvirtError as e:
+        raise _routing.InvalidParameterError(f"invalid InstanceId: {e}") from e
+
+    return await attach(app, args, virdom)
+
+
+async def attach(
+    app: _routing.App,
+    args: _routing.HandlerArgs,
+    virdom: libvirt.virDomain,
+    *,
+    attachments: Optional[Attachments] = None,
+) -> Dict[str, Any]:
+    """Attach the volume in AttachVolume *args* to domain *virdom*.
+
+    The volume gets the first free target if Device is omitted or
+    taken.  *attachments* are those of all pool volumes, if already
+    known.
+    """
+    instance_id = virdom.name()
     volume_id = args.get("VolumeId")
     if not volume_id:
         raise _routing.InvalidParameterError("missing required VolumeId")
-    device = args.get("Device")
-    if not device:
-        raise _routing.InvalidParameterError("missing required Device")
-    if not isinstance(device, str):
+    device = args.get("Device") or None
+    if device is not None and not isinstance(device, str):
         raise _routing.InvalidParameterError("invalid Device value")
     if not isinstance(volume_id, str):
         raise _routing.InvalidParameterError("invalid VolumeId value")
 
-    if device.startswith("/"):
+    if device is not None and device.startswith("/"):
         if not device.startswith("/dev/"):
             raise _routing.InvalidParameterError(
                 "invalid Device, must start with /dev"
             )
         device = device[len("/dev/") :]
 
-    conn = pool.connect()
-    try:
-        virdom = conn.lookupByName(instance_id)
-    except libvirt.libvirtError as e:
-        raise _routing.InvalidParameterError(f"invalid InstanceId: {e}") from e
+    record = get_volume_record(app, volume_id)
+    if record.status != "available":
+        raise _routing.IncorrectStateError(
+            f"Volume {volume_id} is {record.status} and cannot be attached."
+        )
+    check_not_busy(volume_id)
 
+    (vol_info,) = _describe_volumes(app, [record], attachments=attachments)
+    if vol_info["status"] != "available":
+        raise _routing.IncorrectStateError(
+            f"Volume {volume_id} is in use and cannot be attached."
+        )
+
+    storage_pool = get_storage_pool(app, record.pool)
     try:
-        virvol = pool.storageVolLookupByName(volume_id)
+        virvol = storage_pool.pool.storageVolLookupByName(record.volume_name)
     except libvirt.libvirtError as e:
-        raise _routing.InvalidParameterError(f"invalid VolumeId: {e}") from e
-
+        raise InvalidVolumeNotFound(f"invalid VolumeId: {e}") from e
     volume = objects.volume_from_xml(virvol.XMLDesc(0))
 
-    if _get_volume_status(pool, volume) != "available":
-        raise _routing.IncorrectStateError(
-            f"Volume {volume.name} is in use and cannot be attached."
+    profile = app["volume_profiles"].get(
+        record.volume_type, profiles.VolumeProfile()
+    )
+    driver_options = _get_driver_options(args.get("Driver"), profile.driver)
+
+    async with _attachments.domain_lock(instance_id):
+        domain = objects.domain_from_xml(
+            await tasks.run_blocking(virdom.XMLDesc, 0)
         )
+        # Attaches of other volumes may have gone ahead in the meantime.
+        if _attachments.get_attachments(app["db"], volume_ids=[volume_id]):
+            raise _routing.IncorrectStateError(
+                f"Volume {volume_id} is in use and cannot be attached."
+            )
+        used = _attachments.get_used_targets(app["db"], domain)
+        if device is None or device in used:
+            device = _attachments.allocate_target(used)
+            if device is None:
+                raise AttachmentLimitExceededError(
+                    f"Instance {instance_id} has no free disk targets."
+                )
+        driver = profiles.resolve_driver_options(
+            driver_options,
+            iothreads=domain.iothreads,
+            vcpus=domain.vcpus,
+            used_iothreads=domain.used_iothreads,
+        )
+        # The record reserves the target until the device shows up in
+        # the domain.
+        with app["db"]:
+            _attachments.begin_attach(
+                app["db"], volume_id, instance_id, device, driver
+            )
 
+    driver_attrs = "".join(f" {k}='{v}'" for k, v in driver.items())
+
+    # Limits go into the device definition rather than being set after
+    # the fact, so the disk is never attached unthrottled.
+    tune = _get_record_iotune(record)
+    iotune_xml = tune.to_xml() if tune is not None else ""
+
+    disk_type, source = _disk_source(storage_pool, volume)
     xml = textwrap.dedent(
         f"""\
-    <disk type='volume' device='disk'>
-        <driver name='qemu' type='qcow2'/>
-        <source pool='{pool.name()}' volume='{volume_id}' />
+    <disk type='{disk_type}' device='disk'>
+        <driver name='qemu' type='{volume.format}'{driver_attrs}/>
+        {source}
         <target dev='{device}' bus='virtio'/>
         <serial>lvirtebs-{device}</serial>
+        {iotune_xml}
     </disk>"""
     )
 
     try:
-        virdom.attachDevice(xml)
+        with _attachments.in_flight(volume_id, instance_id):
+            await tasks.run_blocking(virdom.attachDevice, xml)
     except libvirt.libvirtError as e:
+        _attachments.forget(app["db"], volume_id, instance_id)
         raise _routing.InternalServerError(str(e)) from e
 
-    # Give the new attachment time to settle.  Alas, there seems to be
-    # no obvious way to actually verify the status of the device in the
-    # target VM.
-    key = (volume_id, instance_id)
-    dev = device
-    for (vol, dom), (_, att_status) in tuple(_known_attachments.items()):
-        if vol == volume_id and att_status == "detached":
-            del _known_attachments[vol, dom]
-    _known_attachments[key] = (dev, "attaching")
-
-    def _mark_attached() -> None:
-        _known_attachments[key] = (dev, "attached")
-
-    asyncio.get_running_loop().call_later(3, _mark_attached)
+    _attachments.track_attach(app, virdom, volume_id, instance_id, device)
 
     return {
         "volumeId": volume_id,
@@ -266,45 +753,67 @@ async def detach_volume(
     args: _routing.HandlerArgs,
     app: _routing.App,
 ) -> Dict[str, Any]:
-    pool: libvirt.virStoragePool = app["libvirt_pool"]
+    lvirt_conn: libvirt.virConnect = app["libvirt"]
     instance_id = args.get("InstanceId")
     if not instance_id:
         raise _routing.InvalidParameterError("missing required InstanceId")
     if not isinstance(instance_id, str):
         raise _routing.InvalidParameterError("invalid InstanceId value")
-    volume_id = args.get("VolumeId")
-    if not volume_id:
-        raise _routing.InvalidParameterError("missing required VolumeId")
-    if not isinstance(volume_id, str):
-        raise _routing.InvalidParameterError("invalid VolumeId value")
 
-    key = (volume_id, instance_id)
-
-    conn = pool.connect()
     try:
-        virdom = conn.lookupByName(instance_id)
+        virdom = lvirt_conn.lookupByName(instance_id)
     except libvirt.libvirtError as e:
         raise errors.InvalidInstanceID_NotFound(
             f"invalid InstanceId: {e}"
         ) from e
 
+    return await detach(app, args, virdom)
+
+
+async def detach(
+    app: _routing.App,
+    args: _routing.HandlerArgs,
+    virdom: libvirt.virDomain,
+    *,
+    attachments: Optional[Attachments] = None,
+) -> Dict[str, Any]:
+    """Detach the volume in DetachVolume *args* from domain *virdom*.
+
+    *attachments* are those of all pool volumes, if already known.
+    """
+    instance_id = virdom.name()
+    volume_id = args.get("VolumeId")
+    if not volume_id:
+        raise _routing.InvalidParameterError("missing required VolumeId")
+    if not isinstance(volume_id, str):
+        raise _routing.InvalidParameterError("invalid VolumeId value")
+
+    record = get_volume_record(app, volume_id)
+    storage_pool = get_storage_pool(app, record.pool)
     try:
-        virvol = pool.storageVolLookupByName(volume_id)
+        virvol = storage_pool.pool.storageVolLookupByName(record.volume_name)
     except libvirt.libvirtError as e:
         raise InvalidVolumeNotFound(f"invalid VolumeId: {e}") from e
 
     volume = objects.volume_from_xml(virvol.XMLDesc(0))
 
-    attachments = objects.get_vol_attachments(pool, volume)
+    if attachments is not None:
+        vol_attachments = attachments.get(volume.name, [])
+    else:
+        vol_attachments = objects.get_vol_attachments(
+            storage_pool.pool, volume
+        )
     device = None
-    for attachment in attachments:
+    for attachment in vol_attachments:
         if attachment.domain == instance_id:
             device = attachment.device
             break
 
     if device is None:
-        known = _known_attachments.get(key)
-        if not known or known[1] != "detaching":
+        known = _attachments.get_attachment(
+            app["db"], volume_id, instance_id
+        )
+        if known is None or known.state != "detaching":
             raise InvalidAttachmentNotFound(
                 f"Volume {volume_id} is not attached to Instance {instance_id}"
             )
@@ -312,126 +821,166 @@ async def detach_volume(
             return {
                 "volumeId": volume_id,
                 "instanceId": instance_id,
-                "status": known[1],
-                "device": f"/dev/{known[0]}",
+                "status": known.state,
+                "device": f"/dev/{known.device}",
             }
 
+    disk_type, source = _disk_source(storage_pool, volume)
     xml = textwrap.dedent(
         f"""\
-    <disk type='volume' device='disk'>
-        <driver name='qemu' type='qcow2'/>
-        <source pool='{pool.name()}' volume='{volume_id}' />
+    <disk type='{disk_type}' device='disk'>
+        <driver name='qemu' type='{volume.format}'/>
+        {source}
         <target dev='{device}' bus='virtio'/>
     </disk>"""
     )
 
+    async with _attachments.domain_lock(instance_id):
+        domain = objects.domain_from_xml(
+            await tasks.run_blocking(virdom.XMLDesc, 0)
+        )
+        known = _attachments.get_attachment(app["db"], volume_id, instance_id)
+        if known is not None and known.state == "detaching":
+            # Another detach of the volume got here first.
+            return {
+                "volumeId": volume_id,
+                "instanceId": instance_id,
+                "status": known.state,
+                "device": f"/dev/{known.device}",
+            }
+        with app["db"]:
+            _attachments.begin_detach(
+                app["db"],
+                volume_id,
+                instance_id,
+                device,
+                domain.disk_aliases.get(device),
+            )
+
     try:
-        virdom.detachDevice(xml)
+        with _attachments.in_flight(volume_id, instance_id):
+            await tasks.run_blocking(virdom.detachDevice, xml)
     except libvirt.libvirtError as e:
+        _attachments.set_state(app["db"], volume_id, instance_id, "attached")
         raise _routing.InternalServerError(str(e)) from e
 
-    # Give the detachment time to settle.  Alas, there seems to be
-    # no obvious way to actually verify the status of the device in the
-    # target VM.
-    dev = device
-    _known_attachments[key] = (dev, "detaching")
-
-    def _mark_detached() -> None:
-        _known_attachments[key] = (dev, "detached")
-
-    asyncio.get_running_loop().call_later(3, _mark_detached)
+    status = _attachments.track_detach(
+        app, virdom, volume_id, instance_id, device
+    )
 
     return {
         "volumeId": volume_id,
         "instanceId": instance_id,
-        "status": "detaching",
+        "status": status,
         "device": f"/dev/{device}",
     }
 
 
+def _disk_source(
+    storage_pool: placement.StoragePool,
+    volume: objects.Volume,
+) -> Tuple[str, str]:
+    """Return the disk type and <source> element to attach *volume*."""
+    if storage_pool.is_block:
+        # The device node as is, guest I/O goes straight to the LV.
+        return "block", f"<source dev='{volume.target_path}'/>"
+    else:
+        return (
+            "volume",
+            f"<source pool='{storage_pool.name}' volume='{volume.name}'/>",
+        )
+
+
 @_routing.handler("ModifyVolume")
 async def modify_volume(
     args: _routing.HandlerArgs,
     app: _routing.App,
 ) -> Dict[str, Any]:
-    lvirt_conn: libvirt.virConnect = app["libvirt"]
-    pool: libvirt.virStoragePool = app["libvirt_pool"]
     volume_id = args.get("VolumeId")
     if not volume_id:
         raise _routing.InvalidParameterError("missing required VolumeId")
     if not isinstance(volume_id, str):
         raise _routing.InvalidParameterError("invalid VolumeId value")
 
-    vol = objects.get_volume(pool, volume_id)
+    record = get_volume_record(app, volume_id)
+    if record.status != "available":
+        raise _routing.IncorrectStateError(
+            f"Volume {volume_id} is {record.status} and cannot be modified."
+        )
+    check_not_busy(volume_id)
+    snapshots.check_not_copying(volume_id)
+    if _get_active_modification(app, volume_id) is not None:
+        raise IncorrectModificationStateError(
+            f"Volume {volume_id} is already being modified."
+        )
+
+    voltype = args.get("VolumeType")
+    if voltype and voltype != record.volume_type:
+        raise _routing.InvalidParameterError(
+            "changing VolumeType is not supported"
+        )
+
+    size = _get_int_arg(args, "Size")
+    if size is None:
+        size = record.size
+    elif size < record.size:
+        raise _routing.InvalidParameterError(
+            f"Size must be at least the current size ({record.size} GiB)"
+        )
+    iops = _get_int_arg(args, "Iops")
+    if iops is None:
+        iops = record.iops
+    throughput = _get_int_arg(args, "Throughput")
+    if throughput is None:
+        throughput = record.throughput
+    old_tune = _get_record_iotune(record)
+    new_tune = _get_iotune(record.volume_type, size, iops, throughput)
+    if size > record.size:
+        profile = app["volume_profiles"].get(
+            record.volume_type, profiles.VolumeProfile()
+        )
+        await check_capacity(
+            app,
+            get_storage_pool(app, record.pool),
+            size - record.size,
+            preallocated=profile.preallocation in {"falloc", "full"},
+        )
+    # Non-standard: grow the filesystems on the volume in the guest.
+    grow_filesystem = args.get("GrowFilesystem", "false") == "true"
 
     start_time = datetime.datetime.now(datetime.timezone.utc)
-    result = {
+    modification: Dict[str, Any] = {
         "volumeId": volume_id,
         "modificationState": "modifying",
         "startTime": start_time.strftime("%Y-%m-%dT%H:%M:%S.%f000Z"),
+        "progress": 0,
+        "originalSize": record.size,
+        "targetSize": size,
+        "originalVolumeType": record.volume_type,
+        "targetVolumeType": record.volume_type,
+    }
+    if old_tune is not None:
+        modification["originalIops"] = old_tune.iops
+        modification["originalThroughput"] = old_tune.throughput
+    if new_tune is not None:
+        modification["targetIops"] = new_tune.iops
+        modification["targetThroughput"] = new_tune.throughput
+
+    params = {
+        "size": size,
+        "iops": iops,
+        "throughput": throughput,
+        "grow_filesystem": grow_filesystem,
     }
-
-    size = args.get("Size")
-    if size:
-        try:
-            size_gb = int(size)
-        except ValueError:
-            raise _routing.InvalidParameterError(
-                "invalid Size value"
-            ) from None
-
-        vol_info = _describe_volume(pool, vol)
-
-        result["originalSize"] = vol_info["size"]
-        result["targetSize"] = size_gb
-
-        if vol_info["status"] == "in-use":
-            for att in vol_info["attachmentSet"]:
-                if att["status"] == "attached":
-                    domain = lvirt_conn.lookupByName(att["instanceId"])
-                    try:
-                        domain.blockResize(
-                            os.path.basename(att["device"]),
-                            size_gb * 2**30,
-                            libvirt.VIR_DOMAIN_BLOCK_RESIZE_BYTES,
-                        )
-                    except libvirt.libvirtError as e:
-                        result["modificationState"] = "failed"
-                        result["statusMessage"] = str(e)
-                        app["logger"].exception(
-                            "could not resize attached volume"
-                        )
-
-        else:
-            try:
-                virvol = pool.storageVolLookupByName(volume_id)
-            except libvirt.libvirtError as e:
-                raise InvalidVolumeNotFound(f"invalid VolumeId: {e}") from e
-            try:
-                virvol.resize(size_gb * 2**30)
-            except libvirt.libvirtError as e:
-                result["modificationState"] = "failed"
-                result["statusMessage"] = str(e)
-                app["logger"].exception("could not resize detached volume")
-
-    end_time = datetime.datetime.now(datetime.timezone.utc)
-    result["endTime"] = end_time.strftime("%Y-%m-%dT%H:%M:%S.%f000Z")
-    result["modificationState"] = "completed"
-    result["progress"] = 100
-
     with app["db"]:
-        app["db"].execute(
-            """
-            INSERT INTO volume_modifications(id, modifications)
-            VALUES (?, ?)
-            ON CONFLICT (id)
-            DO UPDATE SET modifications = EXCLUDED.modifications
-            """,
-            (volume_id, json.dumps(result)),
+        seq = _start_modification(
+            app["db"], volume_id, "modify", modification, params
         )
 
+    _submit_modification(app, seq)
+
     return {
-        "volumeModification": result,
+        "volumeModification": modification,
     }
 
 
@@ -440,109 +989,1603 @@ async def describe_volumes_modifications(
     args: _routing.HandlerArgs,
     app: _routing.App,
 ) -> Dict[str, Any]:
-    volume_ids = args.get("VolumeId")
+    max_results = _paging.get_max_results(
+        args, DESCRIBE_MODIFICATIONS_MAX_RESULTS
+    )
+    compiled = _filters.compile_filters(
+        args.get("Filter"),
+        MODIFICATION_FILTERS,
+        resource_type="volume",
+        id_column="volume_id",
+    )
+    quals = [compiled.where]
+    params = list(compiled.params)
+
+    volume_ids = [v for v in args.get("VolumeId") or () if v]
+    if volume_ids:
+        quals.append(_filters.in_list("volume_id", volume_ids))
+        params.extend(volume_ids)
+
+    next_token = args.get("NextToken")
+    if next_token:
+        after_id, after_seq = _paging.decode_next_token(next_token, 2)
+        if not after_seq.isdigit():
+            raise _paging.InvalidNextTokenError(
+                "The specified NextToken is not valid"
+            )
+        quals.append("(volume_id > ? OR (volume_id = ? AND seq < ?))")
+        params.extend([after_id, after_id, int(after_seq)])
 
-    db_conn: sqlite3.Connection = app["db"]
-    with db_conn:
-        placeholders = ", ".join(["?"] * len(volume_ids))
-        cur = db_conn.execute(
+    # The most recent modification of a volume comes first.
+    result: List[Dict[str, Any]] = []
+    last = None
+    more = False
+    with app["db"]:
+        cur = app["db"].execute(
             f"""
-            SELECT modifications
-            FROM volume_modifications
-            WHERE id IN ({placeholders})
+                SELECT seq, volume_id, modification
+                FROM volume_modification_history
+                WHERE {" AND ".join(quals)}
+                ORDER BY volume_id, seq DESC
             """,
-            volume_ids,
+            params,
         )
-
-        result = [json.loads(row[0]) for row in cur.fetchall()]
-
-    return {
+        for seq, vol_id, data in cur:
+            modification = json.loads(data)
+            if not compiled.match(modification):
+                continue
+            if len(result) == max_results:
+                more = True
+                break
+            result.append(modification)
+            last = (vol_id, str(seq))
+
+    response: Dict[str, Any] = {
         "volumeModificationSet": result,
     }
+    if more and last is not None:
+        response["nextToken"] = _paging.encode_next_token(last)
 
+    return response
 
-def get_attachment_status(att: objects.VolumeAttachment) -> str:
-    key = (att.volume, att.domain)
-    state = _known_attachments.get(key)
-    if state is None:
-        return "attached"
-    else:
-        return state[1]
-
-
-def get_known_attachments() -> Dict[Tuple[str, str], Tuple[str, str]]:
-    return _known_attachments
 
+async def resume_volume_jobs(app: _routing.App) -> None:
+    """Resubmit volume jobs interrupted by a restart."""
+    with app["db"]:
+        cur = app["db"].execute(
+            """
+                SELECT v.id, v.size, v.status, s.image
+                FROM
+                    volumes AS v
+                    LEFT JOIN snapshots AS s ON s.id = v.snapshot_id
+                WHERE v.status IN ('creating', 'importing', 'deleting')
+            """
+        )
+        rows = cur.fetchall()
 
-def _get_volume_status(
-    pool: libvirt.virStoragePool,
-    volume: objects.Volume,
-) -> str:
-    attachments = objects.get_vol_attachments(pool, volume)
-    existing = {(att.volume, att.domain) for att in attachments}
+    for volname, size, status, image in rows:
+        if status == "creating":
+            _submit_provisioning(app, volname, size, image)
+        else:
+            # Imports cannot be resumed, their uploads are gone.
+            _submit_deletion(app, volname)
 
-    att_set = []
-    for att in attachments:
-        att_set.append(
-            {
-                "status": get_attachment_status(att),
-            }
+    with app["db"]:
+        cur = app["db"].execute(
+            """
+                SELECT seq, job
+                FROM volume_modification_history
+                WHERE state IN ('modifying', 'optimizing')
+            """
         )
+        modifications = cur.fetchall()
 
-    for (vol, dom), (_, status) in _known_attachments.items():
-        if (vol, dom) not in existing and vol == volume.name:
-            att_set.append(
-                {
-                    "status": status,
-                }
-            )
+    for seq, job in modifications:
+        if job == "modify":
+            # All steps are idempotent, just start over.
+            _submit_modification(app, seq)
+        else:
+            # Chain maintenance will get to it again.
+            modification, _ = _get_modification(app, seq)
+            modification["modificationState"] = "failed"
+            modification["statusMessage"] = "interrupted by a restart"
+            _put_modification(app, seq, modification)
 
-    if all(att["status"] == "detached" for att in att_set):
-        status = "available"
-    else:
-        status = "in-use"
 
-    return status
+def _submit_provisioning(
+    app: _routing.App,
+    volname: str,
+    size: int,
+    snapshot_image: Optional[str] = None,
+) -> None:
+    async def _job() -> None:
+        await _provision_volume(app, volname, size, snapshot_image)
 
+    app["volume_queue"].submit(_job)
 
-def _describe_volume(
+
+async def _provision_volume(
+    app: _routing.App,
+    volname: str,
+    size: int,
+    snapshot_image: Optional[str],
+) -> None:
+    record = get_volume_record(app, volname)
+    storage_pool = get_storage_pool(app, record.pool)
+    pool = storage_pool.pool
+    profile = app["volume_profiles"].get(
+        record.volume_type, profiles.VolumeProfile()
+    )
+
+    try:
+        try:
+            pool.storageVolLookupByName(volname)
+        except libvirt.libvirtError:
+            if snapshot_image is not None and storage_pool.is_block:
+                # LVs cannot be layered, so the volume is a copy of
+                # the snapshot image.
+                backing = pool.storageVolLookupByName(snapshot_image)
+                await tasks.run_blocking(
+                    pool.createXMLFrom,
+                    profiles.block_volume_xml(volname, size),
+                    backing,
+                    0,
+                )
+            elif snapshot_image is not None:
+                # A thin overlay on top of the snapshot image, which
+                # takes constant time regardless of the volume size.
+                backing = pool.storageVolLookupByName(snapshot_image)
+                backing_vol = objects.volume_from_xml(backing.XMLDesc(0))
+                await tasks.run_blocking(
+                    pool.createXML,
+                    profiles.volume_xml(
+                        volname,
+                        size,
+                        profile,
+                        backing_path=backing_vol.target_path,
+                        backing_format=backing_vol.format,
+                    ),
+                    0,
+                )
+            else:
+                await _create_storage(storage_pool, volname, size, profile)
+    except libvirt.libvirtError:
+        app["logger"].exception(f"could not create volume {volname}")
+        status = "error"
+    else:
+        status = "available"
+
+    with app["db"]:
+        app["db"].execute(
+            """
+                UPDATE volumes SET status = ?
+                WHERE id = ? AND status = 'creating'
+            """,
+            [status, volname],
+        )
+
+    if (
+        status == "available"
+        and snapshot_image
+        and app["flatten_volumes"]
+        and not storage_pool.is_block
+    ):
+        _submit_flattening(app, volname)
+
+
+async def _create_storage(
+    storage_pool: placement.StoragePool,
+    volname: str,
+    size: int,
+    profile: profiles.VolumeProfile,
+) -> None:
+    if storage_pool.is_block:
+        xml = profiles.block_volume_xml(volname, size)
+        flags = 0
+    else:
+        xml = profiles.volume_xml(volname, size, profile)
+        flags = profiles.create_flags(profile)
+    vol = await tasks.run_blocking(storage_pool.pool.createXML, xml, flags)
+    if profile.preallocation == "full":
+        await tasks.run_blocking(
+            vol.wipePattern,
+            libvirt.VIR_STORAGE_VOL_WIPE_ALG_ZERO,
+            0,
+        )
+
+
+async def fill_warm_pool(app: _routing.App) -> None:
+    """Create and remove warm volumes to match the configured counts.
+
+    Only ready warm volumes are removed, ones being provisioned are
+    left to finish.
+    """
+    db: sqlite3.Connection = app["db"]
+    specs: List[warm_pool.WarmSpec] = app["warm_volumes"]
+    wanted = {(spec.volume_type, spec.size): spec.quantity for spec in specs}
+
+    existing: Dict[Tuple[str, int], List[warm_pool.WarmVolume]] = {}
+    for warm in warm_pool.get_warm_volumes(db):
+        existing.setdefault((warm.volume_type, warm.size), []).append(warm)
+
+    for key, warm_vols in existing.items():
+        excess = len(warm_vols) - wanted.get(key, 0)
+        for warm in warm_vols:
+            if warm.status == "ready" and excess > 0:
+                with db:
+                    warm_pool.remove(db, warm.volume_name)
+                _submit_warm_deletion(app, warm)
+                excess -= 1
+            elif warm.status == "provisioning":
+                # Interrupted by a restart, or still in the queue.
+                _submit_warming(app, warm)
+
+    for spec in specs:
+        profile = app["volume_profiles"][spec.volume_type]
+        missing = spec.quantity - len(existing.get(spec[:2], []))
+        for _ in range(missing):
+            try:
+                storage_pool = await _place_volume(
+                    app,
+                    None,
+                    spec.volume_type,
+                    spec.size,
+                    preallocated=profile.preallocation in {"falloc", "full"},
+                )
+            except InsufficientVolumeCapacityError as e:
+                # Leave the space for volumes that are actually asked for.
+                app["logger"].warning(f"not filling warm pool: {e.msg}")
+                return
+            warm = warm_pool.WarmVolume(
+                f"{uuid.uuid4()}.{profile.format}",
+                spec.volume_type,
+                spec.size,
+                "provisioning",
+                storage_pool.name,
+            )
+            warm_pool.add(db, warm)
+            _submit_warming(app, warm)
+
+
+def _submit_warm_pool_fill(app: _routing.App) -> None:
+    async def _job() -> None:
+        await fill_warm_pool(app)
+
+    app["volume_queue"].submit(_job)
+
+
+def _submit_warming(app: _routing.App, warm: warm_pool.WarmVolume) -> None:
+    if warm.volume_name in _warming:
+        return
+    _warming.add(warm.volume_name)
+
+    async def _job() -> None:
+        try:
+            await _warm_volume(app, warm)
+        finally:
+            _warming.discard(warm.volume_name)
+
+    app["volume_queue"].submit(_job)
+
+
+async def _warm_volume(app: _routing.App, warm: warm_pool.WarmVolume) -> None:
+    storage_pool = get_storage_pool(app, warm.pool)
+    profile = app["volume_profiles"].get(
+        warm.volume_type, profiles.VolumeProfile()
+    )
+    try:
+        try:
+            storage_pool.pool.storageVolLookupByName(warm.volume_name)
+        except libvirt.libvirtError:
+            await _create_storage(
+                storage_pool, warm.volume_name, warm.size, profile
+            )
+    except libvirt.libvirtError:
+        app["logger"].exception(
+            f"could not create warm volume {warm.volume_name}"
+        )
+        with app["db"]:
+            warm_pool.remove(app["db"], warm.volume_name)
+        return
+
+    warm_pool.set_ready(app["db"], warm.volume_name)
+
+
+def _submit_warm_deletion(
+    app: _routing.App,
+    warm: warm_pool.WarmVolume,
+) -> None:
+    async def _job() -> None:
+        pool = get_storage_pool(app, warm.pool).pool
+        # Never handed out, so there is nothing to wipe.
+        try:
+            vol = pool.storageVolLookupByName(warm.volume_name)
+        except libvirt.libvirtError:
+            return
+        await tasks.run_blocking(vol.delete, 0)
+
+    app["volume_delete_queue"].submit(_job)
+
+
+def _submit_flattening(app: _routing.App, volume_id: str) -> None:
+    async def _job() -> None:
+        await flatten_volume(app, volume_id)
+
+    app["volume_queue"].submit(_job)
+
+
+async def flatten_volume(
+    app: _routing.App,
+    volume_id: str,
+    *,
+    bandwidth: int = 0,
+    progress: Optional[qemu_img.ProgressCallback] = None,
+) -> None:
+    """Copy all data from the backing chain into the volume's image.
+
+    Attached volumes are flattened live with a block pull limited to
+    *bandwidth* MiB/s (0 is unlimited).  *progress* is called with the
+    completion percentage.
+    """
+    lvirt_conn: libvirt.virConnect = app["libvirt"]
+
+    record = get_volume_record(app, volume_id)
+    if record.status != "available" or volume_id in _busy_volumes:
+        return
+
+    pool = get_volume_pool(app, record)
+    _busy_volumes.add(volume_id)
+    try:
+        attachments = objects.get_pool_attachments(pool)
+        atts = attachments.get(record.volume_name, [])
+        if atts:
+            for att in atts:
+                virdom = lvirt_conn.lookupByName(att.domain)
+                await _block_pull(virdom, att.device, bandwidth, progress)
+        else:
+            virvol = pool.storageVolLookupByName(record.volume_name)
+            await qemu_img.rebase(
+                virvol.path(), None, progress=progress, low_priority=True
+            )
+    finally:
+        _busy_volumes.discard(volume_id)
+
+
+class FlattenError(Exception):
+    pass
+
+
+async def _block_pull(
+    virdom: libvirt.virDomain,
+    device: str,
+    bandwidth: int,
+    progress: Optional[qemu_img.ProgressCallback],
+) -> None:
+    """Pull the backing chain of disk *device* into its image, live."""
+    await tasks.run_blocking(virdom.blockPull, device, bandwidth, 0)
+    while info := await tasks.run_blocking(virdom.blockJobInfo, device, 0):
+        if progress is not None and info["end"]:
+            progress(100 * info["cur"] / info["end"])
+        await asyncio.sleep(1)
+
+    # The job is gone whether it completed, failed or was cancelled,
+    # only the disk tells whether the chain has been pulled.
+    domain = objects.domain_from_xml(
+        await tasks.run_blocking(virdom.XMLDesc, 0)
+    )
+    disks = [d for d in domain.disks if d.target == device]
+    if not disks or disks[0].has_backing_store:
+        raise FlattenError(
+            f"block pull of {device} in {domain.name} did not complete"
+        )
+
+
+async def maintain_volume_chains(app: _routing.App) -> None:
+    """Flatten volumes whose backing chains got deeper than allowed.
+
+    Volumes are flattened one at a time, the progress is reported as
+    a volume modification.
+    """
+    max_depth = app["max_chain_depth"]
+
+    for record in _query_volumes(app, "status = 'available'", []):
+        if record.id in _busy_volumes:
+            continue
+        if _get_active_modification(app, record.id) is not None:
+            continue
+        try:
+            chain = await tasks.run_blocking(
+                objects.get_backing_chain,
+                get_volume_pool(app, record),
+                record.volume_name,
+            )
+        except libvirt.libvirtError:
+            continue
+        if len(chain) - 1 <= max_depth:
+            continue
+
+        await _optimize_volume(app, record.id, len(chain) - 1)
+
+
+async def _optimize_volume(
+    app: _routing.App,
+    volume_id: str,
+    depth: int,
+) -> None:
+    start_time = datetime.datetime.now(datetime.timezone.utc)
+    result: Dict[str, Any] = {
+        "volumeId": volume_id,
+        "modificationState": "optimizing",
+        "statusMessage": f"flattening backing chain of depth {depth}",
+        "startTime": start_time.strftime("%Y-%m-%dT%H:%M:%S.%f000Z"),
+        "progress": 0,
+    }
+    with app["db"]:
+        seq = _start_modification(app["db"], volume_id, "flatten", result)
+
+    def _progress(percent: float) -> None:
+        if int(percent) != result["progress"]:
+            result["progress"] = int(percent)
+            _put_modification(app, seq, result)
+
+    try:
+        await flatten_volume(
+            app,
+            volume_id,
+            bandwidth=app["chain_flatten_rate"],
+            progress=_progress,
+        )
+    except (libvirt.libvirtError, qemu_img.QemuImgError, FlattenError) as e:
+        app["logger"].exception(f"could not flatten volume {volume_id}")
+        result["modificationState"] = "failed"
+        result["statusMessage"] = str(e)
+    else:
+        result["modificationState"] = "completed"
+        result["progress"] = 100
+        del result["statusMessage"]
+
+    end_time = datetime.datetime.now(datetime.timezone.utc)
+    result["endTime"] = end_time.strftime("%Y-%m-%dT%H:%M:%S.%f000Z")
+    _put_modification(app, seq, result)
+
+
+async def reclaim_volume_space(app: _routing.App) -> None:
+    """Sparsify detached volumes whose images grew since the last time.
+
+    Guests free blocks without discarding them, e.g. when their
+    filesystems are not mounted with discard.  Volumes are sparsified
+    one at a time, each run is reported as a volume modification.
+    """
+    with app["db"]:
+        cur = app["db"].execute(
+            "SELECT id, sparse_allocation FROM volumes"
+            " WHERE status = 'available'"
+        )
+        baselines = dict(cur.fetchall())
+
+    for record in _query_volumes(app, "status = 'available'", []):
+        if record.id in _busy_volumes:
+            continue
+        if _get_active_modification(app, record.id) is not None:
+            continue
+        profile = app["volume_profiles"].get(
+            record.volume_type, profiles.VolumeProfile()
+        )
+        storage_pool = get_storage_pool(app, record.pool)
+        if (
+            profile.preallocation in {"falloc", "full"}
+            or storage_pool.is_block
+        ):
+            continue
+        pool = storage_pool.pool
+        try:
+            virvol = pool.storageVolLookupByName(record.volume_name)
+            allocation = virvol.info()[2]
+        except libvirt.libvirtError:
+            continue
+        if allocation - (baselines.get(record.id) or 0) < RECLAIM_MIN_GROWTH:
+            continue
+        if objects.get_pool_attachments(pool).get(record.volume_name):
+            continue
+
+        await _sparsify_volume(app, record.id, virvol, allocation)
+
+
+async def _sparsify_volume(
+    app: _routing.App,
+    volume_id: str,
+    virvol: libvirt.virStorageVol,
+    allocation: int,
+) -> None:
+    start_time = datetime.datetime.now(datetime.timezone.utc)
+    result: Dict[str, Any] = {
+        "volumeId": volume_id,
+        "modificationState": "optimizing",
+        "statusMessage": "reclaiming unused space",
+        "startTime": start_time.strftime("%Y-%m-%dT%H:%M:%S.%f000Z"),
+        "progress": 0,
+    }
+    with app["db"]:
+        seq = _start_modification(app["db"], volume_id, "sparsify", result)
+
+    # The image must not be attached or rewritten while it is sparsified.
+    _busy_volumes.add(volume_id)
+    try:
+        volume = objects.volume_from_xml(virvol.XMLDesc(0))
+        await sparsify.sparsify_in_place(
+            volume.target_path, fmt=volume.format
+        )
+        new_allocation = (await tasks.run_blocking(virvol.info))[2]
+    except (libvirt.libvirtError, sparsify.SparsifyError) as e:
+        app["logger"].exception(f"could not sparsify volume {volume_id}")
+        result["modificationState"] = "failed"
+        result["statusMessage"] = str(e)
+        # Don't try again until the volume grows further.
+        new_allocation = allocation
+    else:
+        reclaimed = max(allocation - new_allocation, 0)
+        app["logger"].info(
+            f"reclaimed {reclaimed} bytes from volume {volume_id}"
+        )
+        app["metrics"].put(
+            (volume_id, "VolumeReclaimedBytes"), time.time(), reclaimed
+        )
+        result["modificationState"] = "completed"
+        result["progress"] = 100
+        # Non-standard.
+        result["reclaimedBytes"] = reclaimed
+        del result["statusMessage"]
+    finally:
+        _busy_volumes.discard(volume_id)
+
+    with app["db"]:
+        app["db"].execute(
+            "UPDATE volumes SET sparse_allocation = ? WHERE id = ?",
+            [new_allocation, volume_id],
+        )
+
+    end_time = datetime.datetime.now(datetime.timezone.utc)
+    result["endTime"] = end_time.strftime("%Y-%m-%dT%H:%M:%S.%f000Z")
+    _put_modification(app, seq, result)
+
+
+def _submit_modification(app: _routing.App, seq: int) -> None:
+    async def _job() -> None:
+        await _modify_volume(app, seq)
+
+    app["volume_queue"].submit(_job)
+
+
+async def _modify_volume(app: _routing.App, seq: int) -> None:
+    lvirt_conn: libvirt.virConnect = app["libvirt"]
+
+    modification, params = _get_modification(app, seq)
+    volume_id = modification["volumeId"]
+    try:
+        record = get_volume_record(app, volume_id)
+        target = record._replace(
+            size=params["size"],
+            iops=params["iops"],
+            throughput=params["throughput"],
+        )
+        profile = app["volume_profiles"].get(
+            record.volume_type, profiles.VolumeProfile()
+        )
+        tune = _get_record_iotune(target)
+
+        (vol_info,) = _describe_volumes(app, [record])
+        attached = [
+            (
+                lvirt_conn.lookupByName(att["instanceId"]),
+                att["device"][len("/dev/") :],
+            )
+            for att in vol_info["attachmentSet"]
+            if att["status"] == "attached"
+        ]
+
+        # Progress is the share of the steps below that are done.
+        resize = target.size != record.size
+        retune = tune != _get_record_iotune(record) and bool(attached)
+        grow = params["grow_filesystem"] and bool(attached)
+        steps = max(int(resize) + int(retune) + int(grow), 1)
+        done = 0
+
+        def _step_done() -> None:
+            nonlocal done
+            done += 1
+            modification["progress"] = 100 * done // steps
+            _put_modification(app, seq, modification)
+
+        # Nothing else may rewrite the image while it is being resized.
+        check_not_busy(volume_id)
+        _busy_volumes.add(volume_id)
+        try:
+            if resize:
+                size = target.size * 2**30
+                storage_pool = get_storage_pool(app, record.pool)
+                if storage_pool.is_block:
+                    # qemu cannot grow a block device, the LV has to
+                    # grow before the guest is told.
+                    virvol = storage_pool.pool.storageVolLookupByName(
+                        record.volume_name
+                    )
+                    await tasks.run_blocking(virvol.resize, size, 0)
+                if attached:
+                    for virdom, device in attached:
+                        await tasks.run_blocking(
+                            virdom.blockResize,
+                            device,
+                            size,
+                            int(libvirt.VIR_DOMAIN_BLOCK_RESIZE_BYTES),
+                        )
+                elif not storage_pool.is_block:
+                    pool = storage_pool.pool
+                    virvol = pool.storageVolLookupByName(record.volume_name)
+                    flags = 0
+                    if profile.preallocation in {"falloc", "full"}:
+                        flags = int(libvirt.VIR_STORAGE_VOL_RESIZE_ALLOCATE)
+                    await tasks.run_blocking(virvol.resize, size, flags)
+                _step_done()
+
+            if retune and tune is not None:
+                for virdom, device in attached:
+                    await tasks.run_blocking(
+                        virdom.setBlockIoTune,
+                        device,
+                        tune.to_params(),
+                        int(libvirt.VIR_DOMAIN_AFFECT_LIVE),
+                    )
+                _step_done()
+        finally:
+            _busy_volumes.discard(volume_id)
+
+        # The new configuration is in effect.
+        with app["db"]:
+            app["db"].execute(
+                """
+                    UPDATE volumes SET size = ?, iops = ?, throughput = ?
+                    WHERE id = ?
+                """,
+                [target.size, target.iops, target.throughput, volume_id],
+            )
+        modification["modificationState"] = "optimizing"
+        _put_modification(app, seq, modification)
+
+        if grow:
+            try:
+                for virdom, device in attached:
+                    await _grow_filesystems(virdom, device)
+            except (
+                libvirt.libvirtError,
+                asyncio.TimeoutError,
+                GuestCommandError,
+            ) as e:
+                # The volume itself has been modified all the same.
+                app["logger"].warning(
+                    f"could not grow filesystems on volume {volume_id}: {e}"
+                )
+                modification["statusMessage"] = (
+                    f"could not grow filesystem: {e}"
+                )
+    except Exception as e:
+        # Whatever went wrong, the modification must not be left
+        # in progress forever.
+        app["logger"].exception(f"could not modify volume {volume_id}")
+        modification["modificationState"] = "failed"
+        modification["statusMessage"] = str(e)
+    else:
+        modification["modificationState"] = "completed"
+        modification["progress"] = 100
+
+    end_time = datetime.datetime.now(datetime.timezone.utc)
+    modification["endTime"] = end_time.strftime("%Y-%m-%dT%H:%M:%S.%f000Z")
+    _put_modification(app, seq, modification)
+
+
+class GuestCommandError(Exception):
+    pass
+
+
+async def _grow_filesystems(virdom: libvirt.virDomain, device: str) -> None:
+    """Grow filesystems on the disk *device* to its size, in the guest."""
+    serial = f"lvirtebs-{device}"
+    disks: Any = await qemu.agent_command(
+        virdom, {"execute": "guest-get-disks"}
+    )
+    disk_names = [
+        d["name"]
+        for d in disks
+        if not d.get("partition")
+        and _attachments.get_disk_serial(d) == serial
+    ]
+    if not disk_names:
+        raise GuestCommandError(f"the guest does not see {device}")
+    disk_name = disk_names[0]
+
+    fsinfo: Any = await qemu.agent_command(
+        virdom, {"execute": "guest-get-fsinfo"}
+    )
+    for fs in fsinfo:
+        devs = [
+            d.get("dev") or f"/dev/{fs['name']}"
+            for d in fs.get("disk") or ()
+            if _attachments.get_disk_serial(d) == serial
+        ]
+        if not devs:
+            continue
+        fs_dev = devs[0]
+        if fs_dev != disk_name:
+            # The filesystem is on a partition, which must grow first.
+            match = re.search(r"(\d+)$", fs_dev)
+            if match is not None:
+                # growpart exits with 1 if the partition is as large
+                # as it can be already.
+                await _guest_run(
+                    virdom,
+                    ["growpart", disk_name, match.group(1)],
+                    ok_codes=(0, 1),
+                )
+
+        command = GROW_FS_COMMANDS.get(fs["type"])
+        if command is None:
+            raise GuestCommandError(
+                f"growing {fs['type']} filesystems is not supported"
+            )
+        await _guest_run(
+            virdom,
+            [
+                arg.format(device=fs_dev, mountpoint=fs["mountpoint"])
+                for arg in command
+            ],
+        )
+
+
+async def _guest_run(
+    virdom: libvirt.virDomain,
+    args: List[str],
+    *,
+    ok_codes: Tuple[int, ...] = (0,),
+) -> None:
+    proc = await qemu.agent_exec(
+        virdom, args, timeout_sec=GUEST_COMMAND_TIMEOUT
+    )
+    if proc.returncode not in ok_codes:
+        stderr = proc.stderr.read().decode(errors="replace").strip()
+        raise GuestCommandError(
+            f"{args[0]} exited with {proc.returncode}: {stderr}"
+        )
+
+
+def _start_modification(
+    db: sqlite3.Connection,
+    volume_id: str,
+    job: str,
+    modification: Dict[str, Any],
+    params: Optional[Dict[str, Any]] = None,
+) -> int:
+    """Record a new modification.  Must be called inside a transaction."""
+    cur = db.execute(
+        """
+            INSERT INTO volume_modification_history
+                (volume_id, job, state, start_time, modification, params)
+            VALUES (?, ?, ?, ?, ?, ?)
+        """,
+        [
+            volume_id,
+            job,
+            modification["modificationState"],
+            modification["startTime"],
+            json.dumps(modification),
+            json.dumps(params or {}),
+        ],
+    )
+    assert cur.lastrowid is not None
+    return cur.lastrowid
+
+
+def _put_modification(
+    app: _routing.App,
+    seq: int,
+    modification: Dict[str, Any],
+) -> None:
+    with app["db"]:
+        app["db"].execute(
+            """
+                UPDATE volume_modification_history
+                SET state = ?, modification = ?
+                WHERE seq = ?
+            """,
+            [
+                modification["modificationState"],
+                json.dumps(modification),
+                seq,
+            ],
+        )
+
+
+def _get_modification(
+    app: _routing.App,
+    seq: int,
+) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+    with app["db"]:
+        cur = app["db"].execute(
+            """
+                SELECT modification, params
+                FROM volume_modification_history
+                WHERE seq = ?
+            """,
+            [seq],
+        )
+        modification, params = cur.fetchone()
+    return json.loads(modification), json.loads(params)
+
+
+def _get_active_modification(
+    app: _routing.App,
+    volume_id: str,
+) -> Optional[int]:
+    with app["db"]:
+        cur = app["db"].execute(
+            """
+                SELECT seq
+                FROM volume_modification_history
+                WHERE
+                    volume_id = ?
+                    AND state IN ('modifying', 'optimizing')
+            """,
+            [volume_id],
+        )
+        row = cur.fetchone()
+    return row[0] if row else None
+
+
+def get_storage_pools(app: _routing.App) -> List[placement.StoragePool]:
+    return list(app["storage_pools"].values())
+
+
+def get_storage_pool(
+    app: _routing.App,
+    name: Optional[str] = None,
+) -> placement.StoragePool:
+    """Return the configured storage pool *name*, the first one if None."""
+    pools: Dict[str, placement.StoragePool] = app["storage_pools"]
+    if name is None:
+        return next(iter(pools.values()))
+    try:
+        return pools[name]
+    except KeyError:
+        raise _routing.InternalServerError(
+            f"storage pool {name} is not configured"
+        ) from None
+
+
+def get_volume_pool(
+    app: _routing.App,
+    record: VolumeRecord,
+) -> libvirt.virStoragePool:
+    """Return the libvirt pool holding the images of volume *record*."""
+    return get_storage_pool(app, record.pool).pool
+
+
+def get_libvirt_pools(app: _routing.App) -> List[libvirt.virStoragePool]:
+    return [p.pool for p in get_storage_pools(app)]
+
+
+async def assign_default_pool(app: _routing.App) -> None:
+    """Record volumes from before multiple pools as in the first pool."""
+    name = get_storage_pool(app).name
+    with app["db"]:
+        for table in ("volumes", "snapshots", "warm_volumes"):
+            app["db"].execute(
+                f"UPDATE {table} SET pool = ? WHERE pool IS NULL",
+                [name],
+            )
+
+
+async def _place_volume(
+    app: _routing.App,
+    zone: Optional[str],
+    volume_type: str,
+    size: int,
+    *,
+    preallocated: bool,
+    allow_block: bool = True,
+) -> placement.StoragePool:
+    """Pick a storage pool for a new volume and admit *size* GiB to it.
+
+    Pools are tried in the order of the placement policy among those
+    serving *zone* and *volume_type*, and if not *allow_block*, taking
+    image files.
+    """
+    eligible = [
+        p
+        for p in get_storage_pools(app)
+        if p.accepts(zone, volume_type) and (allow_block or not p.is_block)
+    ]
+    if not eligible:
+        raise _routing.InvalidParameterError(
+            f"no storage pool serves {volume_type} volumes in {zone}"
+        )
+    for storage_pool in eligible:
+        if storage_pool.accountant.capacity is None:
+            await tasks.run_blocking(storage_pool.accountant.refresh)
+
+    policy = app["volume_placement"]
+    provisioned = get_provisioned_sizes(app)
+    ranked = placement.rank_pools(
+        eligible,
+        policy=policy,
+        provisioned={k: v * 2**30 for k, v in provisioned.items()},
+        load=get_pool_load(app) if policy == "load" else None,
+    )
+    error = None
+    for storage_pool in ranked:
+        try:
+            await check_capacity(
+                app, storage_pool, size, preallocated=preallocated
+            )
+        except InsufficientVolumeCapacityError as e:
+            error = e
+        else:
+            return storage_pool
+    assert error is not None
+    raise error
+
+
+async def check_capacity(
+    app: _routing.App,
+    storage_pool: placement.StoragePool,
+    size: int,
+    *,
+    preallocated: bool,
+) -> None:
+    """Raise InsufficientVolumeCapacityError unless *size* GiB fit the pool.
+
+    Must be followed by recording the new storage in the inventory
+    without yielding to the event loop.
+    """
+    accountant = storage_pool.accountant
+    if accountant.capacity is None:
+        await tasks.run_blocking(accountant.refresh)
+    try:
+        accountant.admit(
+            get_provisioned_size(app, storage_pool.name) * 2**30,
+            size * 2**30,
+            # Block volumes are always fully allocated.
+            preallocated=preallocated or storage_pool.is_block,
+        )
+    except capacity.CapacityError as e:
+        raise InsufficientVolumeCapacityError(
+            f"There is not enough capacity to fulfill your request: {e}."
+        ) from None
+
+
+def get_provisioned_sizes(app: _routing.App) -> Dict[str, int]:
+    """Map storage pools to GiB promised to volumes in them.
+
+    Includes pending growth of volumes being modified.
+    """
+    default = get_storage_pool(app).name
+    with app["db"]:
+        cur = app["db"].execute(
+            """
+                SELECT coalesce(pool, ?), coalesce(sum(size), 0)
+                FROM (
+                    SELECT pool, size
+                    FROM volumes
+                    WHERE status != 'error'
+                    UNION ALL
+                    SELECT pool, size FROM warm_volumes
+                    UNION ALL
+                    SELECT
+                        v.pool,
+                        max(json_extract(m.params, '$.size') - v.size, 0)
+                    FROM
+                        volume_modification_history AS m
+                        INNER JOIN volumes AS v ON v.id = m.volume_id
+                    WHERE
+                        m.job = 'modify'
+                        AND m.state IN ('modifying', 'optimizing')
+                )
+                GROUP BY 1
+            """,
+            [default],
+        )
+        return {pool: int(size) for pool, size in cur.fetchall()}
+
+
+def get_provisioned_size(app: _routing.App, pool: str) -> int:
+    """Return the GiB promised to volumes in *pool*."""
+    return get_provisioned_sizes(app).get(pool, 0)
+
+
+def get_pool_load(app: _routing.App) -> Dict[str, float]:
+    """Map storage pools to their recent volume I/O in bytes per second."""
+    store: metrics.MetricStore = app["pool_metrics"]
+    window = 5 * store.interval
+    now = time.time()
+    load = {}
+    for storage_pool in get_storage_pools(app):
+        total = 0.0
+        for name in POOL_LOAD_METRICS:
+            series = store.get((storage_pool.name, name))
+            if series is None:
+                continue
+            for dp in series.query(now - window, now, window):
+                total += dp.sum
+        load[storage_pool.name] = total / window
+    return load
+
+
+def get_volume_pools(app: _routing.App) -> Dict[str, str]:
+    """Map volume ids to the names of the pools holding them."""
+    default = get_storage_pool(app).name
+    with app["db"]:
+        cur = app["db"].execute("SELECT id, pool FROM volumes")
+        return {id: pool or default for id, pool in cur.fetchall()}
+
+
+async def refresh_pool_capacity(app: _routing.App) -> None:
+    """Sample the storage usage of the pools and record it as metrics."""
+    for storage_pool in get_storage_pools(app):
+        accountant = storage_pool.accountant
+        await tasks.run_blocking(accountant.refresh)
+        usage = accountant.usage(
+            get_provisioned_size(app, storage_pool.name) * 2**30
+        )
+        now = time.time()
+        for name, value in capacity.usage_metrics(usage).items():
+            app["pool_metrics"].put((storage_pool.name, name), now, value)
+
+
+def check_not_busy(volume_id: str) -> None:
+    """Raise IncorrectStateError if the volume's image is in use by a job."""
+    if volume_id in _busy_volumes:
+        raise _routing.IncorrectStateError(
+            f"Volume {volume_id} is busy, try again later."
+        )
+
+
+def _submit_deletion(app: _routing.App, volname: str) -> None:
+    async def _job() -> None:
+        await _delete_volume(app, volname)
+
+    app["volume_delete_queue"].submit(_job)
+
+
+async def _delete_volume(app: _routing.App, volname: str) -> None:
+    record = get_volume_record(app, volname)
+    pool = get_volume_pool(app, record)
+
+    # Only the active image belongs to the volume, the rest of its
+    # backing chain are snapshots, which outlive it.
+    try:
+        vol = pool.storageVolLookupByName(record.volume_name)
+    except libvirt.libvirtError:
+        # Already gone, or failed to provision in the first place.
+        pass
+    else:
+        try:
+            await _wipe_volume(app, vol)
+        except (libvirt.libvirtError, qemu_img.QemuImgError):
+            app["logger"].exception(f"could not wipe volume {volname}")
+        try:
+            await tasks.run_blocking(vol.delete, 0)
+        except libvirt.libvirtError:
+            # Retrying would most likely fail the same way on every
+            # restart.  The image turns up as a volume again on the
+            # next inventory sync and can be deleted once fixed.
+            app["logger"].exception(f"could not delete volume {volname}")
+
+    with app["db"]:
+        app["db"].execute("DELETE FROM volumes WHERE id = ?", [volname])
+        _tags.delete_resource_tags(app["db"], [(volname, "volume")])
+
+    await snapshots.collect_garbage(app)
+
+
+async def _wipe_volume(
+    app: _routing.App,
+    vol: libvirt.virStorageVol,
+) -> None:
+    algorithm = app["volume_wipe"]
+    rate = app["volume_wipe_rate"]
+    if algorithm == "none":
+        return
+    elif algorithm != "zero" or not rate:
+        await tasks.run_blocking(
+            vol.wipePattern, WIPE_ALGORITHMS[algorithm], 0
+        )
+        return
+
+    # libvirt wipes a volume in one go as fast as the disk allows,
+    # so zero it in chunks instead, sleeping between them to stay
+    # under the configured rate.  Holes are skipped: writing zeros
+    # into them would allocate storage just to free it again.
+    loop = asyncio.get_running_loop()
+    zeros = bytes(WIPE_CHUNK_SIZE)
+    for start, end in await _get_allocated_ranges(vol):
+        offset = start
+        while offset < end:
+            chunk = zeros[: min(WIPE_CHUNK_SIZE, end - offset)]
+            started = loop.time()
+            await tasks.run_blocking(_upload, vol, offset, chunk)
+            offset += len(chunk)
+            delay = len(chunk) / rate - (loop.time() - started)
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+
+async def _get_allocated_ranges(
+    vol: libvirt.virStorageVol,
+) -> List[Tuple[int, int]]:
+    """Return the (start, end) byte ranges of *vol* holding data.
+
+    The ranges are of the file or device itself, whatever the format
+    of the image in it.
+    """
+    path = await tasks.run_blocking(vol.path)
+    length = (
+        await tasks.run_blocking(
+            vol.infoFlags, libvirt.VIR_STORAGE_VOL_GET_PHYSICAL
+        )
+    )[2]
+    extents = await qemu_img.map_extents(path, length=length, fmt="raw")
+    return [
+        (e.start, e.start + e.length)
+        for e in extents
+        if e.data and e.depth == 0
+    ]
+
+
+def _upload(vol: libvirt.virStorageVol, offset: int, data: bytes) -> None:
+    stream = vol.connect().newStream(0)
+    vol.upload(stream, offset, len(data), 0)
+    try:
+        _send_all(stream, data)
+    except BaseException:
+        stream.abort()
+        raise
+    else:
+        stream.finish()
+
+
+def _send_all(stream: libvirt.virStream, data: bytes) -> None:
+    pos = 0
+    while pos < len(data):
+        pos += stream.send(data[pos:])
+
+
+async def _import_image(
     pool: libvirt.virStoragePool,
-    volume: objects.Volume,
+    volname: str,
+    content: aiohttp.StreamReader,
+    fmt: str,
+    size: Optional[int],
+) -> int:
+    """Stream the image in *content* into new volume *volname*.
+
+    Return the volume size in GiB.  The image is checked to be a
+    standalone image of format *fmt*, as it is going to be opened as
+    one.
+    """
+    # An empty file, which the upload fills in whatever format.
+    vol = await tasks.run_blocking(
+        pool.createXML,
+        profiles.volume_xml(
+            volname,
+            0,
+            profiles.VolumeProfile(format="raw", preallocation="off"),
+        ),
+        0,
+    )
+
+    stream = vol.connect().newStream(0)
+    await tasks.run_blocking(
+        vol.upload,
+        stream,
+        0,
+        0,
+        libvirt.VIR_STORAGE_VOL_UPLOAD_SPARSE_STREAM,
+    )
+    limit = size * 2**30 if size is not None else None
+    length = 0
+    try:
+        # Only a chunk is held at a time: the body is not read on
+        # until the chunk is sent, and aiohttp stops reading from the
+        # socket while its buffer is full.
+        while chunk := await _read_chunk(content, TRANSFER_CHUNK_SIZE):
+            length += len(chunk)
+            if limit is not None and length > limit:
+                raise _routing.InvalidParameterError(
+                    f"The image is larger than {size} GiB."
+                )
+            if chunk.count(0) == len(chunk):
+                await tasks.run_blocking(stream.sendHole, len(chunk), 0)
+            else:
+                await tasks.run_blocking(_send_all, stream, chunk)
+    except BaseException:
+        stream.abort()
+        raise
+    await tasks.run_blocking(stream.finish)
+
+    volume = objects.volume_from_xml(vol.XMLDesc(0))
+    try:
+        info = await qemu_img.info(volume.target_path)
+    except qemu_img.QemuImgError as e:
+        raise _routing.InvalidParameterError(str(e)) from None
+    if info.format != fmt:
+        raise _routing.InvalidParameterError(
+            f"The image is in {info.format} format, not {fmt}."
+        )
+    if info.backing_filename is not None:
+        raise _routing.InvalidParameterError(
+            "Images with a backing file cannot be imported."
+        )
+    if info.data_file is not None:
+        raise _routing.InvalidParameterError(
+            "Images with an external data file cannot be imported."
+        )
+
+    image_size = max(math.ceil(info.virtual_size / 2**30), 1)
+    if size is None:
+        size = image_size
+    elif size < image_size:
+        raise _routing.InvalidParameterError(
+            f"The image is larger than {size} GiB."
+        )
+
+    # Have libvirt pick up the format and size of the image.
+    await tasks.run_blocking(pool.refresh, 0)
+    vol = pool.storageVolLookupByName(volname)
+    if objects.volume_from_xml(vol.XMLDesc(0)).format != fmt:
+        raise _routing.InternalServerError(
+            f"libvirt does not see volume {volname} as {fmt}"
+        )
+    if info.virtual_size < size * 2**30:
+        await tasks.run_blocking(vol.resize, size * 2**30, 0)
+
+    return size
+
+
+async def _import_block_image(
+    pool: libvirt.virStoragePool,
+    volname: str,
+    content: aiohttp.StreamReader,
+    size: int,
+) -> None:
+    """Copy the raw image in *content* into new block volume *volname*."""
+    vol = await tasks.run_blocking(
+        pool.createXML, profiles.block_volume_xml(volname, size), 0
+    )
+    stream = vol.connect().newStream(0)
+    # Block devices take no holes, the zeros are written out.
+    await tasks.run_blocking(vol.upload, stream, 0, 0, 0)
+    limit = size * 2**30
+    length = 0
+    try:
+        while chunk := await _read_chunk(content, TRANSFER_CHUNK_SIZE):
+            length += len(chunk)
+            if length > limit:
+                raise _routing.InvalidParameterError(
+                    f"The image is larger than {size} GiB."
+                )
+            await tasks.run_blocking(_send_all, stream, chunk)
+    except BaseException:
+        stream.abort()
+        raise
+    await tasks.run_blocking(stream.finish)
+
+
+async def _read_chunk(content: aiohttp.StreamReader, size: int) -> bytes:
+    """Read *size* bytes from *content*, or what is left of it."""
+    try:
+        return await content.readexactly(size)
+    except asyncio.IncompleteReadError as e:
+        return e.partial
+
+
+async def _send_image(
+    stream: libvirt.virStream,
+    response: web.StreamResponse,
+) -> None:
+    """Copy the data of a download *stream* into *response*."""
+    zeros = memoryview(bytes(TRANSFER_CHUNK_SIZE))
+    while True:
+        data = await tasks.run_blocking(
+            stream.recvFlags,
+            TRANSFER_CHUNK_SIZE,
+            libvirt.VIR_STREAM_RECV_STOP_AT_HOLE,
+        )
+        if data == -3:
+            # A hole, which does not have to be read from disk but
+            # still has to go out as zeros.
+            hole = await tasks.run_blocking(stream.recvHole, 0)
+            while hole > 0:
+                n = min(hole, TRANSFER_CHUNK_SIZE)
+                await response.write(zeros[:n])
+                hole -= n
+        elif not data:
+            break
+        else:
+            # write() waits for the transport to drain, so a slow
+            # client slows down the download.
+            await response.write(data)
+
+
+def _get_int_arg(args: _routing.HandlerArgs, name: str) -> Optional[int]:
+    value = args.get(name)
+    if not value:
+        return None
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        raise _routing.InvalidParameterError(
+            f"invalid {name} value"
+        ) from None
+
+
+def _get_iotune(
+    volume_type: str,
+    size: int,
+    iops: Optional[int],
+    throughput: Optional[int],
+) -> Optional[iotune.IoTune]:
+    try:
+        return iotune.get_iotune(
+            volume_type, size, iops=iops, throughput=throughput
+        )
+    except ValueError as e:
+        raise _routing.InvalidParameterError(str(e)) from None
+
+
+def _get_record_iotune(record: VolumeRecord) -> Optional[iotune.IoTune]:
+    try:
+        return iotune.get_iotune(
+            record.volume_type,
+            record.size,
+            iops=record.iops,
+            throughput=record.throughput,
+        )
+    except ValueError:
+        # Not supposed to happen, but an unthrottled volume is better
+        # than one that cannot be attached.
+        return None
+
+
+_DRIVER_PARAMS = {
+    "Cache": "cache",
+    "Io": "io",
+    "Iothread": "iothread",
+    "Queues": "queues",
+    "Discard": "discard",
+    "DetectZeroes": "detect_zeroes",
+}
+
+
+def _get_driver_options(
+    params: Any,
+    defaults: profiles.DriverOptions,
+) -> profiles.DriverOptions:
+    # Driver.Cache, Driver.Io etc. override the volume type defaults.
+    params = params or {}
+    if not isinstance(params, dict):
+        raise _routing.InvalidParameterError("invalid Driver value")
+    unknown = set(params) - set(_DRIVER_PARAMS)
+    if unknown:
+        raise _routing.InvalidParameterError(
+            f"unsupported Driver parameters: {', '.join(sorted(unknown))}"
+        )
+    try:
+        return profiles.make_driver_options(
+            defaults,
+            {_DRIVER_PARAMS[k]: v for k, v in params.items()},
+        )
+    except ValueError as e:
+        raise _routing.InvalidParameterError(str(e)) from None
+
+
+def _describe_volume(
+    record: VolumeRecord,
+    attachments: List[objects.VolumeAttachment],
+    tags: Dict[str, str],
+    known: Mapping[Tuple[str, str], _attachments.AttachmentRecord],
 ) -> Dict[str, Any]:
-    attachments = objects.get_vol_attachments(pool, volume)
-    existing = {(att.volume, att.domain) for att in attachments}
+    existing = {(record.id, att.domain) for att in attachments}
 
     att_set = []
     for att in attachments:
+        # Disks attached by other means than AttachVolume have no
+        # record and are just attached.
+        rec = known.get((record.id, att.domain))
         att_set.append(
             {
                 "instanceId": att.domain,
-                "volumeId": att.volume,
+                "volumeId": record.id,
                 "device": f"/dev/{att.device}",
-                "status": get_attachment_status(att),
+                "status": rec.state if rec is not None else "attached",
+                "driverOptions": rec.driver_options if rec else {},
             }
         )
 
-    for (vol, dom), (device, status) in _known_attachments.items():
-        if (vol, dom) not in existing and vol == volume.name:
+    for (vol, dom), rec in known.items():
+        if (vol, dom) not in existing and vol == record.id:
             att_set.append(
                 {
                     "instanceId": dom,
                     "volumeId": vol,
-                    "device": f"/dev/{device}",
-                    "status": status,
+                    "device": f"/dev/{rec.device}",
+                    "status": rec.state,
                 }
             )
 
-    if all(att["status"] == "detached" for att in att_set):
+    if record.status == "importing":
+        status = "creating"
+    elif record.status != "available":
+        status = record.status
+    elif all(att["status"] == "detached" for att in att_set):
         status = "available"
     else:
         status = "in-use"
 
-    return {
-        "volumeId": volume.name,
-        "volumeType": "standard",
-        "size": volume.capacity // 1073741824,
+    result: Dict[str, Any] = {
+        "volumeId": record.id,
+        "volumeType": record.volume_type,
+        "size": record.size,
+        "availabilityZone": record.availability_zone,
+        "createTime": record.create_time,
+        "snapshotId": record.snapshot_id or "",
         "status": status,
         "attachmentSet": att_set,
+        "tagSet": [{"key": k, "value": v} for k, v in tags.items()],
+    }
+
+    tune = _get_record_iotune(record)
+    if tune is not None:
+        result["iops"] = tune.iops
+        result["throughput"] = tune.throughput
+
+    return result
+
+
+def get_attachments(app: _routing.App) -> Attachments:
+    """Return attachments of all volumes in the pools by volume name."""
+    return objects.get_pools_attachments(get_libvirt_pools(app))
+
+
+def _describe_volumes(
+    app: _routing.App,
+    records: List[VolumeRecord],
+    *,
+    attachments: Optional[Attachments] = None,
+) -> List[Dict[str, Any]]:
+    if not records:
+        return []
+
+    if attachments is None:
+        attachments = get_attachments(app)
+    ids = [r.id for r in records]
+    tags = _tags.get_resource_tags(app["db"], "volume", ids)
+    known = {
+        (a.volume_id, a.instance_id): a
+        for a in _attachments.get_attachments(app["db"], volume_ids=ids)
+    }
+
+    return [
+        _describe_volume(
+            r, attachments.get(r.volume_name, []), tags[r.id], known
+        )
+        for r in records
+    ]
+
+
+def _query_volumes(
+    app: _routing.App,
+    where: str,
+    params: List[Any],
+) -> List[VolumeRecord]:
+    with app["db"]:
+        cur = app["db"].execute(
+            f"""
+                SELECT {", ".join(VolumeRecord._fields)}
+                FROM volumes
+                WHERE {where}
+                ORDER BY id
+            """,
+            params,
+        )
+        return [VolumeRecord(*row) for row in cur.fetchall()]
+
+
+def get_volume_ids(app: _routing.App) -> Dict[str, str]:
+    """Map names of libvirt volumes holding active images to volume ids."""
+    with app["db"]:
+        cur = app["db"].execute("SELECT volume_name, id FROM volumes")
+        return dict(cur.fetchall())
+
+
+def get_volume_record(app: _routing.App, volume_id: str) -> VolumeRecord:
+    """Return the inventory record of volume *volume_id*."""
+    records = _query_volumes(app, "id = ?", [volume_id])
+    if not records:
+        _sync_inventory(app)
+        records = _query_volumes(app, "id = ?", [volume_id])
+        if not records:
+            raise InvalidVolumeNotFound(
+                f"The volume '{volume_id}' does not exist."
+            )
+    return records[0]
+
+
+def _sync_inventory(app: _routing.App) -> None:
+    """Reconcile the volume inventory with the volumes in the pools.
+
+    Picks up volumes created or removed behind our back.  Only the
+    volume names are listed, XML is fetched for new volumes only.
+    """
+    db: sqlite3.Connection = app["db"]
+
+    # Volume name -> pool
+    names = {
+        name: storage_pool
+        for storage_pool in get_storage_pools(app)
+        for name in storage_pool.pool.listVolumes()
+    }
+    with db:
+        cur = db.execute("SELECT id, volume_name, status FROM volumes")
+        rows = cur.fetchall()
+        cur = db.execute("SELECT image FROM snapshots")
+        images = {row[0] for row in cur.fetchall()}
+        cur = db.execute("SELECT volume_name FROM warm_volumes")
+        images.update(row[0] for row in cur.fetchall())
+
+    known = {name for _, name, _ in rows} | {id for id, _, _ in rows}
+    # Volumes that are being provisioned or failed to provision
+    # legitimately have no storage.
+    gone = {
+        id
+        for id, name, status in rows
+        if status == "available" and name not in names
     }
+    missing = names.keys() - known - images
+    if not missing and not gone:
+        return
+
+    new_records = []
+    for name in missing:
+        storage_pool = names[name]
+        if storage_pool.is_block and not VOLUME_NAME_RE.match(name):
+            # Volume groups commonly hold the host's own LVs, which
+            # must not become volumes that can be deleted.
+            continue
+        try:
+            virvol = storage_pool.pool.storageVolLookupByName(name)
+            volume = objects.volume_from_xml(virvol.XMLDesc(0))
+        except libvirt.libvirtError:
+            continue
+        new_records.append(
+            (
+                name,
+                f"{app['region']}a",
+                "standard",
+                volume.capacity // 2**30,
+                name,
+                storage_pool.name,
+            )
+        )
+
+    with db:
+        db.executemany(
+            """
+                INSERT OR IGNORE INTO volumes
+                    (id, availability_zone, volume_type, size, volume_name,
+                     pool)
+                VALUES (?, ?, ?, ?, ?, ?)
+            """,
+            new_records,
+        )
+        db.executemany(
+            "DELETE FROM volumes WHERE id = ?",
+            [(name,) for name in gone],
+        )
+        _tags.delete_resource_tags(db, [(n, "volume") for n in gone])
@@ -0,0 +1,120 @@
+from __future__ import annotations
+from typing import (
+    List,
+    NamedTuple,
+    Optional,
+    Sequence,
+)
+
+import sqlite3
+
+from . import _filters
+
+
+# Warm volumes are created ahead of time in the warm_volumes table and
+# move
+#
+#   provisioning -> ready -> (claimed: moved to the volumes table)
+#
+# They are not volumes until claimed, and are not visible through the
+# API.
+
+# How often to top up the warm pool besides after every claim.
+FILL_INTERVAL = 60.0
+
+
+class WarmSpec(NamedTuple):
+    volume_type: str
+    size: int
+    quantity: int
+
+
+class WarmVolume(NamedTuple):
+    volume_name: str
+    volume_type: str
+    size: int
+    status: str
+    # Name of the storage pool the volume is in.
+    pool: Optional[str]
+
+
+def parse_spec(spec: str) -> WarmSpec:
+    """Parse a TYPE:SIZE:COUNT warm pool specification."""
+    try:
+        voltype, size, count = spec.split(":")
+        result = WarmSpec(voltype, int(size), int(count))
+    except ValueError:
+        raise ValueError(
+            f"invalid warm volume spec {spec!r}, expected TYPE:SIZE:COUNT"
+        ) from None
+    if not voltype or result.size <= 0 or result.quantity < 0:
+        raise ValueError(f"invalid warm volume spec {spec!r}")
+    return result
+
+
+def get_warm_volumes(db: sqlite3.Connection) -> List[WarmVolume]:
+    with db:
+        cur = db.execute(
+            f"""
+                SELECT {", ".join(WarmVolume._fields)}
+                FROM warm_volumes
+                ORDER BY volume_name
+            """
+        )
+        return [WarmVolume(*row) for row in cur.fetchall()]
+
+
+def find_ready(
+    db: sqlite3.Connection,
+    volume_type: str,
+    size: int,
+    pools: Sequence[str],
+) -> Optional[WarmVolume]:
+    """Return a ready warm volume of *volume_type* and *size*.
+
+    Only volumes in one of *pools* are considered.
+    """
+    if not pools:
+        return None
+    with db:
+        cur = db.execute(
+            f"""
+                SELECT {", ".join(WarmVolume._fields)}
+                FROM warm_volumes
+                WHERE
+                    volume_type = ? AND size = ? AND status = 'ready'
+                    AND {_filters.in_list("pool", pools)}
+                LIMIT 1
+            """,
+            [volume_type, size, *pools],
+        )
+        row = cur.fetchone()
+    return WarmVolume(*row) if row is not None else None
+
+
+def add(db: sqlite3.Connection, warm: WarmVolume) -> None:
+    with db:
+        db.execute(
+            """
+                INSERT INTO warm_volumes
+                    (volume_name, volume_type, size, status, pool)
+                VALUES (?, ?, ?, 'provisioning', ?)
+            """,
+            [warm.volume_name, warm.volume_type, warm.size, warm.pool],
+        )
+
+
+def set_ready(db: sqlite3.Connection, volume_name: str) -> None:
+    with db:
+        db.execute(
+            """
+                UPDATE warm_volumes SET status = 'ready'
+                WHERE volume_name = ? AND status = 'provisioning'
+            """,
+            [volume_name],
+        )
+
+
+def remove(db: sqlite3.Connection, volume_name: str) -> None:
+    """Remove a warm volume from the pool.  Must be in a transaction."""
+    db.execute("DELETE FROM warm_volumes WHERE volume_name = ?", [volume_name])
@@ -0,0 +1,148 @@
+from __future__ import annotations
+from typing import (
+    Dict,
+    NamedTuple,
+    Optional,
+)
+
+
+MiB = 2**20
+
+
+class IoTune(NamedTuple):
+    """Block I/O limits of a volume.
+
+    *throughput* is in MiB/s.  A volume may exceed its baseline up to
+    the burst limits for *burst_length* seconds, zero disables bursts.
+    """
+
+    iops: int
+    throughput: int
+    burst_iops: int = 0
+    burst_throughput: int = 0
+    burst_length: int = 0
+
+    def to_params(self) -> Dict[str, int]:
+        """Return typed parameters for virDomain.setBlockIoTune().
+
+        All parameters are always included so that limits which are
+        no longer in effect get cleared.
+        """
+        length = self.burst_length
+        return {
+            "total_iops_sec": self.iops,
+            "total_bytes_sec": self.throughput * MiB,
+            "total_iops_sec_max": self.burst_iops,
+            "total_bytes_sec_max": self.burst_throughput * MiB,
+            "total_iops_sec_max_length": length if self.burst_iops else 0,
+            "total_bytes_sec_max_length": (
+                length if self.burst_throughput else 0
+            ),
+        }
+
+    def to_xml(self) -> str:
+        """Return the <iotune> element of a disk."""
+        elements = "".join(
+            f"<{k}>{v}</{k}>" for k, v in self.to_params().items() if v
+        )
+        return f"<iotune>{elements}</iotune>"
+
+
+def get_iotune(
+    volume_type: str,
+    size: int,
+    *,
+    iops: Optional[int] = None,
+    throughput: Optional[int] = None,
+) -> Optional[IoTune]:
+    """Return I/O limits of a *volume_type* volume of *size* GiB.
+
+    *iops* and *throughput* are the provisioned values, if any.  Raise
+    ValueError if they are not valid for the volume type.  Volume types
+    without EBS performance figures are not limited and get None.
+    """
+    if volume_type in {"gp3", "io1", "io2"}:
+        return _get_provisioned(volume_type, size, iops, throughput)
+
+    if iops is not None:
+        raise ValueError(f"Iops cannot be specified for {volume_type}")
+    if throughput is not None:
+        raise ValueError(f"Throughput cannot be specified for {volume_type}")
+
+    if volume_type == "gp2":
+        # 3 IOPS per GiB, small volumes burst to 3000 IOPS.
+        baseline = min(max(3 * size, 100), 16000)
+        if baseline < 3000:
+            return IoTune(baseline, 250, 3000, 0, 1800)
+        else:
+            return IoTune(baseline, 250)
+    elif volume_type == "st1":
+        # Throughput per TiB, with a burst bucket.
+        return IoTune(
+            500,
+            min(max(40 * size // 1024, 1), 500),
+            0,
+            min(max(250 * size // 1024, 1), 500),
+            3600,
+        )
+    elif volume_type == "sc1":
+        return IoTune(
+            250,
+            min(max(12 * size // 1024, 1), 192),
+            0,
+            min(max(80 * size // 1024, 1), 250),
+            3600,
+        )
+    else:
+        # This includes "standard", the type of volumes which predate
+        # limits or were found in a pool, and which keep running
+        # unthrottled as they always have.
+        return None
+
+
+def _get_provisioned(
+    volume_type: str,
+    size: int,
+    iops: Optional[int],
+    throughput: Optional[int],
+) -> IoTune:
+    if volume_type == "gp3":
+        min_iops, max_iops, iops_per_gib = 3000, 16000, 500
+    elif volume_type == "io1":
+        min_iops, max_iops, iops_per_gib = 100, 64000, 50
+    else:
+        min_iops, max_iops, iops_per_gib = 100, 256000, 1000
+
+    if iops is None:
+        if volume_type != "gp3":
+            raise ValueError(f"Iops is required for {volume_type}")
+        iops = min_iops
+    if not min_iops <= iops <= max_iops:
+        raise ValueError(
+            f"Iops must be between {min_iops} and {max_iops} "
+            f"for {volume_type}"
+        )
+    if iops > max(iops_per_gib * size, min_iops):
+        raise ValueError(
+            f"Iops to volume size ratio cannot exceed {iops_per_gib} "
+            f"for {volume_type}"
+        )
+
+    if volume_type != "gp3":
+        if throughput is not None:
+            raise ValueError(
+                f"Throughput cannot be specified for {volume_type}"
+            )
+        # 256 KiB per I/O operation.
+        limit = 1000 if volume_type == "io1" else 4000
+        return IoTune(iops, min(iops // 4, limit))
+
+    if throughput is None:
+        throughput = 125
+    if not 125 <= throughput <= 1000:
+        raise ValueError("Throughput must be between 125 and 1000 for gp3")
+    if throughput > iops // 4:
+        raise ValueError(
+            "Throughput to Iops ratio cannot exceed 0.25 for gp3"
+        )
+    return IoTune(iops, throughput)
@@ -0,0 +1,130 @@
+from __future__ import annotations
+from typing import (
+    Callable,
+    Iterable,
+    List,
+)
+
+import ipaddress
+import sqlite3
+
+
+class AddressPoolExhaustedError(Exception):
+    pass
+
+
+def ensure_pool(
+    db: sqlite3.Connection,
+    name: str,
+    start: ipaddress.IPv4Address,
+    end: ipaddress.IPv4Address,
+    get_used: Callable[[], Iterable[str]],
+) -> None:
+    """Make sure the free list of pool *name* covers [start, end).
+
+    The free list is rebuilt from scratch when the pool is first seen
+    or when its range changes (e.g. the libvirt network was redefined),
+    in which case *get_used* is called to obtain the addresses that are
+    currently allocated.  Otherwise this is a single indexed lookup.
+    """
+    range_start = int(start)
+    range_end = max(int(end), range_start)
+
+    with db:
+        cur = db.execute(
+            """
+                SELECT range_start, range_end
+                FROM ip_pools
+                WHERE name = ?
+            """,
+            [name],
+        )
+        row = cur.fetchone()
+        if row is not None and tuple(row) == (range_start, range_end):
+            return
+
+        used = {int(ipaddress.IPv4Address(addr)) for addr in get_used()}
+
+        db.execute(
+            """
+                INSERT INTO ip_pools (name, range_start, range_end)
+                VALUES (?, ?, ?)
+                ON CONFLICT (name)
+                DO UPDATE SET
+                    range_start = excluded.range_start,
+                    range_end = excluded.range_end
+            """,
+            [name, range_start, range_end],
+        )
+        db.execute("DELETE FROM ip_free_list WHERE pool = ?", [name])
+        db.executemany(
+            """
+                INSERT INTO ip_free_list (pool, address)
+                VALUES (?, ?)
+            """,
+            (
+                (name, addr)
+                for addr in range(range_start, range_end)
+                if addr not in used
+            ),
+        )
+
+
+def allocate(
+    db: sqlite3.Connection,
+    pool: str,
+    count: int = 1,
+) -> List[ipaddress.IPv4Address]:
+    """Take *count* lowest free addresses out of *pool*.
+
+    Must be called inside the transaction that records the new
+    allocation so that the reservation is atomic with it.  Raises
+    AddressPoolExhaustedError if the pool does not have enough free
+    addresses, in which case nothing is allocated.
+    """
+    cur = db.execute(
+        """
+            SELECT address
+            FROM ip_free_list
+            WHERE pool = ?
+            ORDER BY address
+            LIMIT ?
+        """,
+        [pool, count],
+    )
+    addrs = [row[0] for row in cur.fetchall()]
+    if len(addrs) < count:
+        raise AddressPoolExhaustedError(
+            f"address pool {pool!r} has {len(addrs)} free addresses, "
+            f"{count} requested"
+        )
+
+    db.executemany(
+        """
+            DELETE FROM ip_free_list
+            WHERE pool = ? AND address = ?
+        """,
+        [(pool, addr) for addr in addrs],
+    )
+
+    return [ipaddress.IPv4Address(addr) for addr in addrs]
+
+
+def release(
+    db: sqlite3.Connection,
+    pool: str,
+    addresses: Iterable[str | ipaddress.IPv4Address],
+) -> None:
+    """Return *addresses* to the free list of *pool*.
+
+    Addresses outside of the current pool range are ignored.
+    """
+    db.executemany(
+        """
+            INSERT OR IGNORE INTO ip_free_list (pool, address)
+            SELECT name, ?1
+            FROM ip_pools
+            WHERE name = ?2 AND ?1 >= range_start AND ?1 < range_end
+        """,
+        [(int(ipaddress.IPv4Address(addr)), pool) for addr in addresses],
+    )
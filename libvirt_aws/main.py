@@ -7,10 +7,27 @@ import libvirt
 import logging
 import sqlite3
 import time
-from typing import Any, Mapping, Optional
+from typing import (
+    Any,
+    Dict,
+    List,
+    Mapping,
+    Optional,
+    Sequence,
+    Tuple,
+    Union,
+)
 import uuid
 
+from . import capacity
+from . import events
 from . import handlers
+from . import metrics
+from . import objects
+from . import placement
+from . import profiles
+from . import sparsify
+from . import tasks
 
 
 class AccessLogger(aiohttp.web_log.AccessLogger):
@@ -47,21 +64,22 @@ class AccessLogger(aiohttp.web_log.AccessLogger):
             self.logger.exception("Error in logging")
 
 
-def init_db(db: sqlite3.Connection) -> None:
-    with db:
-        db.execute(
-            """
+# Schema migrations.  Each entry upgrades the database by one version,
+# the resulting version number is stored in the SQLite user_version
+# pragma.  Never edit a migration once released, append a new one.
+MIGRATIONS: List[Tuple[str, ...]] = [
+    # 1: initial schema
+    (
+        """
             CREATE TABLE IF NOT EXISTS tags (
                 resource_name text,
                 resource_type text,
                 tagname       text,
                 tagvalue      text,
                 UNIQUE (resource_name, resource_type, tagname)
-            );
+            )
+        """,
         """
-        )
-        db.execute(
-            """
             CREATE TABLE IF NOT EXISTS ip_addresses (
                 allocation_id      text,
                 ip_address         text,
@@ -71,108 +89,489 @@ def init_db(db: sqlite3.Connection) -> None:
                 UNIQUE (ip_address),
                 UNIQUE (allocation_id),
                 UNIQUE (association_id)
-            );
+            )
+        """,
         """
-        )
-        db.execute(
-            """
             CREATE TABLE IF NOT EXISTS private_ip_addresses (
                 ip_address     text,
                 instance_id    text,
                 interface      text,
                 UNIQUE (ip_address)
-            );
+            )
+        """,
         """
-        )
-        db.execute(
-            """
             CREATE TABLE IF NOT EXISTS dns_zones (
                 id           text,
                 name         text,
                 comment      text,
                 UNIQUE (id)
-            );
+            )
+        """,
         """
-        )
-        db.execute(
-            """
             CREATE TABLE IF NOT EXISTS dns_changes (
                 id           text,
                 submitted_at text,
                 comment      text,
                 UNIQUE (id)
-            );
+            )
+        """,
         """
-        )
-        db.execute(
-            """
             CREATE TABLE IF NOT EXISTS volume_modifications (
                 id            text,
                 modifications text,
                 UNIQUE (id)
-            );
+            )
+        """,
+    ),
+    # 2: covering indexes for hot lookups
+    (
+        """
+            CREATE INDEX IF NOT EXISTS tags_by_type_name_value
+            ON tags (resource_type, tagname, tagvalue, resource_name)
+        """,
+        """
+            CREATE INDEX IF NOT EXISTS tags_by_type_resource
+            ON tags (resource_type, resource_name, tagname, tagvalue)
+        """,
+        """
+            CREATE INDEX IF NOT EXISTS ip_addresses_by_instance
+            ON ip_addresses (instance_id)
+        """,
+        """
+            CREATE INDEX IF NOT EXISTS private_ip_addresses_by_interface
+            ON private_ip_addresses (instance_id, interface, ip_address)
+        """,
+    ),
+    # 3: persistent free lists for static address allocation
+    (
+        """
+            CREATE TABLE IF NOT EXISTS ip_pools (
+                name         text,
+                range_start  integer,
+                range_end    integer,
+                UNIQUE (name)
+            )
+        """,
+        """
+            CREATE TABLE IF NOT EXISTS ip_free_list (
+                pool         text,
+                address      integer,
+                UNIQUE (pool, address)
+            )
+        """,
+    ),
+    # 4: two-phase private IP assignment
+    (
+        """
+            ALTER TABLE private_ip_addresses
+            ADD COLUMN state text NOT NULL DEFAULT 'assigned'
+        """,
+        """
+            ALTER TABLE private_ip_addresses
+            ADD COLUMN reserved_at real
+        """,
+        """
+            CREATE INDEX IF NOT EXISTS private_ip_addresses_by_state
+            ON private_ip_addresses (state, reserved_at)
+        """,
+    ),
+    # 5: volume inventory
+    (
+        """
+            CREATE TABLE IF NOT EXISTS volumes (
+                id                 text,
+                availability_zone  text,
+                volume_type        text,
+                size               integer,
+                create_time        text,
+                UNIQUE (id)
+            )
+        """,
+    ),
+    # 6: asynchronous volume provisioning
+    (
+        """
+            ALTER TABLE volumes
+            ADD COLUMN status text NOT NULL DEFAULT 'available'
+        """,
+        """
+            CREATE INDEX IF NOT EXISTS volumes_by_status
+            ON volumes (status)
+        """,
+    ),
+    # 7: snapshots; volumes are decoupled from their active image
+    (
+        """
+            ALTER TABLE volumes
+            ADD COLUMN volume_name text
+        """,
+        """
+            UPDATE volumes SET volume_name = id
+        """,
+        """
+            CREATE UNIQUE INDEX IF NOT EXISTS volumes_by_volume_name
+            ON volumes (volume_name)
+        """,
+        """
+            CREATE TABLE IF NOT EXISTS snapshots (
+                id           text,
+                volume_id    text,
+                volume_size  integer,
+                image        text,
+                description  text,
+                start_time   text,
+                status       text NOT NULL DEFAULT 'pending',
+                UNIQUE (id),
+                UNIQUE (image)
+            )
+        """,
+        """
+            CREATE INDEX IF NOT EXISTS snapshots_by_volume
+            ON snapshots (volume_id, id)
+        """,
+        """
+            CREATE INDEX IF NOT EXISTS snapshots_by_status
+            ON snapshots (status, id)
+        """,
+    ),
+    # 8: volumes created from snapshots
+    (
+        """
+            ALTER TABLE volumes
+            ADD COLUMN snapshot_id text
+        """,
+        """
+            CREATE INDEX IF NOT EXISTS volumes_by_snapshot
+            ON volumes (snapshot_id)
+        """,
+    ),
+    # 9: attachment settings
+    (
+        """
+            CREATE TABLE IF NOT EXISTS attachments (
+                volume_id    text,
+                instance_id  text,
+                device       text,
+                driver       text,
+                UNIQUE (volume_id, instance_id)
+            )
+        """,
+        """
+            CREATE INDEX IF NOT EXISTS attachments_by_instance
+            ON attachments (instance_id, device)
+        """,
+    ),
+    # 10: provisioned performance
+    (
+        "ALTER TABLE volumes ADD COLUMN iops integer",
+        "ALTER TABLE volumes ADD COLUMN throughput integer",
+    ),
+    # 11: attachment state
+    (
+        """
+            ALTER TABLE attachments
+            ADD COLUMN state text NOT NULL DEFAULT 'attached'
+        """,
+        "ALTER TABLE attachments ADD COLUMN alias text",
+    ),
+    # 12: volume modification history
+    (
+        """
+            CREATE TABLE IF NOT EXISTS volume_modification_history (
+                seq          integer PRIMARY KEY AUTOINCREMENT,
+                volume_id    text NOT NULL,
+                job          text NOT NULL,
+                state        text NOT NULL,
+                start_time   text,
+                modification text NOT NULL,
+                params       text
+            )
+        """,
+        """
+            CREATE INDEX IF NOT EXISTS volume_modification_history_by_volume
+            ON volume_modification_history (volume_id, seq)
+        """,
+        """
+            CREATE INDEX IF NOT EXISTS volume_modification_history_by_state
+            ON volume_modification_history (state)
+        """,
         """
+            INSERT INTO volume_modification_history
+                (volume_id, job, state, start_time, modification)
+            SELECT
+                id,
+                'modify',
+                coalesce(
+                    json_extract(modifications, '$.modificationState'),
+                    'completed'
+                ),
+                json_extract(modifications, '$.startTime'),
+                modifications
+            FROM volume_modifications
+        """,
+        "DROP TABLE volume_modifications",
+    ),
+    # 13: space reclamation
+    (
+        "ALTER TABLE volumes ADD COLUMN sparse_allocation integer",
+    ),
+    # 14: warm volume pool
+    (
+        """
+            CREATE TABLE IF NOT EXISTS warm_volumes (
+                volume_name  text PRIMARY KEY,
+                volume_type  text NOT NULL,
+                size         integer NOT NULL,
+                status       text NOT NULL
+            )
+        """,
+        """
+            CREATE INDEX IF NOT EXISTS warm_volumes_by_spec
+            ON warm_volumes (volume_type, size, status)
+        """,
+    ),
+    # 15: multiple storage pools
+    (
+        "ALTER TABLE volumes ADD COLUMN pool text",
+        "ALTER TABLE snapshots ADD COLUMN pool text",
+        "ALTER TABLE warm_volumes ADD COLUMN pool text",
+    ),
+]
+
+
+def get_db_version(db: sqlite3.Connection) -> int:
+    return int(db.execute("PRAGMA user_version").fetchone()[0])
+
+
+def init_db(db: sqlite3.Connection) -> None:
+    current = get_db_version(db)
+    if current > len(MIGRATIONS):
+        raise RuntimeError(
+            f"database schema version {current} is newer than supported "
+            f"by this version of libvirt-aws ({len(MIGRATIONS)})"
         )
 
+    for version, migration in enumerate(
+        MIGRATIONS[current:], start=current + 1
+    ):
+        # DDL does not start an implicit transaction in sqlite3,
+        # so begin one explicitly to apply the migration atomically.
+        db.execute("BEGIN")
+        try:
+            for stmt in migration:
+                db.execute(stmt)
+            db.execute(f"PRAGMA user_version = {version}")
+        except BaseException:
+            db.rollback()
+            raise
+        else:
+            db.commit()
+
 
 def init_app(
-    pool_name_or_id: str,
+    pool_name_or_id: Union[str, Sequence[str]],
     network_name_or_id: str,
     libvirt_uri: str,
     database: str,
     region: str,
+    volume_workers: int = 4,
+    volume_wipe: str = "none",
+    volume_wipe_rate: int = 64,
+    flatten_volumes: bool = False,
+    max_chain_depth: int = 8,
+    chain_maintenance_interval: float = 300,
+    chain_flatten_rate: int = 64,
+    volume_profiles: Optional[str] = None,
+    metrics_interval: int = 60,
+    storage_overcommit_ratio: float = 1.0,
+    storage_max_fill: float = 0.95,
+    volume_reclaim_interval: float = 3600,
+    warm_volumes: Sequence[str] = (),
+    volume_placement: str = "capacity",
 ) -> web.Application:
     app = web.Application()
     # logging.basicConfig(level=logging.DEBUG)
     aiohttp.log.access_logger.setLevel(logging.DEBUG)
+    # Device events drive volume attachment states, the event loop
+    # must be in place before the connection is opened.
+    events.start_event_loop()
     app["libvirt"] = libvirt.open(libvirt_uri)
 
-    app["libvirt_pool"], app["libvirt_net"] = initialize_libvirt(
-        app["libvirt"], pool_name_or_id, network_name_or_id
+    if isinstance(pool_name_or_id, str):
+        pool_name_or_id = [pool_name_or_id]
+    pool_specs = [placement.parse_pool_spec(s) for s in pool_name_or_id]
+    if not pool_specs:
+        raise ValueError("at least one storage pool is required")
+    libvirt_pools, app["libvirt_net"] = initialize_libvirt(
+        app["libvirt"],
+        [spec.name_or_id for spec in pool_specs],
+        network_name_or_id,
     )
+    limits = capacity.CapacityLimits(
+        overcommit_ratio=storage_overcommit_ratio,
+        max_fill=storage_max_fill,
+    )
+    if len(pool_specs) != len(libvirt_pools):
+        raise AssertionError("storage pools do not match their specs")
+    storage_pools: Dict[str, placement.StoragePool] = {}
+    for i, spec in enumerate(pool_specs):
+        pool = libvirt_pools[i]
+        storage_pools[pool.name()] = placement.StoragePool(
+            name=pool.name(),
+            pool=pool,
+            zones=spec.zones,
+            volume_types=spec.volume_types,
+            accountant=capacity.CapacityAccountant(pool, limits),
+            pool_type=objects.get_pool_type(pool),
+        )
+    # Volumes from before multiple pools were supported are in the
+    # first one, which also serves as the connection to libvirt.
+    app["storage_pools"] = storage_pools
+    app["libvirt_pool"] = libvirt_pools[0]
+    app["volume_placement"] = volume_placement
 
     app["db"] = sqlite3.connect(database)
     app["logger"] = logging.getLogger("libvirt-aws")
     app["region"] = region
+    app["volume_wipe"] = volume_wipe
+    app["volume_wipe_rate"] = volume_wipe_rate * 2**20
+    app["flatten_volumes"] = flatten_volumes
+    app["max_chain_depth"] = max_chain_depth
+    app["chain_flatten_rate"] = chain_flatten_rate
+    app["volume_profiles"] = profiles.load_profiles(volume_profiles)
+    app["warm_volumes"] = [
+        handlers.warm_pool.parse_spec(spec) for spec in warm_volumes
+    ]
+    for spec in app["warm_volumes"]:
+        if spec.volume_type not in app["volume_profiles"]:
+            raise ValueError(
+                f"unknown volume type in warm volume spec: {spec.volume_type}"
+            )
+    for storage_pool in storage_pools.values():
+        for voltype in storage_pool.volume_types:
+            if voltype not in app["volume_profiles"]:
+                raise ValueError(
+                    f"unknown volume type for storage pool "
+                    f"{storage_pool.name}: {voltype}"
+                )
+    app["metrics"] = metrics.MetricStore(metrics_interval or 60)
+    app["pool_metrics"] = metrics.MetricStore(metrics_interval or 60)
     init_db(app["db"])
     app.add_routes(handlers.routes)
+    app.cleanup_ctx.append(
+        tasks.periodic(
+            "sweep_private_ip_reservations",
+            handlers.ips.PRIVATE_IP_RESERVATION_TTL / 2,
+            handlers.ips.sweep_private_ip_reservations,
+        )
+    )
+    app.cleanup_ctx.append(
+        tasks.work_queue("volume_queue", "volume_queue", volume_workers)
+    )
+    # Deletion (and wiping in particular) is low priority: run it
+    # serially, so that it never competes with provisioning for workers.
+    app.cleanup_ctx.append(
+        tasks.work_queue("volume_delete_queue", "volume_delete_queue", 1)
+    )
+    app.on_startup.append(handlers.volumes.assign_default_pool)
+    app.on_startup.append(handlers.volumes.resume_volume_jobs)
+    app.on_startup.append(handlers.snapshots.resume_snapshot_jobs)
+    # Also removes warm volumes no longer configured.
+    app.on_startup.append(handlers.volumes.fill_warm_pool)
+    if app["warm_volumes"]:
+        app.cleanup_ctx.append(
+            tasks.periodic(
+                "fill_warm_pool",
+                handlers.warm_pool.FILL_INTERVAL,
+                handlers.volumes.fill_warm_pool,
+            )
+        )
+    app.cleanup_ctx.append(handlers.attachments.watch_device_events)
+    app.cleanup_ctx.append(
+        tasks.periodic(
+            "reconcile_attachments",
+            handlers.attachments.RECONCILE_INTERVAL,
+            handlers.attachments.reconcile,
+        )
+    )
+    if max_chain_depth:
+        app.cleanup_ctx.append(
+            tasks.periodic(
+                "maintain_volume_chains",
+                chain_maintenance_interval,
+                handlers.volumes.maintain_volume_chains,
+            )
+        )
+    if metrics_interval:
+        app.cleanup_ctx.append(
+            tasks.periodic(
+                "sample_volume_metrics",
+                metrics_interval,
+                handlers.cloudwatch.sample_volume_metrics,
+            )
+        )
+    if volume_reclaim_interval:
+        if sparsify.is_available():
+            app.cleanup_ctx.append(
+                tasks.periodic(
+                    "reclaim_volume_space",
+                    volume_reclaim_interval,
+                    handlers.volumes.reclaim_volume_space,
+                )
+            )
+        else:
+            logging.warning(
+                "virt-sparsify is not installed, the space of detached "
+                "volumes will not be reclaimed"
+            )
+    # Admission control needs current figures regardless of metrics.
+    app.cleanup_ctx.append(
+        tasks.periodic(
+            "refresh_pool_capacity",
+            metrics_interval or 60,
+            handlers.volumes.refresh_pool_capacity,
+        )
+    )
     app.on_cleanup.append(close_libvirt)
     return app
 
 
 def initialize_libvirt(
     libvirt: libvirt.virConnect,
-    pool_name_or_id: str,
+    pool_names_or_ids: Sequence[str],
     network_name_or_id: str,
-) -> tuple[libvirt.virStoragePool, libvirt.virNetwork]:
+) -> tuple[List[libvirt.virStoragePool], libvirt.virNetwork]:
     while True:
         try:
-            pool, network = _initialize_libvirt(
-                libvirt, pool_name_or_id, network_name_or_id
+            pools, network = _initialize_libvirt(
+                libvirt, pool_names_or_ids, network_name_or_id
             )
         except Exception:
             logging.warning("error initializing libvirt, retrying...")
             time.sleep(5)
         else:
-            return pool, network
+            return pools, network
 
 
 def _initialize_libvirt(
     libvirt: libvirt.virConnect,
-    pool_name_or_id: str,
+    pool_names_or_ids: Sequence[str],
     network_name_or_id: str,
-) -> tuple[libvirt.virStoragePool, libvirt.virNetwork]:
-    if is_uuid(pool_name_or_id):
-        pool = libvirt.storagePoolLookupByUUIDString(pool_name_or_id)
-    else:
-        pool = libvirt.storagePoolLookupByName(pool_name_or_id)
+) -> tuple[List[libvirt.virStoragePool], libvirt.virNetwork]:
+    pools = []
+    for pool_name_or_id in pool_names_or_ids:
+        if is_uuid(pool_name_or_id):
+            pool = libvirt.storagePoolLookupByUUIDString(pool_name_or_id)
+        else:
+            pool = libvirt.storagePoolLookupByName(pool_name_or_id)
+        pools.append(pool)
 
     if is_uuid(network_name_or_id):
         network = libvirt.networkLookupByUUIDString(network_name_or_id)
     else:
         network = libvirt.networkLookupByName(network_name_or_id)
 
-    return pool, network
+    return pools, network
 
 
 def is_uuid(name_or_id: str) -> bool:
@@ -195,8 +594,13 @@ async def close_libvirt(app: web.Application) -> None:
 @click.option("--libvirt-uri", default="qemu:///system", help="Libvirtd URI")
 @click.option(
     "--libvirt-image-pool",
-    default="default",
-    help="Name or UUID of libvirt image pool to use for EBS emulation.",
+    default=["default"],
+    multiple=True,
+    metavar="POOL[:az=ZONE,type=TYPE,...]",
+    help="Name or UUID of libvirt image pool to use for EBS emulation.  "
+    "May be given more than once, optionally restricting pools to "
+    "availability zones and volume types.  Volumes from before multiple "
+    "pools were supported are in the first one.",
 )
 @click.option(
     "--libvirt-network",
@@ -209,15 +613,121 @@ async def close_libvirt(app: web.Application) -> None:
     type=str,
     help="AWS region to pretend to be in",
 )
+@click.option(
+    "--volume-workers",
+    default=4,
+    type=int,
+    help="Number of volumes to provision concurrently.",
+)
+@click.option(
+    "--volume-wipe",
+    default="none",
+    type=click.Choice(["none", "zero", "trim"]),
+    help="How to scrub the storage of deleted volumes.",
+)
+@click.option(
+    "--volume-wipe-rate",
+    default=64,
+    type=int,
+    help="Maximum rate of zeroing deleted volumes in MiB/s, 0 to disable.",
+)
+@click.option(
+    "--flatten-volumes/--no-flatten-volumes",
+    default=False,
+    help="Copy snapshot data into volumes created from snapshots "
+    "in the background.",
+)
+@click.option(
+    "--max-chain-depth",
+    default=8,
+    type=int,
+    help="Flatten volumes with more backing images than this, "
+    "0 to disable.",
+)
+@click.option(
+    "--chain-maintenance-interval",
+    default=300,
+    type=float,
+    help="How often to check volume backing chain depth, in seconds.",
+)
+@click.option(
+    "--chain-flatten-rate",
+    default=64,
+    type=int,
+    help="Maximum rate of flattening attached volumes in MiB/s, "
+    "0 for unlimited.",
+)
+@click.option(
+    "--volume-profiles",
+    default=None,
+    type=click.Path(exists=True, dir_okay=False),
+    help="JSON file overriding the on-disk layout of volume types.",
+)
+@click.option(
+    "--metrics-interval",
+    default=60,
+    type=click.IntRange(min=0),
+    help="How often to sample volume I/O metrics, in seconds, "
+    "0 to disable.",
+)
+@click.option(
+    "--storage-overcommit-ratio",
+    default=1.0,
+    type=click.FloatRange(min=0),
+    help="Maximum ratio of volume sizes to storage pool capacity, "
+    "0 for unlimited.",
+)
+@click.option(
+    "--storage-max-fill",
+    default=0.95,
+    type=click.FloatRange(min=0, max=1),
+    help="Fraction of storage pool capacity past which new volumes "
+    "and volume growth are refused.",
+)
+@click.option(
+    "--volume-reclaim-interval",
+    default=3600,
+    type=click.FloatRange(min=0),
+    help="How often to sparsify detached volumes, in seconds, "
+    "0 to disable.",
+)
+@click.option(
+    "--warm-volumes",
+    multiple=True,
+    metavar="TYPE:SIZE:COUNT",
+    help="Keep COUNT volumes of type TYPE and SIZE GiB provisioned "
+    "ahead of CreateVolume requests.  May be given more than once.",
+)
+@click.option(
+    "--volume-placement",
+    default="capacity",
+    type=click.Choice(placement.PLACEMENT_POLICIES),
+    help="Put new volumes in the eligible storage pool with the most "
+    "room (capacity) or the least I/O (load).",
+)
 def main(
     *,
     bind_to: Optional[str],
     port: int,
     database: str,
-    libvirt_image_pool: str,
+    libvirt_image_pool: Tuple[str, ...],
     libvirt_network: str,
     libvirt_uri: str,
     region: str,
+    volume_workers: int,
+    volume_wipe: str,
+    volume_wipe_rate: int,
+    flatten_volumes: bool,
+    max_chain_depth: int,
+    chain_maintenance_interval: float,
+    chain_flatten_rate: int,
+    volume_profiles: Optional[str],
+    metrics_interval: int,
+    storage_overcommit_ratio: float,
+    storage_max_fill: float,
+    volume_reclaim_interval: float,
+    warm_volumes: Tuple[str, ...],
+    volume_placement: str,
 ) -> None:
     web.run_app(
         init_app(
@@ -226,6 +736,20 @@ def main(
             libvirt_uri=libvirt_uri,
             database=database,
             region=region,
+            volume_workers=volume_workers,
+            volume_wipe=volume_wipe,
+            volume_wipe_rate=volume_wipe_rate,
+            flatten_volumes=flatten_volumes,
+            max_chain_depth=max_chain_depth,
+            chain_maintenance_interval=chain_maintenance_interval,
+            chain_flatten_rate=chain_flatten_rate,
+            volume_profiles=volume_profiles,
+            metrics_interval=metrics_interval,
+            storage_overcommit_ratio=storage_overcommit_ratio,
+            storage_max_fill=storage_max_fill,
+            volume_reclaim_interval=volume_reclaim_interval,
+            warm_volumes=warm_volumes,
+            volume_placement=volume_placement,
         ),
         access_log_class=AccessLogger,
         host=bind_to,
@@ -0,0 +1,202 @@
+from __future__ import annotations
+from typing import (
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Mapping,
+    NamedTuple,
+    Optional,
+    Sequence,
+    Tuple,
+)
+
+import array
+import math
+
+
+# (resolution in seconds, number of slots) of the tiers of a series,
+# finest first.  The finest resolution is the sampling interval.
+Tiers = Sequence[Tuple[int, int]]
+
+MetricKey = Tuple[str, str]
+
+
+def default_tiers(interval: int) -> Tiers:
+    # 6 hours of raw samples, a day of 5 minute aggregates and two
+    # weeks of hourly ones.
+    return [
+        (interval, max(6 * 3600 // interval, 1)),
+        (300, 288),
+        (3600, 336),
+    ]
+
+
+class Datapoint(NamedTuple):
+    timestamp: int
+    sum: float
+    sample_count: int
+    minimum: float
+    maximum: float
+
+    @property
+    def average(self) -> float:
+        return self.sum / self.sample_count if self.sample_count else 0.0
+
+
+class _Tier:
+    """A ring buffer of aggregates over fixed-size time buckets."""
+
+    def __init__(self, resolution: int, slots: int) -> None:
+        self.resolution = resolution
+        self.slots = slots
+        self.times = array.array("q", [-1]) * slots
+        self.sums = array.array("d", [0.0]) * slots
+        self.counts = array.array("I", [0]) * slots
+        self.mins = array.array("d", [0.0]) * slots
+        self.maxs = array.array("d", [0.0]) * slots
+
+    @property
+    def retention(self) -> int:
+        return self.resolution * self.slots
+
+    def add(self, timestamp: float, value: float) -> None:
+        bucket = int(timestamp) // self.resolution * self.resolution
+        i = bucket // self.resolution % self.slots
+        if self.times[i] != bucket:
+            # The slot holds an aggregate that aged out, reuse it.
+            self.times[i] = bucket
+            self.sums[i] = value
+            self.counts[i] = 1
+            self.mins[i] = value
+            self.maxs[i] = value
+        else:
+            self.sums[i] += value
+            self.counts[i] += 1
+            self.mins[i] = min(self.mins[i], value)
+            self.maxs[i] = max(self.maxs[i], value)
+
+    def buckets(self, start: int, end: int) -> Iterator[Datapoint]:
+        for i in range(self.slots):
+            t = self.times[i]
+            if start <= t < end:
+                yield Datapoint(
+                    t, self.sums[i], self.counts[i], self.mins[i], self.maxs[i]
+                )
+
+
+class Series:
+    """A time series kept at progressively coarser resolutions.
+
+    Every sample is added to all tiers, so that older data is still
+    available, downsampled, after it is evicted from the finer tiers.
+    Memory use is fixed regardless of how long the series lives.
+    """
+
+    def __init__(self, tiers: Tiers) -> None:
+        self._tiers = [_Tier(res, slots) for res, slots in tiers]
+        self.last_timestamp: Optional[float] = None
+
+    def add(self, timestamp: float, value: float) -> None:
+        for tier in self._tiers:
+            tier.add(timestamp, value)
+        self.last_timestamp = timestamp
+
+    def query(
+        self,
+        start: float,
+        end: float,
+        period: int,
+        *,
+        now: Optional[float] = None,
+    ) -> List[Datapoint]:
+        """Return aggregates over *period* seconds between *start* and *end*.
+
+        Periods are aligned to *start*.  Uses the coarsest tier not
+        coarser than *period* which still covers *start*, or failing
+        that, the finest tier that does, so that data older than the
+        retention of *period*-sized aggregates comes back downsampled.
+        """
+        if now is None:
+            now = self.last_timestamp or end
+        covering = [t for t in self._tiers if t.retention >= now - start]
+        if not covering:
+            covering = self._tiers[-1:]
+        fine = [t for t in covering if t.resolution <= period]
+        tier = fine[-1] if fine else covering[0]
+
+        start = int(start)
+        end = math.ceil(end)
+        periods: Dict[int, List[Datapoint]] = {}
+        for dp in tier.buckets(start, end):
+            key = start + (dp.timestamp - start) // period * period
+            periods.setdefault(key, []).append(dp)
+
+        return [_merge(ts, dps) for ts, dps in sorted(periods.items())]
+
+
+def _merge(timestamp: int, datapoints: Iterable[Datapoint]) -> Datapoint:
+    dps = list(datapoints)
+    return Datapoint(
+        timestamp,
+        sum(dp.sum for dp in dps),
+        sum(dp.sample_count for dp in dps),
+        min(dp.minimum for dp in dps),
+        max(dp.maximum for dp in dps),
+    )
+
+
+class MetricStore:
+    """In-memory time series keyed by (resource id, metric name)."""
+
+    def __init__(self, interval: int, tiers: Optional[Tiers] = None) -> None:
+        self.interval = interval
+        self._tiers = tiers if tiers is not None else default_tiers(interval)
+        self._series: Dict[MetricKey, Series] = {}
+        self._counters: Dict[str, Tuple[float, Dict[str, int]]] = {}
+
+    def put(self, key: MetricKey, timestamp: float, value: float) -> None:
+        series = self._series.get(key)
+        if series is None:
+            series = self._series[key] = Series(self._tiers)
+        series.add(timestamp, value)
+
+    def get(self, key: MetricKey) -> Optional[Series]:
+        return self._series.get(key)
+
+    def keys(self) -> List[MetricKey]:
+        return list(self._series)
+
+    def retain(self, resources: Iterable[str]) -> None:
+        """Drop series and counters of resources not in *resources*."""
+        keep = set(resources)
+        for key in [k for k in self._series if k[0] not in keep]:
+            del self._series[key]
+        for name in [k for k in self._counters if k.split("/")[0] not in keep]:
+            del self._counters[name]
+
+    def delta(
+        self,
+        name: str,
+        timestamp: float,
+        counters: Mapping[str, int],
+    ) -> Optional[Tuple[float, Dict[str, int]]]:
+        """Return the elapsed time and counter increments since last call.
+
+        *name* identifies the counter set, it starts with the resource
+        id followed by "/".  Returns None on the first call, and when
+        the counters went backwards, e.g. because the disk was
+        reattached.
+        """
+        prev = self._counters.get(name)
+        self._counters[name] = (timestamp, dict(counters))
+        if prev is None:
+            return None
+        prev_time, prev_counters = prev
+        elapsed = timestamp - prev_time
+        deltas = {
+            k: v - prev_counters.get(k, 0) for k, v in counters.items()
+        }
+        if elapsed <= 0 or any(v < 0 for v in deltas.values()):
+            return None
+        return elapsed, deltas
@@ -7,6 +7,7 @@ from typing import (
     Mapping,
     MutableMapping,
     Optional,
+    Sequence,
     Set,
     Tuple,
 )
@@ -14,6 +15,7 @@ from typing import (
 import collections
 import functools
 import ipaddress
+import os.path
 
 import libvirt
 import xmltodict
@@ -57,16 +59,96 @@ def get_vol_attachments(
     volume: Volume,
 ) -> List[VolumeAttachment]:
     conn = pool.connect()
+    pool_name = pool.name()
+    pool_path = get_pool_path(pool)
     attachments = []
 
     for dom in get_all_domains(conn):
         for disk in dom.disks:
-            if volume.name == disk.volume and disk.pool == pool.name():
+            if volume.name == disk.volume and disk.in_pool(
+                pool_name, pool_path
+            ):
                 attachments.append(disk.attachment)
 
     return attachments
 
 
+def get_pool_attachments(
+    pool: libvirt.virStoragePool,
+) -> Dict[str, List[VolumeAttachment]]:
+    """Return attachments of all volumes in *pool* keyed by volume name.
+
+    Unlike calling get_vol_attachments() for every volume this walks
+    the domain list only once.
+    """
+    return get_pools_attachments([pool])
+
+
+def get_pools_attachments(
+    pools: Sequence[libvirt.virStoragePool],
+) -> Dict[str, List[VolumeAttachment]]:
+    """Return attachments of all volumes in *pools* keyed by volume name."""
+    if not pools:
+        return {}
+    conn = pools[0].connect()
+    locations = [(pool.name(), get_pool_path(pool)) for pool in pools]
+    attachments: Dict[str, List[VolumeAttachment]] = (
+        collections.defaultdict(list)
+    )
+
+    for dom in get_all_domains(conn):
+        for disk in dom.disks:
+            if any(disk.in_pool(name, path) for name, path in locations):
+                attachments[disk.volume].append(disk.attachment)
+
+    return attachments
+
+
+def get_backing_chain(
+    pool: libvirt.virStoragePool,
+    name: str,
+) -> List[str]:
+    """Return names of volumes in the backing chain of volume *name*.
+
+    The chain starts with *name* itself and ends with the base image.
+    Backing images outside of any pool end the walk.
+    """
+    conn = pool.connect()
+    chain: List[str] = []
+    virvol = pool.storageVolLookupByName(name)
+    while virvol.name() not in chain:
+        chain.append(virvol.name())
+        backing = volume_from_xml(virvol.XMLDesc(0)).backing_store
+        if backing is None:
+            break
+        try:
+            virvol = conn.storageVolLookupByPath(backing)
+        except libvirt.libvirtError:
+            break
+    return chain
+
+
+def get_pool_path(pool: libvirt.virStoragePool) -> str:
+    """Return the target path of *pool*, i.e. the directory of its volumes."""
+    return _pool_path_from_xml(pool.XMLDesc(0))
+
+
+@functools.lru_cache
+def _pool_path_from_xml(xml: str) -> str:
+    parsed = xmltodict.parse(xml)
+    return parsed["pool"]["target"]["path"]  # type: ignore[no-any-return]
+
+
+def get_pool_type(pool: libvirt.virStoragePool) -> str:
+    """Return the libvirt type of *pool*, e.g. "dir" or "logical"."""
+    return _pool_type_from_xml(pool.XMLDesc(0))
+
+
+@functools.lru_cache
+def _pool_type_from_xml(xml: str) -> str:
+    return xmltodict.parse(xml)["pool"]["@type"]  # type: ignore
+
+
 @functools.lru_cache
 def domain_from_xml(xml: str) -> Domain:
     return Domain(xmltodict.parse(xml)["domain"])
@@ -83,16 +165,68 @@ class Domain:
 
     @property
     def disks(self) -> List[DiskDevice]:
+        """Disks that may be storage pool volumes.
+
+        Besides disks of type "volume" this includes file and block
+        disks, which is what volume disks turn into after an external
+        snapshot.  Use DiskDevice.in_pool() to tell which pool they
+        belong to.
+        """
         if self._disks is None:
-            disks = self._dom["devices"]["disk"]
-            if not isinstance(disks, list):
-                disks = [disks]
             self._disks = [
-                DiskDevice(self, d) for d in disks if d["@type"] == "volume"
+                DiskDevice(self, d)
+                for d in self._all_disks()
+                if d["@type"] in {"volume", "file", "block"}
+                and d.get("@device", "disk") == "disk"
+                and d.get("source")
             ]
 
         return self._disks
 
+    @property
+    def iothreads(self) -> int:
+        iothreads = self._dom.get("iothreads")
+        if isinstance(iothreads, dict):
+            iothreads = iothreads.get("#text")
+        return int(iothreads or 0)
+
+    @property
+    def vcpus(self) -> int:
+        vcpu = self._dom.get("vcpu")
+        if isinstance(vcpu, dict):
+            vcpu = vcpu.get("@current") or vcpu.get("#text")
+        return int(vcpu or 1)
+
+    @property
+    def used_iothreads(self) -> Dict[int, int]:
+        """Map iothread ids to the number of disks using them."""
+        used: Dict[int, int] = collections.defaultdict(int)
+        for disk in self._all_disks():
+            driver = disk.get("driver") or {}
+            if driver.get("@iothread"):
+                used[int(driver["@iothread"])] += 1
+        return used
+
+    @property
+    def disk_targets(self) -> List[str]:
+        """Target device names of all disks of the domain."""
+        return [d["target"]["@dev"] for d in self._all_disks()]
+
+    @property
+    def disk_aliases(self) -> Dict[str, str]:
+        """Map target device names to device aliases of live disks."""
+        return {
+            d["target"]["@dev"]: d["alias"]["@name"]
+            for d in self._all_disks()
+            if d.get("alias")
+        }
+
+    def _all_disks(self) -> List[Mapping[str, Any]]:
+        disks = self._dom["devices"].get("disk") or []
+        if not isinstance(disks, list):
+            disks = [disks]
+        return disks
+
 
 class DiskDevice:
     def __init__(self, dom: Domain, desc: Mapping[str, Any]) -> None:
@@ -101,11 +235,35 @@ class DiskDevice:
 
     @property
     def volume(self) -> str:
-        return self._desc["source"]["@volume"]  # type: ignore
+        if self._desc["@type"] == "volume":
+            return self._desc["source"]["@volume"]  # type: ignore
+        else:
+            return os.path.basename(self.path or "")
+
+    @property
+    def pool(self) -> Optional[str]:
+        return self._desc["source"].get("@pool")  # type: ignore
+
+    @property
+    def path(self) -> Optional[str]:
+        source = self._desc["source"]
+        return source.get("@file") or source.get("@dev")  # type: ignore
 
     @property
-    def pool(self) -> str:
-        return self._desc["source"]["@pool"]  # type: ignore
+    def target(self) -> str:
+        return self._desc["target"]["@dev"]  # type: ignore[no-any-return]
+
+    @property
+    def has_backing_store(self) -> bool:
+        # An empty <backingStore/> marks the end of the chain.
+        return bool(self._desc.get("backingStore"))
+
+    def in_pool(self, pool_name: str, pool_path: str) -> bool:
+        if self._desc["@type"] == "volume":
+            return self.pool == pool_name
+        else:
+            path = self.path
+            return path is not None and os.path.dirname(path) == pool_path
 
     @property
     def attachment(self) -> VolumeAttachment:
@@ -139,6 +297,13 @@ class Volume:
     def target_path(self) -> str:
         return self._vol["target"]["path"]  # type: ignore[no-any-return]
 
+    @property
+    def format(self) -> str:
+        fmt = self._vol["target"].get("format")
+        if fmt is None:
+            return "raw"
+        return fmt["@type"]  # type: ignore[no-any-return]
+
     @property
     def backing_store(self) -> Optional[str]:
         bs = self._vol.get("backingStore")
@@ -157,7 +322,7 @@ class VolumeAttachment:
         self,
         domain: str,
         volume: str,
-        pool: str,
+        pool: Optional[str],
         desc: Mapping[str, Any],
     ) -> None:
         self._domain = domain
@@ -174,7 +339,7 @@ class VolumeAttachment:
         return self._volume
 
     @property
-    def pool(self) -> str:
+    def pool(self) -> Optional[str]:
         return self._pool
 
     @property
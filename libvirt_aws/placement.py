@@ -0,0 +1,132 @@
+from __future__ import annotations
+from typing import (
+    FrozenSet,
+    List,
+    Mapping,
+    NamedTuple,
+    Optional,
+    Sequence,
+)
+
+import libvirt
+
+from . import capacity
+
+
+# How to pick among the pools that may hold a new volume:
+# "capacity" prefers the pool with the most room, "load" the one with
+# the least volume I/O.
+PLACEMENT_POLICIES = ("capacity", "load")
+
+# libvirt pool types whose volumes are block devices rather than image
+# files.  Their volumes are raw and attached as type='block' disks.
+BLOCK_POOL_TYPES = frozenset({"logical"})
+
+
+class PoolSpec(NamedTuple):
+    name_or_id: str
+    # Availability zones and volume types the pool takes volumes of,
+    # empty for any.
+    zones: FrozenSet[str] = frozenset()
+    volume_types: FrozenSet[str] = frozenset()
+
+
+class StoragePool(NamedTuple):
+    name: str
+    pool: libvirt.virStoragePool
+    zones: FrozenSet[str]
+    volume_types: FrozenSet[str]
+    accountant: capacity.CapacityAccountant
+    # libvirt pool type.
+    pool_type: str = "dir"
+
+    @property
+    def is_block(self) -> bool:
+        return self.pool_type in BLOCK_POOL_TYPES
+
+    def accepts(
+        self,
+        zone: Optional[str],
+        volume_type: Optional[str],
+    ) -> bool:
+        """Whether the pool takes volumes of *volume_type* in *zone*.
+
+        None matches any zone or volume type.
+        """
+        if zone is not None and self.zones and zone not in self.zones:
+            return False
+        if (
+            volume_type is not None
+            and self.volume_types
+            and volume_type not in self.volume_types
+        ):
+            return False
+        return True
+
+
+def parse_pool_spec(spec: str) -> PoolSpec:
+    """Parse a POOL[:az=ZONE,type=TYPE,...] storage pool specification."""
+    name, _, selectors = spec.partition(":")
+    if not name:
+        raise ValueError(f"invalid storage pool spec {spec!r}")
+    zones = set()
+    volume_types = set()
+    for selector in filter(None, selectors.split(",")):
+        key, _, value = selector.partition("=")
+        if not value:
+            raise ValueError(
+                f"invalid storage pool spec {spec!r}: "
+                f"expected KEY=VALUE, got {selector!r}"
+            )
+        if key == "az":
+            zones.add(value)
+        elif key == "type":
+            volume_types.add(value)
+        else:
+            raise ValueError(
+                f"invalid storage pool spec {spec!r}: "
+                f"unknown selector {key!r}"
+            )
+    return PoolSpec(name, frozenset(zones), frozenset(volume_types))
+
+
+def get_headroom(pool: StoragePool, provisioned: int) -> int:
+    """Return how many more bytes can be provisioned in *pool*."""
+    accountant = pool.accountant
+    limits = accountant.limits
+    if accountant.capacity is None:
+        return 0
+    headroom = int(accountant.capacity * limits.max_fill) - (
+        accountant.allocation
+    )
+    if limits.overcommit_ratio:
+        headroom = min(
+            headroom,
+            int(accountant.capacity * limits.overcommit_ratio) - provisioned,
+        )
+    return max(headroom, 0)
+
+
+def rank_pools(
+    pools: Sequence[StoragePool],
+    *,
+    policy: str,
+    provisioned: Mapping[str, int],
+    load: Optional[Mapping[str, float]] = None,
+) -> List[StoragePool]:
+    """Order *pools* from most to least preferred for a new volume.
+
+    *provisioned* maps pool names to bytes provisioned in them, *load*
+    to their current I/O rate, which the "load" policy needs.
+    """
+
+    def _headroom(pool: StoragePool) -> int:
+        return get_headroom(pool, provisioned.get(pool.name, 0))
+
+    if policy == "load":
+        loads = load or {}
+        return sorted(
+            pools, key=lambda p: (loads.get(p.name, 0.0), -_headroom(p))
+        )
+    else:
+        return sorted(pools, key=lambda p: -_headroom(p))
@@ -0,0 +1,339 @@
+from __future__ import annotations
+from typing import (
+    Any,
+    Dict,
+    Mapping,
+    NamedTuple,
+    Optional,
+    Set,
+)
+
+import json
+import textwrap
+
+import libvirt
+
+
+FORMATS = {"raw", "qcow2"}
+PREALLOCATION_MODES = {"off", "metadata", "falloc", "full"}
+
+# Allowed values of disk driver attributes, None means "any number".
+DRIVER_ATTRIBUTES: Dict[str, Optional[Set[str]]] = {
+    "cache": {"default", "none", "writethrough", "writeback", "directsync"},
+    "io": {"threads", "native", "io_uring"},
+    "iothread": None,
+    "queues": None,
+    "discard": {"ignore", "unmap"},
+    "detect_zeroes": {"off", "on", "unmap"},
+}
+
+
+class DriverOptions(NamedTuple):
+    """Disk driver settings used when attaching a volume.
+
+    None leaves the setting to libvirt.  *iothread* and *queues* may
+    be "auto": use one of the domain's iothreads round-robin, and as
+    many queues as the domain has vCPUs, respectively.
+    """
+
+    cache: Optional[str] = None
+    io: Optional[str] = None
+    iothread: Optional[str] = None
+    queues: Optional[str] = None
+    discard: Optional[str] = None
+    detect_zeroes: Optional[str] = None
+
+
+_GENERAL_DRIVER = DriverOptions(
+    cache="none",
+    io="threads",
+    discard="unmap",
+    detect_zeroes="unmap",
+)
+
+_FAST_DRIVER = DriverOptions(
+    cache="none",
+    io="native",
+    iothread="auto",
+    queues="auto",
+    discard="unmap",
+    detect_zeroes="unmap",
+)
+
+# Guest discards would punch holes into preallocated images.
+_PREALLOCATED_DRIVER = _FAST_DRIVER._replace(
+    discard="ignore",
+    detect_zeroes="on",
+)
+
+
+class VolumeProfile(NamedTuple):
+    """On-disk layout and attach settings of an EBS volume type."""
+
+    format: str = "qcow2"
+    # qcow2 cluster size in bytes, None for the qemu default (64 KiB).
+    cluster_size: Optional[int] = None
+    preallocation: str = "metadata"
+    extended_l2: bool = False
+    lazy_refcounts: bool = True
+    # Pass guest discards down, so that thin images shrink as guests
+    # free blocks.
+    driver: DriverOptions = _GENERAL_DRIVER
+
+
+DEFAULT_PROFILES: Dict[str, VolumeProfile] = {
+    # General purpose: thin qcow2, as all volumes used to be.
+    "standard": VolumeProfile(driver=_GENERAL_DRIVER),
+    "gp2": VolumeProfile(driver=_GENERAL_DRIVER),
+    "gp3": VolumeProfile(
+        cluster_size=128 * 1024,
+        extended_l2=True,
+        driver=_FAST_DRIVER,
+    ),
+    # Provisioned IOPS: fully allocated raw images, no qcow2 metadata
+    # lookups and no allocation on first write.
+    "io1": VolumeProfile(
+        format="raw",
+        preallocation="falloc",
+        driver=_PREALLOCATED_DRIVER,
+    ),
+    "io2": VolumeProfile(
+        format="raw",
+        preallocation="full",
+        driver=_PREALLOCATED_DRIVER,
+    ),
+    # Throughput optimized: large clusters for sequential I/O.
+    "st1": VolumeProfile(
+        cluster_size=2 * 1024 * 1024,
+        driver=_GENERAL_DRIVER,
+    ),
+    # Cold: as thin as possible.
+    "sc1": VolumeProfile(preallocation="off", driver=_GENERAL_DRIVER),
+}
+
+
+def load_profiles(path: Optional[str]) -> Dict[str, VolumeProfile]:
+    """Return volume profiles, with overrides from JSON file *path*.
+
+    The file maps volume type names to objects with VolumeProfile
+    fields, "driver" being an object with DriverOptions fields.  Fields
+    that are not given keep their defaults, unknown volume types are
+    added.
+    """
+    profiles = dict(DEFAULT_PROFILES)
+    if path is None:
+        return profiles
+
+    with open(path) as f:
+        overrides = json.load(f)
+    if not isinstance(overrides, dict):
+        raise ValueError(f"{path}: expected an object of volume types")
+
+    for voltype, fields in overrides.items():
+        base = profiles.get(voltype, VolumeProfile())
+        profiles[voltype] = _make_profile(voltype, base, fields)
+
+    return profiles
+
+
+def _make_profile(
+    voltype: str,
+    base: VolumeProfile,
+    fields: Mapping[str, Any],
+) -> VolumeProfile:
+    unknown = set(fields) - set(VolumeProfile._fields)
+    if unknown:
+        raise ValueError(
+            f"volume type {voltype}: unknown profile settings: "
+            f"{', '.join(sorted(unknown))}"
+        )
+    fields = dict(fields)
+    if "driver" in fields:
+        fields["driver"] = make_driver_options(base.driver, fields["driver"])
+    profile = base._replace(**fields)
+    if profile.format not in FORMATS:
+        raise ValueError(
+            f"volume type {voltype}: unsupported format {profile.format!r}"
+        )
+    if profile.preallocation not in PREALLOCATION_MODES:
+        raise ValueError(
+            f"volume type {voltype}: unsupported preallocation "
+            f"{profile.preallocation!r}"
+        )
+    if profile.format == "qcow2" and profile.preallocation == "full":
+        raise ValueError(
+            f"volume type {voltype}: full preallocation requires raw format"
+        )
+    if profile.extended_l2 and (profile.cluster_size or 0) < 16 * 1024:
+        raise ValueError(
+            f"volume type {voltype}: extended_l2 requires a cluster_size "
+            f"of at least 16 KiB"
+        )
+    return profile
+
+
+def make_driver_options(
+    base: DriverOptions,
+    fields: Mapping[str, Any],
+) -> DriverOptions:
+    """Return *base* with *fields* overridden, raise ValueError if invalid."""
+    unknown = set(fields) - set(DriverOptions._fields)
+    if unknown:
+        raise ValueError(
+            f"unknown driver settings: {', '.join(sorted(unknown))}"
+        )
+    for name, value in fields.items():
+        if value is None:
+            continue
+        allowed = DRIVER_ATTRIBUTES[name]
+        if allowed is None:
+            if value != "auto" and not str(value).isdigit():
+                raise ValueError(
+                    f"driver setting {name} must be a number or 'auto'"
+                )
+        elif value not in allowed:
+            raise ValueError(
+                f"unsupported driver setting {name}={value!r}, "
+                f"expected one of {', '.join(sorted(allowed))}"
+            )
+    options = base._replace(
+        **{k: str(v) if v is not None else None for k, v in fields.items()}
+    )
+    if options.io == "native" and options.cache not in {"none", "directsync"}:
+        raise ValueError("io=native requires cache=none or cache=directsync")
+    return options
+
+
+def resolve_driver_options(
+    options: DriverOptions,
+    *,
+    iothreads: int,
+    vcpus: int,
+    used_iothreads: Mapping[int, int],
+) -> Dict[str, str]:
+    """Return disk driver attributes for attaching to a domain.
+
+    *used_iothreads* maps iothread ids of the domain to the number of
+    disks already using them.  "auto" settings the domain cannot honor
+    are dropped.
+    """
+    attrs = {k: v for k, v in options._asdict().items() if v is not None}
+
+    if attrs.get("iothread") == "auto":
+        if iothreads:
+            ids = range(1, iothreads + 1)
+            attrs["iothread"] = str(
+                min(ids, key=lambda i: (used_iothreads.get(i, 0), i))
+            )
+        else:
+            del attrs["iothread"]
+
+    if attrs.get("queues") == "auto":
+        if vcpus > 1:
+            attrs["queues"] = str(vcpus)
+        else:
+            del attrs["queues"]
+
+    return attrs
+
+
+def volume_xml(
+    volname: str,
+    size: int,
+    profile: VolumeProfile,
+    *,
+    backing_path: Optional[str] = None,
+    backing_format: str = "qcow2",
+) -> str:
+    """Return libvirt XML of a volume of *size* GiB laid out per *profile*.
+
+    With *backing_path* the volume is a thin qcow2 overlay regardless of
+    the profile format and preallocation.
+    """
+    if backing_path is not None:
+        profile = profile._replace(format="qcow2", preallocation="off")
+        backing = f"""
+        <backingStore>
+            <path>{backing_path}</path>
+            <format type='{backing_format}'/>
+        </backingStore>"""
+    else:
+        backing = ""
+
+    if profile.preallocation in {"falloc", "full"}:
+        allocation = size
+    else:
+        allocation = 0
+
+    if profile.format == "qcow2":
+        features = ["<lazy_refcounts/>"] if profile.lazy_refcounts else []
+        if profile.extended_l2:
+            features.append("<extended_l2/>")
+        cluster_size = (
+            f"\n            <clusterSize unit='B'>{profile.cluster_size}"
+            f"</clusterSize>"
+            if profile.cluster_size
+            else ""
+        )
+        qcow2_opts = f"""
+            <compat>1.1</compat>{cluster_size}
+            <features>
+                {"".join(features)}
+            </features>"""
+    else:
+        qcow2_opts = ""
+
+    return textwrap.dedent(
+        f"""\
+    <volume type='file'>
+        <name>{volname}</name>
+        <capacity unit="G">{size}</capacity>
+        <allocation unit="G">{allocation}</allocation>{backing}
+        <target>
+            <path>{volname}</path>
+            <permissions>
+                <mode>0644</mode>
+            </permissions>
+            <format type='{profile.format}'/>{qcow2_opts}
+        </target>
+    </volume>"""
+    )
+
+
+def block_volume_xml(
+    volname: str,
+    size: int,
+    *,
+    origin_path: Optional[str] = None,
+) -> str:
+    """Return libvirt XML of a volume of *size* GiB in a logical pool.
+
+    Block volumes are raw and fully allocated whatever the profile:
+    libvirt does not create LVs in thin pools, and its sparse LVs stop
+    taking writes once their copy-on-write space runs out.  With
+    *origin_path* the volume is an LVM snapshot of that LV.
+    """
+    if origin_path is not None:
+        origin = f"""
+        <backingStore>
+            <path>{origin_path}</path>
+        </backingStore>"""
+    else:
+        origin = ""
+
+    return textwrap.dedent(
+        f"""\
+    <volume type='block'>
+        <name>{volname}</name>
+        <capacity unit="G">{size}</capacity>
+        <allocation unit="G">{size}</allocation>{origin}
+    </volume>"""
+    )
+
+
+def create_flags(profile: VolumeProfile) -> int:
+    """Return virStoragePool.createXML() flags for *profile*."""
+    if profile.format == "qcow2" and profile.preallocation == "metadata":
+        return int(libvirt.VIR_STORAGE_VOL_CREATE_PREALLOC_METADATA)
+    else:
+        return 0
@@ -56,16 +56,21 @@ async def agent_exec(
     args: List[str],
     *,
     env: Optional[Mapping[str, Any]] = None,
+    input: Optional[bytes] = None,
     timeout_sec: float = 5.0,
 ) -> RemoteProcess:
+    arguments: Dict[str, Any] = {
+        "path": args[0],
+        "arg": args[1:],
+        "env": [f"{k}={v}" for k, v in env.items()] if env else [],
+        "capture-output": True,
+    }
+    if input is not None:
+        arguments["input-data"] = base64.b64encode(input).decode("ascii")
+
     command = {
         "execute": "guest-exec",
-        "arguments": {
-            "path": args[0],
-            "arg": args[1:],
-            "env": [f"{k}={v}" for k, v in env.items()] if env else [],
-            "capture-output": True,
-        },
+        "arguments": arguments,
     }
 
     result = await agent_command(domain, command)
@@ -0,0 +1,188 @@
+from __future__ import annotations
+from typing import (
+    Callable,
+    List,
+    NamedTuple,
+    Optional,
+)
+
+import asyncio
+import json
+import re
+
+from . import tasks
+
+ProgressCallback = Callable[[float], None]
+
+_PROGRESS_RE = re.compile(r"\((\d+(?:\.\d+)?)/100%\)")
+
+
+class QemuImgError(Exception):
+    pass
+
+
+class Extent(NamedTuple):
+    """A range of guest data as reported by qemu-img map."""
+
+    start: int
+    length: int
+    # Index of the image in the backing chain the data comes from,
+    # 0 is the image itself.
+    depth: int
+    present: bool
+    zero: bool
+    data: bool
+    # Offset of the data in the image file at *depth*, if it is stored
+    # there as is.
+    offset: Optional[int]
+
+
+class ImageInfo(NamedTuple):
+    format: str
+    virtual_size: int
+    backing_filename: Optional[str]
+    # External data file of a qcow2 image, which holds the guest data
+    # instead of the image itself.
+    data_file: Optional[str] = None
+
+
+async def info(path: str, *, fmt: Optional[str] = None) -> ImageInfo:
+    """Return the format, size and external files of the image at *path*.
+
+    Without *fmt* the format is probed from the image contents.  The
+    image is opened without locking, like by the other read-only
+    commands.
+    """
+    opts = ["-f", fmt] if fmt is not None else []
+    out = await run("info", "--output=json", "-U", *opts, path)
+    return parse_info(out)
+
+
+def parse_info(out: bytes) -> ImageInfo:
+    data = json.loads(out)
+    specific = data.get("format-specific") or {}
+    return ImageInfo(
+        format=data["format"],
+        virtual_size=data["virtual-size"],
+        backing_filename=data.get("backing-filename"),
+        data_file=(specific.get("data") or {}).get("data-file"),
+    )
+
+
+async def map_extents(
+    path: str,
+    *,
+    start: int = 0,
+    length: Optional[int] = None,
+    fmt: str = "qcow2",
+) -> List[Extent]:
+    """Return the allocation map of the image at *path* and its backing chain.
+
+    The image is opened without locking, so it must not be written to
+    concurrently, which holds for snapshot images.
+    """
+    opts = ["--start-offset", str(start)]
+    if length is not None:
+        opts += ["--max-length", str(length)]
+    out = await run("map", "--output=json", "-U", "-f", fmt, *opts, path)
+    return [
+        Extent(
+            start=e["start"],
+            length=e["length"],
+            depth=e["depth"],
+            present=e.get("present", True),
+            zero=e["zero"],
+            data=e["data"],
+            offset=e.get("offset"),
+        )
+        for e in json.loads(out)
+    ]
+
+
+async def rebase(
+    path: str,
+    backing: Optional[str],
+    *,
+    backing_format: str = "qcow2",
+    progress: Optional[ProgressCallback] = None,
+    low_priority: bool = False,
+) -> None:
+    """Rebase the qcow2 image at *path* onto *backing*.
+
+    Data that differs between the old and the new backing chain is
+    copied into the image, so the image keeps its content.  With
+    *backing* of None the image is flattened into a standalone one.
+    The image must not be in use.  *progress* is called with the
+    completion percentage as the rebase goes.  With *low_priority*
+    qemu-img runs at the lowest CPU and I/O priority.
+    """
+    opts = ["-p"] if progress is not None else []
+    if backing is None:
+        opts += ["-b", ""]
+    else:
+        opts += ["-F", backing_format, "-b", backing]
+    await run(
+        "rebase",
+        "-f",
+        "qcow2",
+        *opts,
+        path,
+        progress=progress,
+        low_priority=low_priority,
+    )
+
+
+async def run(
+    *args: str,
+    progress: Optional[ProgressCallback] = None,
+    low_priority: bool = False,
+) -> bytes:
+    """Run qemu-img with *args* and return its standard output.
+
+    If *progress* is given, it is called with the percentage reported
+    by qemu-img -p.
+    """
+    prefix = tasks.low_priority_command() if low_priority else []
+    proc = await asyncio.create_subprocess_exec(
+        *prefix,
+        "qemu-img",
+        *args,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+    )
+    if progress is None:
+        stdout, stderr = await proc.communicate()
+    else:
+        stdout, stderr = await _communicate_progress(proc, progress)
+    if proc.returncode != 0:
+        raise QemuImgError(
+            f"qemu-img {args[0]} failed: {stderr.decode(errors='replace')}"
+        )
+    return stdout
+
+
+async def _communicate_progress(
+    proc: asyncio.subprocess.Process,
+    progress: ProgressCallback,
+) -> tuple[bytes, bytes]:
+    assert proc.stdout is not None and proc.stderr is not None
+    stderr_task = asyncio.create_task(proc.stderr.read())
+    stdout = bytearray()
+    # Progress is printed as "(NN.NN/100%)" lines terminated by "\r".
+    pending = ""
+    while True:
+        chunk = await proc.stdout.read(4096)
+        if not chunk:
+            break
+        stdout += chunk
+        *lines, pending = (pending + chunk.decode(errors="replace")).split(
+            "\r"
+        )
+        for line in lines:
+            m = _PROGRESS_RE.search(line)
+            if m:
+                progress(float(m.group(1)))
+
+    stderr = await stderr_task
+    await proc.wait()
+    return bytes(stdout), stderr
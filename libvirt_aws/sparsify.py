@@ -0,0 +1,38 @@
+from __future__ import annotations
+
+import asyncio
+import shutil
+
+from . import tasks
+
+
+class SparsifyError(Exception):
+    pass
+
+
+def is_available() -> bool:
+    return shutil.which("virt-sparsify") is not None
+
+
+async def sparsify_in_place(path: str, *, fmt: str = "qcow2") -> None:
+    """Return blocks unused by the filesystems in image *path* to the host.
+
+    Runs virt-sparsify at the lowest CPU and I/O priority.  The image
+    must not be in use.
+    """
+    proc = await asyncio.create_subprocess_exec(
+        *tasks.low_priority_command(),
+        "virt-sparsify",
+        "--in-place",
+        "--quiet",
+        "--format",
+        fmt,
+        path,
+        stdout=asyncio.subprocess.DEVNULL,
+        stderr=asyncio.subprocess.PIPE,
+    )
+    _, stderr = await proc.communicate()
+    if proc.returncode != 0:
+        raise SparsifyError(
+            f"virt-sparsify failed: {stderr.decode(errors='replace')}"
+        )
@@ -0,0 +1,135 @@
+from __future__ import annotations
+from typing import (
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    List,
+    Optional,
+    TypeVar,
+)
+
+import asyncio
+import contextlib
+import functools
+import logging
+import shutil
+
+from aiohttp import web
+
+
+T = TypeVar("T")
+
+AppTask = Callable[[web.Application], Awaitable[None]]
+CleanupContext = Callable[[web.Application], AsyncIterator[None]]
+Job = Callable[[], Awaitable[None]]
+
+
+def periodic(
+    name: str,
+    interval: float,
+    func: AppTask,
+) -> CleanupContext:
+    """Run *func* every *interval* seconds for the lifetime of the app.
+
+    Returns a cleanup context suitable for ``app.cleanup_ctx``.
+    Exceptions raised by *func* are logged and do not stop the task.
+    """
+
+    async def _loop(app: web.Application) -> None:
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await func(app)
+            except Exception:
+                app["logger"].exception(f"background task {name} failed")
+
+    async def _ctx(app: web.Application) -> AsyncIterator[None]:
+        task = asyncio.create_task(_loop(app), name=name)
+        yield
+        task.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await task
+
+    return _ctx
+
+
+class WorkQueue:
+    """A fixed-size pool of workers running submitted jobs in order.
+
+    Must be created in a running event loop.  Jobs still queued when
+    the queue is closed are dropped, so callers must persist whatever
+    is needed to resume them.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        workers: int,
+        logger: Optional[logging.Logger] = None,
+    ) -> None:
+        self._name = name
+        self._logger = logger or logging.getLogger("libvirt-aws")
+        self._queue: asyncio.Queue[Job] = asyncio.Queue()
+        self._workers: List[asyncio.Task[None]] = [
+            asyncio.create_task(self._work(), name=f"{name}-{i}")
+            for i in range(workers)
+        ]
+
+    def submit(self, job: Job) -> None:
+        self._queue.put_nowait(job)
+
+    async def join(self) -> None:
+        """Wait until all submitted jobs are done."""
+        await self._queue.join()
+
+    async def close(self) -> None:
+        for worker in self._workers:
+            worker.cancel()
+        for worker in self._workers:
+            with contextlib.suppress(asyncio.CancelledError):
+                await worker
+
+    async def _work(self) -> None:
+        while True:
+            job = await self._queue.get()
+            try:
+                await job()
+            except Exception:
+                self._logger.exception(f"{self._name} job failed")
+            finally:
+                self._queue.task_done()
+
+
+def work_queue(key: str, name: str, workers: int) -> CleanupContext:
+    """Create a :class:`WorkQueue` stored as ``app[key]``.
+
+    Returns a cleanup context suitable for ``app.cleanup_ctx``.
+    """
+
+    async def _ctx(app: web.Application) -> AsyncIterator[None]:
+        queue = WorkQueue(name, workers, app["logger"])
+        app[key] = queue
+        yield
+        await queue.close()
+
+    return _ctx
+
+
+async def run_blocking(func: Callable[..., T], *args: object) -> T:
+    """Run a blocking call, e.g. into libvirt, in the default executor."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, functools.partial(func, *args))
+
+
+def low_priority_command() -> List[str]:
+    """Return a command prefix to run a process at the lowest priority.
+
+    The process gets the CPU and, in the idle I/O class, the disk only
+    when nobody else wants them.
+    """
+    prefix = []
+    if shutil.which("ionice") is not None:
+        prefix += ["ionice", "-c", "3"]
+    if shutil.which("nice") is not None:
+        prefix += ["nice", "-n", "19"]
+    return prefix
@@ -0,0 +1,96 @@
+from __future__ import annotations
+import logging
+import sqlite3
+
+from aiohttp import web
+
+from libvirt_aws import main
+from libvirt_aws import objects
+from libvirt_aws.handlers import attachments
+
+
+def _make_app() -> web.Application:
+    app = web.Application()
+    app["db"] = sqlite3.connect(":memory:")
+    app["logger"] = logging.getLogger("test")
+    main.init_db(app["db"])
+    return app
+
+
+def test_attachment_detach_events() -> None:
+    app = _make_app()
+    db = app["db"]
+    with db:
+        attachments.begin_attach(db, "vol-1", "vm1", "vdb", {"io": "native"})
+    attachments.set_state(db, "vol-1", "vm1", "attached", expected="attaching")
+
+    with db:
+        attachments.begin_detach(db, "vol-1", "vm1", "vdb", "virtio-disk1")
+    assert attachments.get_states(db) == {
+        ("vol-1", "vm1"): ("vdb", "detaching")
+    }
+
+    # Events of unrelated devices are ignored.
+    attachments.handle_device_event(app, "removed", "vm1", "virtio-disk2")
+    attachments.handle_device_event(app, "removed", "vm2", "virtio-disk1")
+
+    attachments.handle_device_event(
+        app, "removal-failed", "vm1", "virtio-disk1"
+    )
+    record = attachments.get_attachment(db, "vol-1", "vm1")
+    assert record is not None
+    assert record.state == "attached"
+    assert record.driver_options == {"io": "native"}
+
+    with db:
+        attachments.begin_detach(db, "vol-1", "vm1", "vdb", None)
+    attachments.handle_device_event(app, "removed", "vm1", "virtio-disk1")
+    assert attachments.get_attachment(db, "vol-1", "vm1") is None
+
+
+def test_attachment_get_disk_serial() -> None:
+    assert attachments.get_disk_serial({"serial": "lvirtebs-vdb"}) == (
+        "lvirtebs-vdb"
+    )
+    assert attachments.get_disk_serial(
+        {"name": "/dev/vdb", "address": {"serial": "lvirtebs-vdb"}}
+    ) == ("lvirtebs-vdb")
+    assert attachments.get_disk_serial({"name": "/dev/vda"}) is None
+
+
+def test_attachment_targets() -> None:
+    assert attachments.target_name(0) == "vda"
+    assert attachments.target_name(25) == "vdz"
+    assert attachments.target_name(26) == "vdaa"
+    assert attachments.target_name(attachments.MAX_TARGETS - 1) == "vdzz"
+
+    assert attachments.allocate_target({"vda"}) == "vdb"
+    assert attachments.allocate_target(set()) == "vdb"
+    assert attachments.allocate_target({"vdb", "vdc", "vde"}) == "vdd"
+    taken = {
+        attachments.target_name(i) for i in range(attachments.MAX_TARGETS)
+    }
+    assert attachments.allocate_target(taken) is None
+
+
+def test_attachment_used_targets() -> None:
+    app = _make_app()
+    db = app["db"]
+    domain = objects.domain_from_xml(
+        """
+        <domain>
+          <name>vm1</name>
+          <devices>
+            <disk type='file' device='disk'>
+              <source file='/var/lib/libvirt/images/root.qcow2'/>
+              <target dev='vda' bus='virtio'/>
+            </disk>
+          </devices>
+        </domain>
+        """
+    )
+    with db:
+        attachments.begin_attach(db, "vol-1", "vm1", "vdb", {})
+        attachments.begin_attach(db, "vol-2", "vm2", "vdc", {})
+
+    assert attachments.get_used_targets(db, domain) == {"vda", "vdb"}
@@ -0,0 +1,87 @@
+from __future__ import annotations
+from typing import Any, Dict, List
+
+import asyncio
+import logging
+
+from aiohttp import web
+import pytest
+
+from libvirt_aws.handlers import _routing
+from libvirt_aws.handlers import batch
+
+
+def test_parse_batch() -> None:
+    steps, concurrency = batch.parse_batch(
+        {
+            "Requests": [
+                {
+                    "Action": "CreateVolume",
+                    "Size": 10,
+                    "AvailabilityZone": "us-east-2a",
+                    "Encrypted": False,
+                    "TagSpecification": [
+                        {"Tag": [{"Key": "k", "Value": "v"}]},
+                    ],
+                },
+                {"Action": "DeleteVolume", "VolumeId": "vol-1"},
+            ],
+            "MaxConcurrency": 2,
+        }
+    )
+    assert concurrency == 2
+    assert steps == [
+        batch.BatchStep(
+            "CreateVolume",
+            {
+                "Size": "10",
+                "AvailabilityZone": "us-east-2a",
+                "Encrypted": "false",
+                "TagSpecification": [{"Tag": [{"Key": "k", "Value": "v"}]}],
+            },
+        ),
+        batch.BatchStep("DeleteVolume", {"VolumeId": "vol-1"}),
+    ]
+
+
+@pytest.mark.parametrize(
+    "body",
+    [
+        [],
+        {},
+        {"Requests": []},
+        {"Requests": [{"Action": "DescribeVolumes"}]},
+        {"Requests": [{"Action": "DeleteVolume", "VolumeId": None}]},
+        {"Requests": [{"Action": "CreateVolume"}], "MaxConcurrency": 0},
+        {
+            "Requests": [
+                {"Action": "AttachVolume", "VolumeId": "vol-1"},
+                {"Action": "DeleteVolume", "VolumeId": "vol-1"},
+            ],
+        },
+        {"Requests": [{"Action": "DeleteVolume"}] * 501},
+    ],
+)
+def test_parse_batch_invalid(body: Any) -> None:
+    with pytest.raises(_routing.InvalidParameterError):
+        batch.parse_batch(body)
+
+
+def test_run_batch_errors() -> None:
+    app = web.Application()
+    app["logger"] = logging.getLogger("test")
+    app["storage_pools"] = {}
+    steps = [
+        batch.BatchStep("CreateVolume", {"AvailabilityZone": "a"}),
+        batch.BatchStep("AttachVolume", {"VolumeId": "vol-1"}),
+        batch.BatchStep("DeleteVolume", {}),
+    ]
+
+    results: List[Dict[str, Any]] = asyncio.run(
+        batch.run_batch(app, steps, 2)
+    )
+
+    assert [r["Error"]["Code"] for r in results] == [
+        "InvalidParameterValue"
+    ] * 3
+    assert results[1]["Error"]["Message"] == "missing required InstanceId"
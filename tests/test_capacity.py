@@ -0,0 +1,115 @@
+from __future__ import annotations
+from typing import List
+
+import json
+import sqlite3
+
+from aiohttp import web
+import pytest
+
+from libvirt_aws import capacity
+from libvirt_aws import main
+from libvirt_aws import placement
+from libvirt_aws.handlers import volumes
+
+GiB = 2**30
+
+
+def test_check_admission() -> None:
+    limits = capacity.CapacityLimits(overcommit_ratio=2.0, max_fill=0.9)
+    usage = capacity.PoolUsage(100 * GiB, 50 * GiB, 150 * GiB)
+
+    capacity.check_admission(usage, limits, 50 * GiB, preallocated=False)
+    with pytest.raises(capacity.CapacityError):
+        capacity.check_admission(usage, limits, 51 * GiB, preallocated=False)
+
+    capacity.check_admission(usage, limits, 40 * GiB, preallocated=True)
+    with pytest.raises(capacity.CapacityError):
+        capacity.check_admission(usage, limits, 41 * GiB, preallocated=True)
+
+    unlimited = limits._replace(overcommit_ratio=0)
+    capacity.check_admission(usage, unlimited, 1000 * GiB, preallocated=False)
+
+
+class _FakeVol:
+    def __init__(self, name: str, allocation: int) -> None:
+        self._name = name
+        self._allocation = allocation
+
+    def name(self) -> str:
+        return self._name
+
+    def info(self) -> List[int]:
+        return [0, 10 * GiB, self._allocation]
+
+
+class _FakePool:
+    def info(self) -> List[int]:
+        return [2, 100 * GiB, 10 * GiB, 90 * GiB]
+
+    def listAllVolumes(self, flags: int) -> List[_FakeVol]:
+        return [_FakeVol("a", 15 * GiB), _FakeVol("b", 5 * GiB)]
+
+
+def test_accountant() -> None:
+    accountant = capacity.CapacityAccountant(
+        _FakePool(), capacity.CapacityLimits(max_fill=0.5)
+    )
+    accountant.refresh()
+    # Volumes grew since libvirt last refreshed the pool.
+    assert accountant.allocation == 20 * GiB
+
+    accountant.admit(0, 20 * GiB, preallocated=True)
+    assert accountant.allocation == 40 * GiB
+    with pytest.raises(capacity.CapacityError):
+        accountant.admit(0, 20 * GiB, preallocated=True)
+
+    accountant.refresh()
+    assert accountant.allocation == 20 * GiB
+
+
+def test_provisioned_size() -> None:
+    app = web.Application()
+    app["db"] = sqlite3.connect(":memory:")
+    app["storage_pools"] = {
+        name: placement.StoragePool(
+            name,
+            None,
+            frozenset(),
+            frozenset(),
+            capacity.CapacityAccountant(None, capacity.CapacityLimits()),
+        )
+        for name in ("p1", "p2")
+    }
+    main.init_db(app["db"])
+    with app["db"]:
+        app["db"].executemany(
+            """
+                INSERT INTO volumes
+                    (id, availability_zone, volume_type, size, status,
+                     volume_name, pool)
+                VALUES (?, 'az', 'gp2', ?, ?, ?, ?)
+            """,
+            [
+                ("v1", 10, "available", "v1", "p1"),
+                ("v2", 20, "creating", "v2", "p1"),
+                ("v3", 30, "error", "v3", "p1"),
+                ("v4", 40, "available", "v4", "p2"),
+                # From before multiple pools, in the first one.
+                ("v5", 50, "available", "v5", None),
+            ],
+        )
+        app["db"].execute(
+            """
+                INSERT INTO volume_modification_history
+                    (volume_id, job, state, start_time, modification, params)
+                VALUES ('v1', 'modify', 'modifying', '', '{}', ?)
+            """,
+            [json.dumps({"size": 15})],
+        )
+
+    assert volumes.get_provisioned_sizes(app) == {
+        "p1": 10 + 20 + 5 + 50,
+        "p2": 40,
+    }
+    assert volumes.get_provisioned_size(app, "p3") == 0
@@ -0,0 +1,168 @@
+from __future__ import annotations
+
+from typing import (
+    Any,
+    List,
+    Sequence,
+    Tuple,
+)
+
+import sqlite3
+
+import pytest
+
+from libvirt_aws import main
+
+
+# Queries on the request path that must never degrade to full table scans.
+HOT_QUERIES: List[Tuple[str, Sequence[Any]]] = [
+    (
+        """
+            SELECT resource_name FROM tags
+            WHERE tagname = ? AND resource_type = 'volume'
+            AND tagvalue IN (?, ?)
+        """,
+        ["Name", "foo", "bar"],
+    ),
+    (
+        """
+            SELECT resource_name FROM tags
+            WHERE
+                resource_type = 'ip_address'
+                AND (tagname = ? AND tagvalue IN (?))
+        """,
+        ["Name", "foo"],
+    ),
+    (
+        """
+            SELECT resource_name, tagname, tagvalue FROM tags
+            WHERE resource_type = 'ip_address' AND resource_name IN (?, ?)
+        """,
+        ["192.0.2.1", "192.0.2.2"],
+    ),
+    (
+        """
+            SELECT ip_address, instance_id, allocation_id, association_id
+            FROM ip_addresses
+            WHERE instance_id IN (?)
+        """,
+        ["i-1"],
+    ),
+    (
+        """
+            SELECT ip_address
+            FROM private_ip_addresses
+            WHERE
+                instance_id = ?
+                AND interface = ?
+                AND ip_address IN (?, ?)
+        """,
+        ["i-1", "eth0", "192.0.2.1", "192.0.2.2"],
+    ),
+    (
+        """
+            SELECT seq, volume_id, modification
+            FROM volume_modification_history
+            WHERE volume_id IN (?, ?)
+            ORDER BY volume_id, seq DESC
+        """,
+        ["vol-1", "vol-2"],
+    ),
+]
+
+
+@pytest.fixture
+def db() -> sqlite3.Connection:
+    conn = sqlite3.connect(":memory:")
+    main.init_db(conn)
+    return conn
+
+
+def _query_plan(
+    db: sqlite3.Connection,
+    query: str,
+    args: Sequence[Any],
+) -> List[str]:
+    cur = db.execute(f"EXPLAIN QUERY PLAN {query}", args)
+    return [row[3] for row in cur.fetchall()]
+
+
+@pytest.mark.parametrize("query,args", HOT_QUERIES)
+def test_db_hot_queries_use_indexes(
+    db: sqlite3.Connection,
+    query: str,
+    args: Sequence[Any],
+) -> None:
+    plan = _query_plan(db, query, args)
+    assert plan
+    for step in plan:
+        if step.startswith(("SCAN", "SEARCH")):
+            assert step.startswith("SEARCH") and "INDEX" in step, plan
+
+
+def test_db_migrations_apply_once(db: sqlite3.Connection) -> None:
+    assert main.get_db_version(db) == len(main.MIGRATIONS)
+    # Re-running must be a no-op.
+    main.init_db(db)
+    assert main.get_db_version(db) == len(main.MIGRATIONS)
+
+
+def test_db_migrations_upgrade_unversioned(tmp_path: Any) -> None:
+    # Databases created before schema versioning have all of the
+    # initial tables but user_version = 0.
+    conn = sqlite3.connect(tmp_path / "legacy.db")
+    with conn:
+        for stmt in main.MIGRATIONS[0]:
+            conn.execute(stmt)
+        conn.execute(
+            """
+                INSERT INTO tags
+                    (resource_name, resource_type, tagname, tagvalue)
+                VALUES ('vol', 'volume', 'Name', 'foo')
+            """
+        )
+    assert main.get_db_version(conn) == 0
+
+    main.init_db(conn)
+
+    assert main.get_db_version(conn) == len(main.MIGRATIONS)
+    cur = conn.execute("SELECT resource_name FROM tags")
+    assert cur.fetchall() == [("vol",)]
+
+
+def test_db_migrations_keep_volume_modifications(tmp_path: Any) -> None:
+    conn = sqlite3.connect(tmp_path / "v11.db")
+    for migration in main.MIGRATIONS[:11]:
+        with conn:
+            for stmt in migration:
+                conn.execute(stmt)
+    conn.execute("PRAGMA user_version = 11")
+    with conn:
+        conn.execute(
+            """
+                INSERT INTO volume_modifications (id, modifications)
+                VALUES ('vol-1', ?)
+            """,
+            [
+                '{"volumeId": "vol-1", "modificationState": "completed", '
+                '"startTime": "2024-01-01T00:00:00.000000000Z"}'
+            ],
+        )
+
+    main.init_db(conn)
+
+    cur = conn.execute(
+        """
+            SELECT volume_id, job, state, start_time
+            FROM volume_modification_history
+        """
+    )
+    assert cur.fetchall() == [
+        ("vol-1", "modify", "completed", "2024-01-01T00:00:00.000000000Z")
+    ]
+
+
+def test_db_rejects_newer_schema(db: sqlite3.Connection) -> None:
+    db.execute(f"PRAGMA user_version = {len(main.MIGRATIONS) + 1}")
+    with pytest.raises(RuntimeError):
+        main.init_db(db)
@@ -0,0 +1,67 @@
+from __future__ import annotations
+
+import pathlib
+
+import pytest
+
+from libvirt_aws import qemu_img
+from libvirt_aws.handlers import _paging
+from libvirt_aws.handlers import ebs
+
+BS = ebs.BLOCK_SIZE
+
+
+def _extent(
+    start: int,
+    length: int,
+    *,
+    depth: int = 0,
+    data: bool = True,
+    offset: int | None = None,
+) -> qemu_img.Extent:
+    return qemu_img.Extent(
+        start=start,
+        length=length,
+        depth=depth,
+        present=True,
+        zero=not data,
+        data=data,
+        offset=offset,
+    )
+
+
+def test_ebs_block_indexes() -> None:
+    extents = [
+        _extent(0, 4096),
+        _extent(4096, BS),
+        _extent(3 * BS, 2 * BS + 1),
+    ]
+    assert list(ebs._block_indexes(extents)) == [0, 1, 3, 4, 5]
+
+
+def test_ebs_read_block(tmp_path: pathlib.Path) -> None:
+    top = tmp_path / "top"
+    base = tmp_path / "base"
+    top.write_bytes(b"x" * 100 + b"T" * 16)
+    base.write_bytes(b"B" * 16)
+
+    extents = [
+        _extent(BS, 8, depth=0, offset=100),
+        _extent(BS + 8, 8, data=False),
+        _extent(BS + 16, 8, depth=1, offset=0),
+    ]
+    data = ebs._read_block([str(top), str(base)], extents, BS, 32)
+    assert data == b"T" * 8 + b"\0" * 8 + b"B" * 8 + b"\0" * 8
+
+
+def test_ebs_paging() -> None:
+    token = _paging.encode_next_token(["7"])
+    assert ebs._get_paging({"pageToken": token}) == (ebs.MAX_RESULTS, 7)
+    assert ebs._get_paging(
+        {"pageToken": token, "startingBlockIndex": "9", "maxResults": "100"}
+    ) == (100, 9)
+
+    for bad in ("garbage", _paging.encode_next_token(["x"])):
+        with pytest.raises(ebs.ValidationError) as excinfo:
+            ebs._get_paging({"pageToken": bad})
+        assert excinfo.value.code == "ValidationException"
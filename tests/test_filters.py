@@ -0,0 +1,110 @@
+from __future__ import annotations
+from typing import Any
+
+import sqlite3
+
+import pytest
+
+from libvirt_aws import main
+from libvirt_aws.handlers import _filters
+from libvirt_aws.handlers import _routing
+
+FIELDS = {
+    "volume-id": _filters.Field(column="id"),
+    "size": _filters.Field(column="size", type=int),
+    "status": _filters.Field(getter=lambda v: [v["status"]]),
+}
+
+
+@pytest.fixture
+def db() -> sqlite3.Connection:
+    conn = sqlite3.connect(":memory:")
+    main.init_db(conn)
+    with conn:
+        conn.executemany(
+            """
+                INSERT INTO volumes
+                    (id, availability_zone, volume_type, size, create_time)
+                VALUES
+                    (?, 'us-east-2a', 'gp2', ?, '')
+            """,
+            [("vol-a", 1), ("vol-b", 2), ("vol-*", 3)],
+        )
+        conn.executemany(
+            """
+                INSERT INTO tags
+                    (resource_name, resource_type, tagname, tagvalue)
+                VALUES
+                    (?, 'volume', ?, ?)
+            """,
+            [("vol-a", "Name", "alpha"), ("vol-b", "N", "beta")],
+        )
+    return conn
+
+
+def _select(db: sqlite3.Connection, filters: list[Any]) -> list[str]:
+    compiled = _filters.compile_filters(
+        filters, FIELDS, resource_type="volume", id_column="id"
+    )
+    cur = db.execute(
+        f"SELECT id FROM volumes WHERE {compiled.where} ORDER BY id",
+        compiled.params,
+    )
+    return [row[0] for row in cur.fetchall()]
+
+
+def test_filters_columns_and_wildcards(db: sqlite3.Connection) -> None:
+    assert _select(db, [{"Name": "volume-id", "Value": ["vol-?"]}]) == [
+        "vol-*",
+        "vol-a",
+        "vol-b",
+    ]
+    assert _select(db, [{"Name": "volume-id", "Value": ["vol-\\*"]}]) == [
+        "vol-*",
+    ]
+    assert _select(
+        db,
+        [
+            {"Name": "volume-id", "Value": ["vol-a", "vol-b"]},
+            {"Name": "size", "Value": ["2"]},
+        ],
+    ) == ["vol-b"]
+
+
+def test_filters_tags(db: sqlite3.Connection) -> None:
+    # Single-character tag names must be handled like any other.
+    assert _select(db, [{"Name": "tag:N", "Value": ["beta"]}]) == ["vol-b"]
+    assert _select(db, [{"Name": "tag:Name", "Value": ["al*"]}]) == ["vol-a"]
+    assert _select(db, [{"Name": "tag-key", "Value": ["N*"]}]) == [
+        "vol-a",
+        "vol-b",
+    ]
+
+
+def test_filters_residual() -> None:
+    compiled = _filters.compile_filters(
+        [{"Name": "status", "Value": ["in-*"]}],
+        FIELDS,
+        resource_type="volume",
+        id_column="id",
+    )
+    assert not compiled.has_sql
+    assert compiled.match({"status": "in-use"})
+    assert not compiled.match({"status": "available"})
+
+
+def test_filters_invalid() -> None:
+    with pytest.raises(_routing.InvalidParameterError):
+        _filters.compile_filters(
+            [{"Name": "bogus", "Value": ["x"]}],
+            FIELDS,
+            resource_type="volume",
+            id_column="id",
+        )
+    with pytest.raises(_routing.InvalidParameterError):
+        _filters.compile_filters(
+            [{"Name": "size", "Value": ["big"]}],
+            FIELDS,
+            resource_type="volume",
+            id_column="id",
+        )
@@ -0,0 +1,66 @@
+from __future__ import annotations
+from typing import Any
+
+import pytest
+import xmltodict
+
+from libvirt_aws import iotune
+
+
+def test_iotune_defaults() -> None:
+    gp2 = iotune.get_iotune("gp2", 100)
+    assert gp2 == iotune.IoTune(300, 250, 3000, 0, 1800)
+    assert iotune.get_iotune("gp2", 2000) == iotune.IoTune(6000, 250)
+
+    gp3 = iotune.get_iotune("gp3", 10)
+    assert gp3 == iotune.IoTune(3000, 125)
+
+    st1 = iotune.get_iotune("st1", 2048)
+    assert st1 is not None
+    assert st1.throughput == 80
+    assert st1.burst_throughput == 500
+
+    assert iotune.get_iotune("scratch", 10) is None
+
+
+def test_iotune_provisioned() -> None:
+    assert iotune.get_iotune(
+        "gp3", 100, iops=6000, throughput=500
+    ) == iotune.IoTune(6000, 500)
+    assert iotune.get_iotune("io2", 100, iops=10000) == iotune.IoTune(
+        10000, 2500
+    )
+
+
+@pytest.mark.parametrize(
+    "volume_type,size,kwargs",
+    [
+        ("gp2", 100, {"iops": 1000}),
+        ("io1", 100, {}),
+        ("io1", 10, {"iops": 1000}),
+        ("io2", 100, {"iops": 5000, "throughput": 200}),
+        ("gp3", 100, {"iops": 2000}),
+        ("gp3", 100, {"throughput": 1000}),
+    ],
+)
+def test_iotune_invalid(
+    volume_type: str,
+    size: int,
+    kwargs: dict[str, Any],
+) -> None:
+    with pytest.raises(ValueError):
+        iotune.get_iotune(volume_type, size, **kwargs)
+
+
+def test_iotune_params() -> None:
+    tune = iotune.IoTune(300, 250, 3000, 0, 1800)
+    params = tune.to_params()
+    assert params["total_bytes_sec"] == 250 * 2**20
+    assert params["total_iops_sec_max_length"] == 1800
+    assert params["total_bytes_sec_max"] == 0
+    assert params["total_bytes_sec_max_length"] == 0
+
+    xml = xmltodict.parse(tune.to_xml())["iotune"]
+    assert xml["total_iops_sec"] == "300"
+    assert xml["total_iops_sec_max"] == "3000"
+    assert "total_bytes_sec_max" not in xml
@@ -0,0 +1,60 @@
+from __future__ import annotations
+
+import ipaddress
+import sqlite3
+
+import pytest
+
+from libvirt_aws import ipalloc
+from libvirt_aws import main
+
+START = ipaddress.IPv4Address("10.11.12.2")
+END = ipaddress.IPv4Address("10.11.12.10")
+
+
+@pytest.fixture
+def db() -> sqlite3.Connection:
+    conn = sqlite3.connect(":memory:")
+    main.init_db(conn)
+    ipalloc.ensure_pool(conn, "test", START, END, lambda: ["10.11.12.3"])
+    return conn
+
+
+def _free(db: sqlite3.Connection) -> int:
+    cur = db.execute("SELECT count(*) FROM ip_free_list WHERE pool = 'test'")
+    return int(cur.fetchone()[0])
+
+
+def test_ipalloc_allocate_skips_used(db: sqlite3.Connection) -> None:
+    with db:
+        addrs = ipalloc.allocate(db, "test", 3)
+    assert [str(a) for a in addrs] == [
+        "10.11.12.2",
+        "10.11.12.4",
+        "10.11.12.5",
+    ]
+    assert _free(db) == 4
+
+
+def test_ipalloc_allocate_is_all_or_nothing(db: sqlite3.Connection) -> None:
+    with pytest.raises(ipalloc.AddressPoolExhaustedError):
+        with db:
+            ipalloc.allocate(db, "test", 8)
+    assert _free(db) == 7
+
+
+def test_ipalloc_release(db: sqlite3.Connection) -> None:
+    with db:
+        (addr,) = ipalloc.allocate(db, "test")
+        ipalloc.release(db, "test", [addr, "192.0.2.1"])
+    assert _free(db) == 7
+    with db:
+        assert ipalloc.allocate(db, "test") == [addr]
+
+
+def test_ipalloc_range_change_rebuilds(db: sqlite3.Connection) -> None:
+    with db:
+        ipalloc.allocate(db, "test", 2)
+    new_end = END + 2
+    ipalloc.ensure_pool(db, "test", START, new_end, lambda: ["10.11.12.2"])
+    assert _free(db) == 9
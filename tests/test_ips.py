@@ -0,0 +1,167 @@
+from __future__ import annotations
+from typing import Any, List, Optional
+
+import asyncio
+import logging
+import sqlite3
+import time
+
+from aiohttp import web
+import pytest
+
+from libvirt_aws import main
+from libvirt_aws import qemu
+from libvirt_aws.handlers import _routing
+from libvirt_aws.handlers import ips
+
+NETWORK_XML = """
+<network>
+  <name>default</name>
+  <ip family='ipv4' address='10.0.0.1' prefix='24'>
+    <dhcp>
+      <range start='10.0.0.100' end='10.0.0.200'/>
+    </dhcp>
+  </ip>
+</network>
+"""
+
+INTERFACE_ID = "eni-vm1::eth0"
+
+
+class _FakeNet:
+    def XMLDesc(self, flags: int = 0) -> str:
+        return NETWORK_XML
+
+
+class _FakeConn:
+    def lookupByName(self, name: str) -> Any:
+        return object()
+
+
+class _FakeAgent:
+    """Stands in for guest-exec, failing with the queued outcomes."""
+
+    def __init__(self, outcomes: List[Any]) -> None:
+        self.outcomes = outcomes
+        self.scripts: List[str] = []
+
+    async def agent_exec(
+        self,
+        virdom: Any,
+        args: List[str],
+        *,
+        input: Optional[bytes] = None,
+    ) -> qemu.RemoteProcess:
+        self.scripts.append((input or b"").decode())
+        outcome = self.outcomes.pop(0) if self.outcomes else 0
+        if isinstance(outcome, Exception):
+            raise outcome
+        return qemu.RemoteProcess(1, outcome, b"", b"boom")
+
+
+def _make_app(
+    monkeypatch: pytest.MonkeyPatch,
+    outcomes: List[Any],
+) -> web.Application:
+    app = web.Application()
+    app["db"] = sqlite3.connect(":memory:")
+    app["logger"] = logging.getLogger("test")
+    app["libvirt"] = _FakeConn()
+    app["libvirt_net"] = _FakeNet()
+    main.init_db(app["db"])
+    app["agent"] = agent = _FakeAgent(outcomes)
+    monkeypatch.setattr(qemu, "agent_exec", agent.agent_exec)
+    return app
+
+
+def _assign(app: web.Application, count: int) -> Any:
+    async def _main() -> Any:
+        return await ips.assign_private_ip_addresses(
+            {
+                "NetworkInterfaceId": INTERFACE_ID,
+                "SecondaryPrivateIpAddressCount": str(count),
+            },
+            app,
+        )
+
+    return asyncio.run(_main())
+
+
+def _get_states(app: web.Application) -> List[Any]:
+    cur = app["db"].execute(
+        """
+            SELECT ip_address, state, reserved_at IS NULL
+            FROM private_ip_addresses
+            ORDER BY ip_address
+        """
+    )
+    return list(cur.fetchall())
+
+
+def test_assign_private_ips(monkeypatch: pytest.MonkeyPatch) -> None:
+    app = _make_app(monkeypatch, [0])
+
+    result = _assign(app, 2)
+
+    addrs = [
+        a["privateIpAddress"] for a in result["assignedPrivateIpAddressesSet"]
+    ]
+    assert len(addrs) == 2
+    assert app["agent"].scripts == [
+        "".join(f"addr add {addr} dev eth0\n" for addr in addrs)
+    ]
+    assert _get_states(app) == [(addr, "assigned", 1) for addr in addrs]
+
+
+@pytest.mark.parametrize(
+    "outcomes",
+    [
+        # The guest agent is unreachable.
+        [RuntimeError("no agent")],
+        # Some address could not be added, with the undo failing or not.
+        [2, RuntimeError("no agent")],
+        [2, 0],
+    ],
+)
+def test_assign_private_ips_failed(
+    monkeypatch: pytest.MonkeyPatch,
+    outcomes: List[Any],
+) -> None:
+    app = _make_app(monkeypatch, outcomes)
+
+    with pytest.raises(_routing.InternalServerError) as excinfo:
+        _assign(app, 2)
+
+    assert "could not assign address in VM" in excinfo.value.msg
+    # The reservation is gone and the addresses can be handed out again.
+    assert _get_states(app) == []
+    app["agent"].outcomes = [0]
+    _assign(app, 2)
+
+
+def test_sweep_private_ip_reservations(
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    app = _make_app(monkeypatch, [])
+    db = app["db"]
+    now = time.time()
+    with db:
+        db.executemany(
+            """
+                INSERT INTO private_ip_addresses
+                    (ip_address, instance_id, interface, state, reserved_at)
+                VALUES (?, 'vm1', 'eth0', ?, ?)
+            """,
+            [
+                ("10.0.0.20", "pending", now - ips.PRIVATE_IP_RESERVATION_TTL),
+                ("10.0.0.21", "pending", now),
+                ("10.0.0.22", "assigned", None),
+            ],
+        )
+
+    asyncio.run(ips.sweep_private_ip_reservations(app))
+
+    assert _get_states(app) == [
+        ("10.0.0.21", "pending", 0),
+        ("10.0.0.22", "assigned", 1),
+    ]
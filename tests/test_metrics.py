@@ -0,0 +1,52 @@
+from __future__ import annotations
+
+from libvirt_aws import metrics
+
+
+def test_series_query() -> None:
+    series = metrics.Series([(60, 10), (300, 10)])
+    for i in range(10):
+        series.add(60 * i, float(i))
+
+    points = series.query(0, 600, 60)
+    assert [p.sum for p in points] == [float(i) for i in range(10)]
+
+    points = series.query(0, 600, 300)
+    assert len(points) == 2
+    assert points[0].sum == 0 + 1 + 2 + 3 + 4
+    assert points[0].sample_count == 5
+    assert points[0].minimum == 0
+    assert points[1].maximum == 9
+    assert points[1].average == 7
+
+
+def test_series_downsampling() -> None:
+    series = metrics.Series([(60, 5), (300, 10)])
+    for i in range(20):
+        series.add(60 * i, 1.0)
+
+    # The raw tier only holds the last 5 minutes, older data comes
+    # from the 5 minute aggregates.
+    points = series.query(0, 1200, 60)
+    assert [p.timestamp for p in points] == [0, 300, 600, 900]
+    assert all(p.sample_count == 5 for p in points)
+
+    points = series.query(900, 1200, 60)
+    assert [p.timestamp for p in points] == [900, 960, 1020, 1080, 1140]
+
+
+def test_metric_store_delta() -> None:
+    store = metrics.MetricStore(60)
+    assert store.delta("vol/i-1", 0, {"rd.reqs": 10}) is None
+    assert store.delta("vol/i-1", 60, {"rd.reqs": 25}) == (
+        60,
+        {"rd.reqs": 15},
+    )
+    # Counters were reset.
+    assert store.delta("vol/i-1", 120, {"rd.reqs": 5}) is None
+
+    store.put(("vol", "VolumeReadOps"), 60, 15)
+    store.put(("other", "VolumeReadOps"), 60, 1)
+    store.retain(["other"])
+    assert store.keys() == [("other", "VolumeReadOps")]
+    assert store.delta("vol/i-1", 180, {"rd.reqs": 10}) is None
@@ -0,0 +1,58 @@
+from __future__ import annotations
+
+from libvirt_aws import objects
+
+DOMAIN_XML = """
+<domain type='kvm'>
+  <name>vm1</name>
+  <devices>
+    <disk type='file' device='disk'>
+      <source file='/var/lib/libvirt/images/root.qcow2'/>
+      <target dev='vda' bus='virtio'/>
+    </disk>
+    <disk type='volume' device='disk'>
+      <source pool='ebs' volume='vol-1.qcow2'/>
+      <target dev='vdb' bus='virtio'/>
+    </disk>
+    <disk type='file' device='disk'>
+      <source file='/srv/ebs/overlay.qcow2'/>
+      <target dev='vdc' bus='virtio'/>
+    </disk>
+    <disk type='block' device='disk'>
+      <source dev='/dev/ebs/vol-2.raw'/>
+      <target dev='vdd' bus='virtio'/>
+    </disk>
+    <disk type='file' device='cdrom'>
+      <target dev='sda' bus='sata'/>
+    </disk>
+  </devices>
+</domain>
+"""
+
+
+def test_domain_disks_in_pool() -> None:
+    domain = objects.domain_from_xml(DOMAIN_XML)
+    assert domain.disk_targets == ["vda", "vdb", "vdc", "vdd", "sda"]
+
+    in_pool = [d for d in domain.disks if d.in_pool("ebs", "/srv/ebs")]
+    # Volume disks turn into file disks after an external snapshot.
+    assert [(d.volume, d.target) for d in in_pool] == [
+        ("vol-1.qcow2", "vdb"),
+        ("overlay.qcow2", "vdc"),
+    ]
+    assert [d.attachment.device for d in in_pool] == ["vdb", "vdc"]
+
+    # LVs of logical pools are attached as block devices.
+    in_pool = [d for d in domain.disks if d.in_pool("lvm", "/dev/ebs")]
+    assert [(d.volume, d.target) for d in in_pool] == [("vol-2.raw", "vdd")]
+
+
+def test_pool_type() -> None:
+    xml = """
+        <pool type='logical'>
+          <name>lvm</name>
+          <target><path>/dev/ebs</path></target>
+        </pool>
+    """
+    assert objects._pool_type_from_xml(xml) == "logical"
+    assert objects._pool_path_from_xml(xml) == "/dev/ebs"
@@ -0,0 +1,98 @@
+from __future__ import annotations
+from typing import AbstractSet, Any, List
+
+import pytest
+
+from libvirt_aws import capacity
+from libvirt_aws import placement
+
+GiB = 2**30
+
+
+class _FakePool:
+    def __init__(self, size: int) -> None:
+        self.size = size
+
+    def info(self) -> List[int]:
+        return [2, self.size, 0, self.size]
+
+    def listAllVolumes(self, flags: int) -> List[Any]:
+        return []
+
+
+def _make_pool(
+    name: str,
+    size: int,
+    *,
+    zones: AbstractSet[str] = frozenset(),
+    volume_types: AbstractSet[str] = frozenset(),
+) -> placement.StoragePool:
+    accountant = capacity.CapacityAccountant(
+        _FakePool(size), capacity.CapacityLimits(max_fill=1.0)
+    )
+    accountant.refresh()
+    return placement.StoragePool(
+        name,
+        None,
+        frozenset(zones),
+        frozenset(volume_types),
+        accountant,
+    )
+
+
+def test_parse_pool_spec() -> None:
+    assert placement.parse_pool_spec("default") == placement.PoolSpec(
+        "default"
+    )
+    assert placement.parse_pool_spec(
+        "nvme:az=us-east-2a,az=us-east-2b,type=io2"
+    ) == placement.PoolSpec(
+        "nvme",
+        frozenset({"us-east-2a", "us-east-2b"}),
+        frozenset({"io2"}),
+    )
+    for spec in (":az=a", "nvme:az", "nvme:zone=a"):
+        with pytest.raises(ValueError):
+            placement.parse_pool_spec(spec)
+
+
+def test_accepts() -> None:
+    pool = _make_pool("p", GiB, zones={"a"}, volume_types={"io2"})
+    assert pool.accepts("a", "io2")
+    assert pool.accepts(None, "io2")
+    assert not pool.accepts("b", "io2")
+    assert not pool.accepts("a", "gp3")
+    assert _make_pool("any", GiB).accepts("b", "gp3")
+
+
+def test_is_block() -> None:
+    pool = _make_pool("p", GiB)
+    assert not pool.is_block
+    assert pool._replace(pool_type="logical").is_block
+
+
+def test_rank_pools() -> None:
+    small = _make_pool("small", 100 * GiB)
+    large = _make_pool("large", 200 * GiB)
+    pools = [small, large]
+
+    ranked = placement.rank_pools(pools, policy="capacity", provisioned={})
+    assert [p.name for p in ranked] == ["large", "small"]
+
+    # Overcommit counts against the headroom.
+    ranked = placement.rank_pools(
+        pools, policy="capacity", provisioned={"large": 150 * GiB}
+    )
+    assert [p.name for p in ranked] == ["small", "large"]
+
+    ranked = placement.rank_pools(
+        pools,
+        policy="load",
+        provisioned={},
+        load={"large": 1000.0, "small": 10.0},
+    )
+    assert [p.name for p in ranked] == ["small", "large"]
+
+    # Ties in load go to the pool with the most room.
+    ranked = placement.rank_pools(pools, policy="load", provisioned={})
+    assert [p.name for p in ranked] == ["large", "small"]
@@ -0,0 +1,120 @@
+from __future__ import annotations
+from typing import Any
+
+import json
+import pathlib
+
+import pytest
+import xmltodict
+
+from libvirt_aws import profiles
+
+
+def test_profiles_overrides(tmp_path: pathlib.Path) -> None:
+    path = tmp_path / "profiles.json"
+    path.write_text(
+        json.dumps(
+            {
+                "gp2": {"cluster_size": 65536, "extended_l2": True},
+                "scratch": {"preallocation": "off"},
+            }
+        )
+    )
+    loaded = profiles.load_profiles(str(path))
+    assert loaded["gp2"].extended_l2
+    assert loaded["gp2"].format == "qcow2"
+    assert loaded["scratch"].preallocation == "off"
+    assert loaded["io2"] == profiles.DEFAULT_PROFILES["io2"]
+
+
+@pytest.mark.parametrize(
+    "fields",
+    [
+        {"format": "vmdk"},
+        {"preallocation": "full"},
+        {"extended_l2": True},
+        {"iops": 3000},
+    ],
+)
+def test_profiles_invalid(
+    tmp_path: pathlib.Path,
+    fields: dict[str, Any],
+) -> None:
+    path = tmp_path / "profiles.json"
+    path.write_text(json.dumps({"gp2": fields}))
+    with pytest.raises(ValueError):
+        profiles.load_profiles(str(path))
+
+
+def test_profiles_volume_xml() -> None:
+    xml = profiles.volume_xml("v.raw", 10, profiles.DEFAULT_PROFILES["io1"])
+    vol = xmltodict.parse(xml)["volume"]
+    assert vol["target"]["format"]["@type"] == "raw"
+    assert vol["allocation"]["#text"] == "10"
+    assert "compat" not in vol["target"]
+
+    xml = profiles.volume_xml(
+        "v.qcow2",
+        10,
+        profiles.DEFAULT_PROFILES["io1"],
+        backing_path="/pool/base.raw",
+        backing_format="raw",
+    )
+    vol = xmltodict.parse(xml)["volume"]
+    assert vol["target"]["format"]["@type"] == "qcow2"
+    assert vol["allocation"]["#text"] == "0"
+    assert vol["backingStore"]["format"]["@type"] == "raw"
+
+    xml = profiles.volume_xml("v.qcow2", 10, profiles.DEFAULT_PROFILES["gp3"])
+    vol = xmltodict.parse(xml)["volume"]
+    assert vol["target"]["clusterSize"]["#text"] == "131072"
+    assert "extended_l2" in vol["target"]["features"]
+
+
+def test_profiles_block_volume_xml() -> None:
+    vol = xmltodict.parse(profiles.block_volume_xml("v.raw", 10))["volume"]
+    assert vol["@type"] == "block"
+    assert vol["allocation"]["#text"] == "10"
+    assert "backingStore" not in vol
+
+    xml = profiles.block_volume_xml(
+        "v.raw.tmp", 10, origin_path="/dev/ebs/v.raw"
+    )
+    vol = xmltodict.parse(xml)["volume"]
+    assert vol["backingStore"]["path"] == "/dev/ebs/v.raw"
+
+
+def test_profiles_driver_options() -> None:
+    gp3 = profiles.DEFAULT_PROFILES["gp3"].driver
+    opts = profiles.make_driver_options(gp3, {"cache": "directsync"})
+    assert opts.cache == "directsync"
+    assert opts.io == "native"
+
+    with pytest.raises(ValueError):
+        profiles.make_driver_options(gp3, {"cache": "writeback"})
+    with pytest.raises(ValueError):
+        profiles.make_driver_options(gp3, {"queues": "many"})
+    with pytest.raises(ValueError):
+        profiles.make_driver_options(gp3, {"aio": "native"})
+
+    attrs = profiles.resolve_driver_options(
+        gp3, iothreads=2, vcpus=4, used_iothreads={1: 3, 2: 1}
+    )
+    assert attrs["iothread"] == "2"
+    assert attrs["queues"] == "4"
+
+    attrs = profiles.resolve_driver_options(
+        gp3, iothreads=0, vcpus=1, used_iothreads={}
+    )
+    assert "iothread" not in attrs
+    assert "queues" not in attrs
+    assert attrs["io"] == "native"
+
+
+def test_profiles_discard() -> None:
+    assert profiles.VolumeProfile().driver.discard == "unmap"
+    assert profiles.DEFAULT_PROFILES["gp3"].driver.discard == "unmap"
+    # Preallocated images must stay allocated.
+    io2 = profiles.DEFAULT_PROFILES["io2"].driver
+    assert io2.discard == "ignore"
+    assert io2.detect_zeroes != "unmap"
@@ -0,0 +1,50 @@
+from __future__ import annotations
+from typing import List
+
+import asyncio
+import sys
+
+from libvirt_aws import qemu_img
+
+
+def test_qemu_img_progress() -> None:
+    reported: List[float] = []
+
+    async def _main() -> bytes:
+        proc = await asyncio.create_subprocess_exec(
+            sys.executable,
+            "-c",
+            "import sys\n"
+            "for p in ('0.00', '12.50', '100.00'):\n"
+            "    sys.stdout.write(f'    ({p}/100%)\\r')\n"
+            "    sys.stdout.flush()\n",
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+        )
+        stdout, _ = await qemu_img._communicate_progress(
+            proc, reported.append
+        )
+        return stdout
+
+    stdout = asyncio.run(_main())
+
+    assert reported == [0.0, 12.5, 100.0]
+    assert stdout.count(b"\r") == 3
+
+
+def test_qemu_img_parse_info() -> None:
+    info = qemu_img.parse_info(
+        b'{"virtual-size": 1073741824, "filename": "a.qcow2",'
+        b' "format": "qcow2", "backing-filename": "/etc/shadow"}'
+    )
+    assert info == qemu_img.ImageInfo("qcow2", 2**30, "/etc/shadow")
+
+    info = qemu_img.parse_info(b'{"virtual-size": 512, "format": "raw"}')
+    assert info.backing_filename is None
+
+    info = qemu_img.parse_info(
+        b'{"virtual-size": 512, "format": "qcow2", "format-specific":'
+        b' {"type": "qcow2", "data": {"data-file": "/dev/sda"}}}'
+    )
+    assert info.backing_filename is None
+    assert info.data_file == "/dev/sda"
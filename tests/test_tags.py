@@ -0,0 +1,170 @@
+from __future__ import annotations
+from typing import Any, Dict, List
+
+import asyncio
+import sqlite3
+
+from aiohttp import web
+import libvirt
+import pytest
+
+from libvirt_aws import main
+from libvirt_aws.handlers import _paging
+from libvirt_aws.handlers import _routing
+from libvirt_aws.handlers import tags
+
+
+class _FakeConn:
+    def __init__(self, domains: List[str]) -> None:
+        self.domains = domains
+
+    def lookupByName(self, name: str) -> Any:
+        if name not in self.domains:
+            raise libvirt.libvirtError(f"no domain {name}")
+        return object()
+
+
+def _make_app() -> web.Application:
+    app = web.Application()
+    app["db"] = sqlite3.connect(":memory:")
+    app["libvirt"] = _FakeConn(["vm1"])
+    main.init_db(app["db"])
+    with app["db"]:
+        app["db"].executemany(
+            """
+                INSERT INTO volumes
+                    (id, availability_zone, volume_type, size, status,
+                     volume_name)
+                VALUES (?, 'az', 'gp2', 1, ?, ?)
+            """,
+            [
+                ("vol-1", "available", "vol-1"),
+                # No libvirt volume yet.
+                ("vol-2", "creating", "vol-2"),
+                # The original image has become a snapshot.
+                ("vol-3", "available", "vol-3-1"),
+            ],
+        )
+        app["db"].execute(
+            "INSERT INTO snapshots (id, status) VALUES ('snap-1', 'completed')"
+        )
+        app["db"].execute(
+            """
+                INSERT INTO ip_addresses (allocation_id, ip_address)
+                VALUES ('eipalloc-1', '10.0.0.1')
+            """
+        )
+    return app
+
+
+def _tag_args(resource_ids: List[str], **tagset: str) -> Dict[str, Any]:
+    return {
+        "ResourceId": resource_ids,
+        "Tag": [{"Key": k, "Value": v} for k, v in tagset.items()],
+    }
+
+
+def _call(handler: Any, args: Dict[str, Any], app: web.Application) -> Any:
+    async def _main() -> Any:
+        return await handler(args, app)
+
+    return asyncio.run(_main())
+
+
+def _describe(app: web.Application, **args: Any) -> Dict[str, Any]:
+    result: Dict[str, Any] = _call(tags.describe_tags, args, app)
+    return result
+
+
+def _tagged(result: Dict[str, Any]) -> List[Any]:
+    return [(t["resourceId"], t["key"]) for t in result["tagSet"]]
+
+
+def test_tags_create_describe() -> None:
+    app = _make_app()
+    ids = ["vol-1", "vol-2", "vol-3", "snap-1", "eipalloc-1", "vm1"]
+    _call(tags.create_tags, _tag_args(ids, Name="a", env="dev"), app)
+
+    result = _describe(app)
+    assert len(result["tagSet"]) == 12
+    assert "nextToken" not in result
+    assert {
+        (t["resourceId"], t["resourceType"]) for t in result["tagSet"]
+    } == {
+        ("vol-1", "volume"),
+        ("vol-2", "volume"),
+        ("vol-3", "volume"),
+        ("snap-1", "snapshot"),
+        ("eipalloc-1", "elastic-ip"),
+        ("vm1", "instance"),
+    }
+
+    result = _describe(
+        app,
+        Filter=[
+            {"Name": "resource-type", "Value": ["volume"]},
+            {"Name": "key", "Value": ["env"]},
+        ],
+    )
+    assert _tagged(result) == [
+        ("vol-1", "env"),
+        ("vol-2", "env"),
+        ("vol-3", "env"),
+    ]
+
+    result = _describe(
+        app, Filter=[{"Name": "resource-id", "Value": ["eipalloc-1"]}]
+    )
+    assert _tagged(result) == [("eipalloc-1", "Name"), ("eipalloc-1", "env")]
+
+    for bad_id in ("vol-9", "snap-9", "eipalloc-9"):
+        with pytest.raises(tags.InvalidIDError):
+            _call(tags.create_tags, _tag_args([bad_id], k="v"), app)
+    with pytest.raises(_routing.InvalidParameterError):
+        _describe(app, Filter=[{"Name": "resource-type", "Value": ["vpc"]}])
+
+
+def test_tags_paging() -> None:
+    app = _make_app()
+    ids = ["vol-1", "vol-2", "vol-3"]
+    _call(tags.create_tags, _tag_args(ids, a="1", b="2"), app)
+
+    seen = []
+    next_token = None
+    while True:
+        args: Dict[str, Any] = {"MaxResults": "5"}
+        if next_token is not None:
+            args["NextToken"] = next_token
+        result = _describe(app, **args)
+        seen.extend(_tagged(result))
+        next_token = result.get("nextToken")
+        if next_token is None:
+            break
+        assert len(result["tagSet"]) == 5
+
+    assert seen == [(v, k) for v in ids for k in ("a", "b")]
+
+    with pytest.raises(_paging.InvalidNextTokenError):
+        _describe(app, NextToken="garbage")
+
+
+def test_tags_delete() -> None:
+    app = _make_app()
+    _call(tags.create_tags, _tag_args(["vol-1", "vol-2"], a="1", b="2"), app)
+
+    # Only tags with the given value go.
+    _call(
+        tags.delete_tags,
+        {"ResourceId": ["vol-1"], "Tag": [{"Key": "a", "Value": "x"}]},
+        app,
+    )
+    _call(
+        tags.delete_tags,
+        {"ResourceId": ["vol-1"], "Tag": [{"Key": "b"}]},
+        app,
+    )
+    _call(tags.delete_tags, {"ResourceId": ["vol-2"]}, app)
+    assert _tagged(_describe(app)) == [("vol-1", "a")]
+
+    with pytest.raises(tags.InvalidIDError):
+        _call(tags.delete_tags, {"ResourceId": ["vm2"]}, app)
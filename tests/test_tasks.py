@@ -0,0 +1,34 @@
+from __future__ import annotations
+
+import asyncio
+import functools
+
+from libvirt_aws import tasks
+
+
+def test_work_queue_is_bounded() -> None:
+    running = 0
+    peak = 0
+    done = []
+
+    async def _job(i: int) -> None:
+        nonlocal running, peak
+        running += 1
+        peak = max(peak, running)
+        await asyncio.sleep(0.01)
+        running -= 1
+        if i == 3:
+            raise RuntimeError("job failure must not kill the worker")
+        done.append(i)
+
+    async def _main() -> None:
+        queue = tasks.WorkQueue("test", 2)
+        for i in range(10):
+            queue.submit(functools.partial(_job, i))
+        await queue.join()
+        await queue.close()
+
+    asyncio.run(_main())
+
+    assert peak == 2
+    assert sorted(done) == [i for i in range(10) if i != 3]
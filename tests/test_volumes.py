@@ -0,0 +1,678 @@
+from __future__ import annotations
+from typing import Any, Dict, List, Optional, Tuple
+
+import asyncio
+import logging
+import sqlite3
+
+from aiohttp import web
+import libvirt
+import pytest
+import xmltodict
+
+from libvirt_aws import capacity
+from libvirt_aws import main
+from libvirt_aws import placement
+from libvirt_aws import profiles
+from libvirt_aws import qemu_img
+from libvirt_aws.handlers import _routing
+from libvirt_aws.handlers import snapshots
+from libvirt_aws.handlers import volumes
+
+
+class _FakeStream:
+    def __init__(self, items: List[Any]) -> None:
+        self.items = items
+
+    def recvFlags(self, nbytes: int, flags: int) -> Any:
+        item = self.items.pop(0)
+        return -3 if isinstance(item, int) else item
+
+    def recvHole(self, flags: int) -> int:
+        return int(self.items.pop(0))
+
+
+class _FakeResponse(web.StreamResponse):
+    def __init__(self) -> None:
+        super().__init__()
+        self.body = bytearray()
+
+    async def write(self, data: Any) -> None:
+        self.body += data
+
+
+def test_send_image_fills_holes() -> None:
+    hole = volumes.TRANSFER_CHUNK_SIZE + 10
+    stream = _FakeStream([b"abc", hole, hole, b"def", b""])
+    response = _FakeResponse()
+
+    asyncio.run(volumes._send_image(stream, response))
+
+    assert response.body == b"abc" + bytes(hole) + b"def"
+
+
+def test_read_chunk() -> None:
+    async def _main() -> List[bytes]:
+        content = asyncio.StreamReader()
+        content.feed_data(b"x" * 10)
+        content.feed_eof()
+        return [
+            await volumes._read_chunk(content, 4)  # type: ignore
+            for _ in range(4)
+        ]
+
+    assert asyncio.run(_main()) == [b"xxxx", b"xxxx", b"xx", b""]
+
+
+class _FakeVol:
+    def __init__(self, *, fail_delete: bool = False) -> None:
+        self.fail_delete = fail_delete
+        self.deleted = False
+
+    def path(self) -> str:
+        return "/pool/vol-1"
+
+    def infoFlags(self, flags: int) -> List[int]:
+        return [0, 100, 100]
+
+    def delete(self, flags: int) -> None:
+        if self.fail_delete:
+            raise libvirt.libvirtError("device busy")
+        self.deleted = True
+
+
+class _FakePool:
+    def __init__(self, vol: Optional[_FakeVol]) -> None:
+        self.vol = vol
+
+    def storageVolLookupByName(self, name: str) -> _FakeVol:
+        if self.vol is None:
+            raise libvirt.libvirtError(f"no volume {name}")
+        return self.vol
+
+
+class _FakeQueue:
+    def __init__(self) -> None:
+        self.jobs: List[Any] = []
+
+    def submit(self, job: Any) -> None:
+        self.jobs.append(job)
+
+
+def _make_app(
+    vol: Optional[_FakeVol],
+    monkeypatch: pytest.MonkeyPatch,
+) -> web.Application:
+    app = web.Application()
+    app["db"] = sqlite3.connect(":memory:")
+    app["logger"] = logging.getLogger("test")
+    app["volume_wipe"] = "none"
+    app["volume_wipe_rate"] = 0
+    app["volume_delete_queue"] = _FakeQueue()
+    app["storage_pools"] = {
+        "p1": placement.StoragePool(
+            "p1",
+            _FakePool(vol),
+            frozenset(),
+            frozenset(),
+            capacity.CapacityAccountant(None, capacity.CapacityLimits()),
+        )
+    }
+    main.init_db(app["db"])
+    with app["db"]:
+        app["db"].execute(
+            """
+                INSERT INTO volumes
+                    (id, availability_zone, volume_type, size, status,
+                     volume_name, pool)
+                VALUES ('vol-1', 'az', 'gp2', 1, 'available', 'vol-1', 'p1')
+            """
+        )
+
+    async def _collect_garbage(app: web.Application) -> None:
+        pass
+
+    monkeypatch.setattr(snapshots, "collect_garbage", _collect_garbage)
+    return app
+
+
+def _get_status(app: web.Application) -> Optional[str]:
+    row = app["db"].execute("SELECT status FROM volumes").fetchone()
+    return row[0] if row is not None else None
+
+
+def _run_jobs(app: web.Application) -> None:
+    async def _main() -> None:
+        queue = app["volume_delete_queue"]
+        while queue.jobs:
+            await queue.jobs.pop(0)()
+
+    asyncio.run(_main())
+
+
+def test_delete_volume(monkeypatch: pytest.MonkeyPatch) -> None:
+    vol = _FakeVol()
+    app = _make_app(vol, monkeypatch)
+
+    asyncio.run(volumes.delete(app, "vol-1", attachments={}))
+    assert _get_status(app) == "deleting"
+    # Deleting again is a no-op.
+    asyncio.run(volumes.delete(app, "vol-1", attachments={}))
+    assert len(app["volume_delete_queue"].jobs) == 1
+
+    _run_jobs(app)
+    assert vol.deleted
+    assert _get_status(app) is None
+
+
+def test_delete_volume_modifying(monkeypatch: pytest.MonkeyPatch) -> None:
+    app = _make_app(_FakeVol(), monkeypatch)
+    with app["db"]:
+        app["db"].execute(
+            """
+                INSERT INTO volume_modification_history
+                    (volume_id, job, state, start_time, modification, params)
+                VALUES ('vol-1', 'modify', 'modifying', '', '{}', '{}')
+            """
+        )
+
+    with pytest.raises(_routing.IncorrectStateError):
+        asyncio.run(volumes.delete(app, "vol-1", attachments={}))
+    assert _get_status(app) == "available"
+
+
+def test_delete_volume_resumed(monkeypatch: pytest.MonkeyPatch) -> None:
+    # A deletion interrupted by a restart is retried, and a volume
+    # that cannot be removed is not retried forever.
+    app = _make_app(_FakeVol(fail_delete=True), monkeypatch)
+    with app["db"]:
+        app["db"].execute("UPDATE volumes SET status = 'deleting'")
+
+    asyncio.run(volumes.resume_volume_jobs(app))
+    assert len(app["volume_delete_queue"].jobs) == 1
+
+    _run_jobs(app)
+    assert _get_status(app) is None
+
+
+def test_modify_volume_setup_failed(monkeypatch: pytest.MonkeyPatch) -> None:
+    app = _make_app(_FakeVol(), monkeypatch)
+    app["libvirt"] = None
+    app["volume_profiles"] = profiles.DEFAULT_PROFILES
+    modification = {
+        "volumeId": "vol-1",
+        "modificationState": "modifying",
+        "startTime": "",
+    }
+    params = {
+        "size": 2,
+        "iops": None,
+        "throughput": None,
+        "grow_filesystem": False,
+    }
+    with app["db"]:
+        seq = volumes._start_modification(
+            app["db"], "vol-1", "modify", modification, params
+        )
+
+    def _describe_volumes(*args: Any, **kwargs: Any) -> Any:
+        raise RuntimeError("no attachments")
+
+    monkeypatch.setattr(volumes, "_describe_volumes", _describe_volumes)
+
+    asyncio.run(volumes._modify_volume(app, seq))
+
+    modification, _ = volumes._get_modification(app, seq)
+    assert modification["modificationState"] == "failed"
+    assert modification["statusMessage"] == "no attachments"
+    assert volumes._get_active_modification(app, "vol-1") is None
+    assert volumes.get_volume_record(app, "vol-1").size == 1
+
+
+def test_wipe_volume_skips_holes(monkeypatch: pytest.MonkeyPatch) -> None:
+    app = _make_app(None, monkeypatch)
+    app["volume_wipe"] = "zero"
+    app["volume_wipe_rate"] = 2**40
+
+    async def _map_extents(path: str, **kwargs: Any) -> List[Any]:
+        assert kwargs["fmt"] == "raw"
+        return [
+            qemu_img.Extent(0, 10, 0, True, False, True, 0),
+            qemu_img.Extent(10, 50, 0, True, True, False, None),
+            qemu_img.Extent(60, 40, 0, True, False, True, 60),
+        ]
+
+    writes: List[Tuple[int, int]] = []
+
+    def _upload(vol: Any, offset: int, data: bytes) -> None:
+        assert not any(data)
+        writes.append((offset, len(data)))
+
+    monkeypatch.setattr(qemu_img, "map_extents", _map_extents)
+    monkeypatch.setattr(volumes, "_upload", _upload)
+    monkeypatch.setattr(volumes, "WIPE_CHUNK_SIZE", 16)
+
+    asyncio.run(volumes._wipe_volume(app, _FakeVol()))
+
+    assert writes == [(0, 10), (60, 16), (76, 16), (92, 8)]
+
+
+FLATTEN_DOMAIN_XML = """
+<domain>
+  <name>vm1</name>
+  <devices>
+    <disk type='volume' device='disk'>
+      <source pool='p1' volume='vol-1'/>
+      {backing_store}
+      <target dev='vdb' bus='virtio'/>
+    </disk>
+  </devices>
+</domain>
+"""
+
+BACKING_STORE_XML = """
+<backingStore type='file'>
+  <format type='qcow2'/>
+  <source file='/pool/snap-image.qcow2'/>
+  <backingStore/>
+</backingStore>
+"""
+
+
+class _FlattenDomain:
+    """A domain with vol-1 attached, whose block pull may fail."""
+
+    def __init__(self, succeed: bool) -> None:
+        self.succeed = succeed
+        self.pulled = False
+        self.jobs: List[Dict[str, int]] = []
+
+    def name(self) -> str:
+        return "vm1"
+
+    def XMLDesc(self, flags: int) -> str:
+        backing_store = "<backingStore/>" if self.pulled else BACKING_STORE_XML
+        return FLATTEN_DOMAIN_XML.format(backing_store=backing_store)
+
+    def blockPull(self, device: str, bandwidth: int, flags: int) -> None:
+        assert device == "vdb"
+        self.jobs = [{"cur": 50, "end": 100}]
+
+    def blockJobInfo(self, device: str, flags: int) -> Dict[str, int]:
+        if self.jobs:
+            return self.jobs.pop(0)
+        self.pulled = self.succeed
+        return {}
+
+
+class _FlattenConn:
+    def __init__(self, domains: List[_FlattenDomain]) -> None:
+        self.domains = domains
+
+    def listAllDomains(self) -> List[_FlattenDomain]:
+        return self.domains
+
+    def lookupByName(self, name: str) -> _FlattenDomain:
+        return self.domains[0]
+
+
+class _FlattenPool(_FakePool):
+    def __init__(self, conn: _FlattenConn) -> None:
+        super().__init__(_FakeVol())
+        self.conn = conn
+
+    def connect(self) -> _FlattenConn:
+        return self.conn
+
+    def name(self) -> str:
+        return "p1"
+
+    def XMLDesc(self, flags: int) -> str:
+        return "<pool type='dir'><target><path>/pool</path></target></pool>"
+
+
+def _make_flatten_app(
+    monkeypatch: pytest.MonkeyPatch,
+    domains: List[_FlattenDomain],
+) -> web.Application:
+    app = _make_app(None, monkeypatch)
+    app["libvirt"] = conn = _FlattenConn(domains)
+    app["storage_pools"]["p1"] = app["storage_pools"]["p1"]._replace(
+        pool=_FlattenPool(conn)
+    )
+
+    async def _sleep(delay: float) -> None:
+        pass
+
+    monkeypatch.setattr(asyncio, "sleep", _sleep)
+    return app
+
+
+@pytest.mark.parametrize("succeed", [True, False])
+def test_flatten_volume_attached(
+    monkeypatch: pytest.MonkeyPatch,
+    succeed: bool,
+) -> None:
+    domain = _FlattenDomain(succeed)
+    app = _make_flatten_app(monkeypatch, [domain])
+    reported: List[float] = []
+
+    async def _main() -> None:
+        await volumes.flatten_volume(app, "vol-1", progress=reported.append)
+
+    if succeed:
+        asyncio.run(_main())
+    else:
+        # The job went away without the chain having been pulled.
+        with pytest.raises(volumes.FlattenError):
+            asyncio.run(_main())
+    assert reported == [50.0]
+    assert "vol-1" not in volumes._busy_volumes
+
+
+def test_flatten_volume_detached(monkeypatch: pytest.MonkeyPatch) -> None:
+    app = _make_flatten_app(monkeypatch, [])
+    commands: List[Tuple[Tuple[str, ...], Dict[str, Any]]] = []
+
+    async def _run(*args: str, **kwargs: Any) -> bytes:
+        commands.append((args, kwargs))
+        return b""
+
+    monkeypatch.setattr(qemu_img, "run", _run)
+
+    asyncio.run(volumes.flatten_volume(app, "vol-1"))
+
+    ((args, kwargs),) = commands
+    assert args == ("rebase", "-f", "qcow2", "-b", "", "/pool/vol-1")
+    # The copy must not starve the guests of disk bandwidth.
+    assert kwargs["low_priority"]
+
+
+SNAPSHOT_IMAGE_XML = """
+<volume type='file'>
+  <name>snap-image.qcow2</name>
+  <key>/pool/snap-image.qcow2</key>
+  <capacity unit='bytes'>10737418240</capacity>
+  <target>
+    <path>/pool/snap-image.qcow2</path>
+    <format type='qcow2'/>
+  </target>
+</volume>
+"""
+
+
+class _FakeSnapshotImage:
+    def XMLDesc(self, flags: int) -> str:
+        return SNAPSHOT_IMAGE_XML
+
+
+class _SnapshotPool:
+    """A pool holding a snapshot image and nothing else."""
+
+    def __init__(self) -> None:
+        self.created: List[str] = []
+
+    def info(self) -> List[int]:
+        return [2, 100 * 2**30, 0, 100 * 2**30]
+
+    def listAllVolumes(self, flags: int) -> List[Any]:
+        return []
+
+    def storageVolLookupByName(self, name: str) -> Any:
+        if name != "snap-image.qcow2":
+            raise libvirt.libvirtError(f"no volume {name}")
+        return _FakeSnapshotImage()
+
+    def createXML(self, xml: str, flags: int) -> None:
+        self.created.append(xml)
+
+
+def _make_snapshot_app(monkeypatch: pytest.MonkeyPatch) -> web.Application:
+    app = _make_app(None, monkeypatch)
+    app["volume_profiles"] = profiles.DEFAULT_PROFILES
+    app["volume_queue"] = _FakeQueue()
+    app["flatten_volumes"] = False
+    pool = _SnapshotPool()
+    app["storage_pools"]["p2"] = placement.StoragePool(
+        "p2",
+        pool,
+        frozenset(),
+        frozenset(),
+        capacity.CapacityAccountant(pool, capacity.CapacityLimits()),
+    )
+    with app["db"]:
+        app["db"].executemany(
+            """
+                INSERT INTO snapshots
+                    (id, volume_id, volume_size, image, description,
+                     start_time, status, pool)
+                VALUES (?, 'vol-0', 10, ?, '', '', ?, 'p2')
+            """,
+            [
+                ("snap-1", "snap-image.qcow2", "completed"),
+                ("snap-2", "snap-image-2.qcow2", "pending"),
+            ],
+        )
+    return app
+
+
+def test_create_volume_from_snapshot(monkeypatch: pytest.MonkeyPatch) -> None:
+    app = _make_snapshot_app(monkeypatch)
+
+    result = asyncio.run(
+        volumes.create(
+            app, {"SnapshotId": "snap-1", "AvailabilityZone": "us-east-2a"}
+        )
+    )
+    volname = result["volumeId"]
+    record = volumes.get_volume_record(app, volname)
+    # As large as the snapshot, next to its image.
+    assert record.size == 10
+    assert record.pool == "p2"
+    assert record.status == "creating"
+
+    async def _run_provisioning() -> None:
+        await app["volume_queue"].jobs.pop()()
+
+    asyncio.run(_run_provisioning())
+
+    (xml,) = app["storage_pools"]["p2"].pool.created
+    vol = xmltodict.parse(xml)["volume"]
+    assert vol["name"] == volname
+    assert vol["capacity"]["#text"] == "10"
+    assert vol["allocation"]["#text"] == "0"
+    assert vol["target"]["format"]["@type"] == "qcow2"
+    assert vol["backingStore"]["path"] == "/pool/snap-image.qcow2"
+    assert vol["backingStore"]["format"]["@type"] == "qcow2"
+    assert volumes.get_volume_record(app, volname).status == "available"
+
+
+@pytest.mark.parametrize(
+    "args, error",
+    [
+        ({"SnapshotId": "snap-1", "Size": "5"}, "InvalidParameterValue"),
+        ({"SnapshotId": "snap-2"}, "IncorrectState"),
+        ({"SnapshotId": "snap-9"}, "InvalidSnapshot.NotFound"),
+    ],
+)
+def test_create_volume_from_snapshot_invalid(
+    monkeypatch: pytest.MonkeyPatch,
+    args: Dict[str, str],
+    error: str,
+) -> None:
+    app = _make_snapshot_app(monkeypatch)
+
+    with pytest.raises(_routing.ServiceError) as excinfo:
+        asyncio.run(
+            volumes.create(app, {**args, "AvailabilityZone": "us-east-2a"})
+        )
+    assert excinfo.value.code == error
+    assert app["volume_queue"].jobs == []
+
+
+IMPORTED_IMAGE_INFO = b"""
+{
+    "virtual-size": 1073741824,
+    "filename": "/pool/vol-new",
+    "format": "qcow2",
+    "format-specific": {
+        "type": "qcow2",
+        "data": {"compat": "1.1", "data-file": "/etc/shadow"}
+    }
+}
+"""
+
+
+class _ImportVol:
+    """A new volume taking an upload, and its stream."""
+
+    def __init__(self) -> None:
+        self.data = bytearray()
+        self.aborted = False
+
+    def connect(self) -> _ImportVol:
+        return self
+
+    def newStream(self, flags: int) -> _ImportVol:
+        return self
+
+    def upload(
+        self,
+        stream: Any,
+        offset: int,
+        length: int,
+        flags: int,
+    ) -> None:
+        pass
+
+    def send(self, data: bytes) -> int:
+        self.data += data
+        return len(data)
+
+    def sendHole(self, length: int, flags: int) -> None:
+        self.data += bytes(length)
+
+    def finish(self) -> None:
+        pass
+
+    def abort(self) -> None:
+        self.aborted = True
+
+    def XMLDesc(self, flags: int) -> str:
+        return SNAPSHOT_IMAGE_XML
+
+
+class _ImportPool:
+    def __init__(self) -> None:
+        self.vol = _ImportVol()
+
+    def createXML(self, xml: str, flags: int) -> _ImportVol:
+        return self.vol
+
+
+def test_import_image_data_file(monkeypatch: pytest.MonkeyPatch) -> None:
+    commands: List[Tuple[str, ...]] = []
+
+    async def _run(*args: str, **kwargs: Any) -> bytes:
+        commands.append(args)
+        return IMPORTED_IMAGE_INFO
+
+    monkeypatch.setattr(qemu_img, "run", _run)
+
+    async def _main() -> int:
+        content = asyncio.StreamReader()
+        content.feed_data(b"QFI\xfb")
+        content.feed_eof()
+        return await volumes._import_image(
+            _ImportPool(),
+            "vol-new",
+            content,  # type: ignore
+            "qcow2",
+            None,
+        )
+
+    with pytest.raises(_routing.InvalidParameterError) as excinfo:
+        asyncio.run(_main())
+    assert "external data file" in excinfo.value.msg
+    # The image is not locked, and thus not written to, by the check.
+    ((cmd, *opts, path),) = commands
+    assert cmd == "info"
+    assert "-U" in opts
+    assert path == "/pool/snap-image.qcow2"
+
+
+LEGACY_VOLUME_XML = """
+<volume type='file'>
+  <name>legacy</name>
+  <key>/pool/legacy</key>
+  <capacity unit='bytes'>10737418240</capacity>
+  <target>
+    <path>/pool/legacy</path>
+    <format type='raw'/>
+  </target>
+</volume>
+"""
+
+
+class _FakeLegacyVol:
+    def XMLDesc(self, flags: int) -> str:
+        return LEGACY_VOLUME_XML
+
+
+class _LegacyPool:
+    """A pool with a volume the inventory does not know about."""
+
+    def listVolumes(self) -> List[str]:
+        return ["legacy"]
+
+    def storageVolLookupByName(self, name: str) -> Any:
+        if name != "legacy":
+            raise libvirt.libvirtError(f"no volume {name}")
+        return _FakeLegacyVol()
+
+
+class _FakeDomain:
+    def __init__(self) -> None:
+        self.attached: List[str] = []
+
+    def name(self) -> str:
+        return "vm1"
+
+    def XMLDesc(self, flags: int) -> str:
+        return """
+            <domain>
+              <name>vm1</name>
+              <devices>
+                <emulator>/usr/bin/qemu-system-x86_64</emulator>
+              </devices>
+            </domain>
+        """
+
+    def attachDevice(self, xml: str) -> None:
+        self.attached.append(xml)
+
+
+def test_attach_legacy_volume_unthrottled(
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    app = _make_app(None, monkeypatch)
+    app["region"] = "us-east-2"
+    app["volume_profiles"] = profiles.DEFAULT_PROFILES
+    app["storage_pools"]["p1"] = placement.StoragePool(
+        "p1",
+        _LegacyPool(),
+        frozenset(),
+        frozenset(),
+        capacity.CapacityAccountant(None, capacity.CapacityLimits()),
+    )
+    domain = _FakeDomain()
+
+    assert volumes.get_volume_record(app, "legacy").volume_type == "standard"
+    asyncio.run(
+        volumes.attach(app, {"VolumeId": "legacy"}, domain, attachments={})
+    )
+
+    (xml,) = domain.attached
+    disk = xmltodict.parse(xml)["disk"]
+    assert disk["source"]["@volume"] == "legacy"
+    assert "iotune" not in disk
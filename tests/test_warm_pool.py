@@ -0,0 +1,105 @@
+from __future__ import annotations
+from typing import AbstractSet, Any, List
+
+import asyncio
+import logging
+import sqlite3
+
+from aiohttp import web
+import pytest
+
+from libvirt_aws import capacity
+from libvirt_aws import main
+from libvirt_aws import placement
+from libvirt_aws import profiles
+from libvirt_aws.handlers import volumes
+from libvirt_aws.handlers import warm_pool
+
+
+def test_parse_spec() -> None:
+    assert warm_pool.parse_spec("gp3:10:4") == warm_pool.WarmSpec(
+        "gp3", 10, 4
+    )
+    for spec in ("gp3:10", "gp3:ten:4", ":10:4", "gp3:0:4"):
+        with pytest.raises(ValueError):
+            warm_pool.parse_spec(spec)
+
+
+class _FakeQueue:
+    def __init__(self) -> None:
+        self.jobs: List[Any] = []
+
+    def submit(self, job: Any) -> None:
+        self.jobs.append(job)
+
+
+class _FakePool:
+    def info(self) -> List[int]:
+        return [2, 1000 * 2**30, 0, 1000 * 2**30]
+
+    def listAllVolumes(self, flags: int) -> List[Any]:
+        return []
+
+
+def _make_pool(
+    name: str,
+    volume_types: AbstractSet[str] = frozenset(),
+) -> placement.StoragePool:
+    return placement.StoragePool(
+        name,
+        _FakePool(),
+        frozenset(),
+        frozenset(volume_types),
+        capacity.CapacityAccountant(_FakePool(), capacity.CapacityLimits()),
+    )
+
+
+def _make_app(specs: List[str]) -> web.Application:
+    app = web.Application()
+    app["db"] = sqlite3.connect(":memory:")
+    app["logger"] = logging.getLogger("test")
+    app["volume_profiles"] = dict(profiles.DEFAULT_PROFILES)
+    app["warm_volumes"] = [warm_pool.parse_spec(s) for s in specs]
+    app["volume_queue"] = _FakeQueue()
+    app["volume_delete_queue"] = _FakeQueue()
+    app["storage_pools"] = {
+        "fast": _make_pool("fast", volume_types={"gp3"}),
+        "bulk": _make_pool("bulk"),
+    }
+    app["volume_placement"] = "capacity"
+    main.init_db(app["db"])
+    return app
+
+
+def test_fill_warm_pool() -> None:
+    app = _make_app(["gp2:10:2", "gp3:20:1"])
+    db = app["db"]
+
+    asyncio.run(volumes.fill_warm_pool(app))
+    warm = warm_pool.get_warm_volumes(db)
+    assert sorted((w.volume_type, w.size) for w in warm) == [
+        ("gp2", 10),
+        ("gp2", 10),
+        ("gp3", 20),
+    ]
+    assert all(w.status == "provisioning" for w in warm)
+    assert len(app["volume_queue"].jobs) == 3
+    # gp2 volumes only fit the unrestricted pool.
+    assert volumes.get_provisioned_sizes(app) == {"fast": 20, "bulk": 20}
+    assert {w.pool for w in warm if w.volume_type == "gp2"} == {"bulk"}
+
+    assert warm_pool.find_ready(db, "gp2", 10, ["bulk"]) is None
+    for w in warm:
+        warm_pool.set_ready(db, w.volume_name)
+    ready = warm_pool.find_ready(db, "gp2", 10, ["bulk"])
+    assert ready is not None and ready.volume_name.endswith(".qcow2")
+    assert warm_pool.find_ready(db, "gp2", 10, ["fast"]) is None
+
+    # Fewer wanted now: ready extras go away, nothing new is made.
+    app["warm_volumes"] = [warm_pool.parse_spec("gp2:10:1")]
+    app["volume_queue"].jobs.clear()
+    asyncio.run(volumes.fill_warm_pool(app))
+    warm = warm_pool.get_warm_volumes(db)
+    assert [(w.volume_type, w.size) for w in warm] == [("gp2", 10)]
+    assert len(app["volume_delete_queue"].jobs) == 2
+    assert not app["volume_queue"].jobs